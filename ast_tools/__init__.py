@@ -1,6 +1,9 @@
 """
 ast_tools top level package
 """
+# keep in sync with setup.py, rewrite caches are keyed on it
+__version__ = '0.1.8'
+
 from .common import *
 from . import immutable_ast
 from . import passes
@@ -1,12 +1,18 @@
 import abc
 import ast
-import datetime
+import builtins
+from collections import OrderedDict
 import functools
+import hashlib
 import inspect
 import itertools
+import linecache
 import logging
 import os
+import sys
+import tempfile
 import textwrap
+import time
 import types
 import typing as tp
 import weakref
@@ -17,10 +23,15 @@ import libcst as cst
 
 from ast_tools import stack
 from ast_tools.stack import SymbolTable
-from ast_tools.visitors import used_names
+from ast_tools.visitors import bound_names
 from ast_tools.cst_utils import to_module
 
-__ALL__ = ['exec_in_file', 'exec_def_in_file', 'exec_str_in_file', 'get_ast', 'get_cst', 'gen_free_name']
+__ALL__ = ['exec_in_file', 'exec_def_in_file', 'exec_str_in_file', 'exec_code',
+           'compile_def_in_file', 'compile_str_in_file', 'restore_source',
+           'gc_sources', 'set_source_limits', 'get_ast', 'get_cst',
+           'clear_source_cache', 'code_names', 'compact_env',
+           'NameAllocator', 'get_name_allocator', 'NAME_ALLOCATOR',
+           'gen_free_name']
 
 CSTDefStmt = tp.Union[
         cst.ClassDef,
@@ -41,6 +52,7 @@ def exec_def_in_file(
         path: tp.Optional[str] = None,
         file_name: tp.Optional[str] = None,
         serialized_tree: tp.Optional[DefStmt] = None,
+        in_memory: bool = False,
         ) -> tp.Any:
     """
     execs a definition in a file and returns the definiton
@@ -48,11 +60,32 @@ def exec_def_in_file(
     For explanation of serialized_tree see
     https://github.com/leonardt/ast_tools/issues/46
     """
-    tree_name = _get_name(tree)
-    if file_name is None:
-        file_name = f'{tree_name}_{datetime.datetime.now().isoformat()}.py'
+    tree_name, code, _ = compile_def_in_file(tree, path, file_name, serialized_tree, in_memory)
+    return exec_code(code, st)[tree_name]
+
+
+def compile_def_in_file(
+        tree: DefStmt,
+        path: tp.Optional[str] = None,
+        file_name: tp.Optional[str] = None,
+        serialized_tree: tp.Optional[DefStmt] = None,
+        in_memory: bool = False,
+        ) -> tp.Tuple[str, types.CodeType, str]:
+    """
+    compiles a definition in a file and returns the name of the definition,
+    the code object which defines it when exec'd and the serialized source
 
-    return exec_in_file(tree, st, path, file_name, serialized_tree)[tree_name]
+    For explanation of serialized_tree see
+    https://github.com/leonardt/ast_tools/issues/46
+    """
+    tree_name = _get_name(tree)
+    source = to_source(tree)
+    if serialized_tree is None:
+        serialized_source = source
+    else:
+        serialized_source = to_source(serialized_tree)
+    code = _compile_in_file(source, path, file_name, serialized_source, in_memory, tree_name)
+    return tree_name, code, serialized_source
 
 def _get_name(tree: DefStmt) -> str:
     if isinstance(tree, ast.AST):
@@ -74,6 +107,7 @@ def exec_in_file(
         path: tp.Optional[str] = None,
         file_name: tp.Optional[str] = None,
         serialized_tree: tp.Optional[DefStmt] = None,
+        in_memory: bool = False,
         ) -> tp.MutableMapping[str, tp.Any]:
 
     """
@@ -88,7 +122,7 @@ def exec_in_file(
         serialized_source = source
     else:
         serialized_source = to_source(serialized_tree)
-    return exec_str_in_file(source, st, path, file_name, serialized_source)
+    return exec_str_in_file(source, st, path, file_name, serialized_source, in_memory)
 
 
 def exec_str_in_file(
@@ -97,6 +131,7 @@ def exec_str_in_file(
         path: tp.Optional[str] = None,
         file_name: tp.Optional[str] = None,
         serialized_source: tp.Optional[str] = None,
+        in_memory: bool = False,
         ) -> tp.MutableMapping[str, tp.Any]:
     """
     execs a string as a module and returns the modified enviroment
@@ -104,28 +139,247 @@ def exec_str_in_file(
     For explanation of serialized_source see
     https://github.com/leonardt/ast_tools/issues/46
     """
+    code = compile_str_in_file(source, path, file_name, serialized_source, in_memory)
+    return exec_code(code, st)
 
+
+def compile_str_in_file(
+        source: str,
+        path: tp.Optional[str] = None,
+        file_name: tp.Optional[str] = None,
+        serialized_source: tp.Optional[str] = None,
+        in_memory: bool = False,
+        ) -> types.CodeType:
+    """
+    writes serialized_source to a file and compiles source as if it came from
+    that file
+
+    If file_name is None the file is named by a hash of serialized_source
+    so identical sources share a single file.
+
+    If in_memory the file is never written, instead serialized_source is
+    registered with linecache under a synthetic file name so that tracebacks
+    and inspect.getsource still work.
+    """
+    return _compile_in_file(source, path, file_name, serialized_source, in_memory)
+
+
+def _compile_in_file(
+        source: str,
+        path: tp.Optional[str],
+        file_name: tp.Optional[str],
+        serialized_source: tp.Optional[str],
+        in_memory: bool,
+        prefix: str = 'ast_tools_exec',
+        ) -> types.CodeType:
     if path is None:
         path = '.ast_tools'
 
-    if file_name is None:
-        file_name = f'ast_tools_exec_{datetime.datetime.now().isoformat()}.py'
-
     if serialized_source is None:
         serialized_source = source
 
+    content_addressed = file_name is None
+    if content_addressed:
+        digest = hashlib.sha256(serialized_source.encode()).hexdigest()[:32]
+        file_name = f'{prefix}_{digest}.py'
+
     file_name = os.path.join(path, file_name)
-    os.makedirs(path, exist_ok=True)
-    with open(file_name, 'w') as fp:
-        fp.write(serialized_source)
+    if in_memory:
+        file_name = f'<{file_name}>'
+        restore_source(file_name, serialized_source)
+    elif not restore_source(file_name, serialized_source, missing_only=content_addressed):
+        _note_write(path, len(serialized_source))
 
     try:
         code = compile(source, filename=file_name, mode='exec')
     except Exception as e:
         logging.exception("Error compiling source")
         raise e from None
+    return code
+
+
+def _is_synthetic(file_name: str) -> bool:
+    return file_name.startswith('<') and file_name.endswith('>')
 
-    st_dict = dict(st)
+
+def restore_source(file_name: str, source: str, missing_only: bool = False) -> bool:
+    """
+    Makes source available as the contents of file_name
+    (the file a code object was compiled from).
+
+    Synthetic file names (of the form `<name>`) are registered with linecache,
+    other files are written to disk.  If missing_only existing sources are
+    left untouched (but are marked as used, see `gc_sources`).
+
+    Returns whether the source already existed.
+    """
+    if _is_synthetic(file_name):
+        if missing_only and file_name in linecache.cache:
+            return True
+        # mtime of None prevents linecache.checkcache from evicting the entry
+        linecache.cache[file_name] = (
+            len(source),
+            None,
+            source.splitlines(True),
+            file_name,
+        )
+        return False
+    else:
+        if missing_only:
+            try:
+                # update the modification time which tracks last use
+                os.utime(file_name)
+                return True
+            except FileNotFoundError:
+                pass
+        dir_name = os.path.dirname(file_name) or '.'
+        os.makedirs(dir_name, exist_ok=True)
+        # write then rename so concurrent readers never see a partial source
+        fd, tmp = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(source)
+            os.replace(tmp, file_name)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return False
+
+
+_MAX_BYTES: tp.Optional[int] = None
+_MAX_AGE: tp.Optional[float] = None
+# path -> approximate number of bytes of sources in path
+_STORE_SIZES: tp.MutableMapping[str, int] = {}
+
+
+def set_source_limits(
+        max_bytes: tp.Optional[int] = None,
+        max_age: tp.Optional[float] = None,
+        ) -> None:
+    """
+    Sets the eviction policy for files of generated sources.
+
+    When a directory of generated sources exceeds max_bytes the least
+    recently used files are removed.  Files which have not been used for
+    max_age seconds are removed whenever a directory is collected (the first
+    time it is written to and whenever it exceeds max_bytes).
+    See `gc_sources`.
+    """
+    global _MAX_BYTES, _MAX_AGE
+    _MAX_BYTES = max_bytes
+    _MAX_AGE = max_age
+    _STORE_SIZES.clear()
+
+
+def _note_write(path: str, size: int) -> None:
+    if _MAX_BYTES is None and _MAX_AGE is None:
+        return
+
+    if path not in _STORE_SIZES:
+        gc_sources(path, _MAX_BYTES, _MAX_AGE)
+        return
+
+    _STORE_SIZES[path] += size
+    if _MAX_BYTES is not None and _STORE_SIZES[path] > _MAX_BYTES:
+        gc_sources(path, _MAX_BYTES, _MAX_AGE)
+
+
+def gc_sources(
+        path: str = '.ast_tools',
+        max_bytes: tp.Optional[int] = None,
+        max_age: tp.Optional[float] = None,
+        ) -> int:
+    """
+    Evicts files of generated sources from path.
+
+    Files not used in the last max_age seconds are removed, then the least
+    recently used files are removed until at most max_bytes remain.  At least
+    one limit is required (pass max_bytes=0 to remove every file), note that
+    removed files may back live code.  Only `.py` files are considered.
+
+    Returns the number of bytes remaining.
+    """
+    if max_bytes is None and max_age is None:
+        raise ValueError('gc_sources requires max_bytes or max_age')
+
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.endswith('.py') and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        pass
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    # least recently used first
+    for mtime, size, file_name in sorted(entries):
+        if ((max_age is not None and now - mtime > max_age)
+                or (max_bytes is not None and total > max_bytes)):
+            try:
+                os.unlink(file_name)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    _STORE_SIZES[path] = total
+    return total
+
+
+# module attributes used by the interpreter (e.g. __name__ sets the
+# __module__ of functions)
+_MODULE_NAMES = frozenset((
+    '__builtins__',
+    '__file__',
+    '__loader__',
+    '__name__',
+    '__package__',
+    '__spec__',
+))
+
+
+def code_names(code: types.CodeType) -> tp.AbstractSet[str]:
+    """
+    Returns the names of globals (and attributes) which code, or any code
+    nested in it, may load
+    """
+    names = set()
+    stack = [code]
+    while stack:
+        c = stack.pop()
+        names.update(c.co_names)
+        stack.extend(k for k in c.co_consts if isinstance(k, types.CodeType))
+    return names
+
+
+def compact_env(
+        code: types.CodeType,
+        st: SymbolTable,
+        keep: tp.Iterable[str] = (),
+        ) -> SymbolTable:
+    """
+    Returns the part of st which code can reference (plus the names in keep)
+    so that exec'ing code does not keep the rest of st alive.
+
+    Names accessed dynamically (e.g. through `globals()` or `eval`) are not
+    detected, these must be passed in keep.
+    """
+    return st.restrict(itertools.chain(code_names(code), _MODULE_NAMES, keep))
+
+
+def exec_code(
+        code: types.CodeType,
+        st: SymbolTable,
+        ) -> tp.MutableMapping[str, tp.Any]:
+    """
+    execs a code object as a module and returns the modified enviroment
+    """
+    if isinstance(st, SymbolTable):
+        st_dict = st.flatten()
+    else:
+        st_dict = dict(st)
     try:
         exec(code, st_dict)
         return st_dict
@@ -134,17 +388,193 @@ def exec_str_in_file(
         raise e from None
 
 
+class _ParsedFile(tp.NamedTuple):
+    # lines of the file as returned by linecache
+    lines: tp.Sequence[str]
+    module: tp.Union[ast.Module, cst.Module]
+    # line of the first decorator (or the def) -> function def
+    functions: tp.Mapping[int, tp.Union[ast.AST, cst.FunctionDef]]
+    # qualname -> class defs
+    classes: tp.Mapping[str, tp.Sequence[tp.Union[ast.ClassDef, cst.ClassDef]]]
+
+
+# nodes which may contain defs (match statements are python 3.10+)
+_AST_DEF_SCOPES = tuple(
+    getattr(ast, name) for name in ('stmt', 'excepthandler', 'match_case')
+    if hasattr(ast, name)
+)
+
+
+def _ast_defs(node: ast.AST, scope: tp.List[str], defs: tp.List) -> None:
+    """
+    Collects (qualname, first line, def) of every def in node in source order
+    """
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            first_line = min([child.lineno, *(d.lineno for d in child.decorator_list)])
+            qualname = '.'.join((*scope, child.name))
+            defs.append((qualname, first_line, child))
+            if isinstance(child, ast.ClassDef):
+                _ast_defs(child, [*scope, child.name], defs)
+            else:
+                _ast_defs(child, [*scope, child.name, '<locals>'], defs)
+        elif isinstance(child, _AST_DEF_SCOPES):
+            _ast_defs(child, scope, defs)
+
+
+# nodes which may contain defs (older libcst releases lack some of them)
+_CST_DEF_SCOPES = tuple(
+    getattr(cst, name) for name in (
+        'BaseCompoundStatement',
+        'BaseSuite',
+        'Else',
+        'ExceptHandler',
+        'ExceptStarHandler',
+        'Finally',
+        'MatchCase',
+    )
+    if hasattr(cst, name)
+)
+
+
+def _cst_defs(node: cst.CSTNode, defs: tp.List) -> None:
+    """
+    Collects every def in node in source order
+    """
+    for child in node.children:
+        if isinstance(child, (cst.FunctionDef, cst.ClassDef)):
+            defs.append(child)
+        if isinstance(child, _CST_DEF_SCOPES):
+            _cst_defs(child, defs)
+
+
+def _parse_file(source: str, kind: str) -> tp.Optional[tp.Tuple]:
+    # Locating defs with libcst position metadata costs more than parsing
+    # so line numbers are taken from the (much cheaper) ast of the file
+    module = ast.parse(source)
+    ast_defs = []
+    _ast_defs(module, [], ast_defs)
+
+    if kind == 'cst':
+        module = cst.parse_module(source)
+        cst_defs = []
+        _cst_defs(module, cst_defs)
+        if len(cst_defs) != len(ast_defs):
+            return None
+        defs = []
+        for (qualname, first_line, a), c in zip(ast_defs, cst_defs):
+            if a.name != c.name.value:
+                return None
+            defs.append((qualname, first_line, c))
+    else:
+        defs = ast_defs
+
+    functions = {}
+    classes = {}
+    for qualname, first_line, node in defs:
+        if isinstance(node, (ast.ClassDef, cst.ClassDef)):
+            classes.setdefault(qualname, []).append(node)
+        else:
+            functions[first_line] = node
+    return module, functions, classes
+
+
+# number of files kept parsed, definitions are usually decorated in import
+# order so only the most recent few are needed
+_PARSED_FILES_SIZE = 16
+_PARSED_FILES: tp.MutableMapping[tp.Tuple[str, str], _ParsedFile] = OrderedDict()
+
+
+def _get_parsed_file(obj, kind: str) -> tp.Optional[_ParsedFile]:
+    try:
+        file_name = inspect.getsourcefile(obj)
+    except TypeError:
+        return None
+    if file_name is None:
+        return None
+
+    if isinstance(obj, types.ModuleType):
+        module_globals = vars(obj)
+    elif isinstance(obj, types.FunctionType):
+        module_globals = obj.__globals__
+    else:
+        module = sys.modules.get(getattr(obj, '__module__', None))
+        module_globals = None if module is None else vars(module)
+
+    # same checks as inspect.getsource
+    linecache.checkcache(file_name)
+    lines = linecache.getlines(file_name, module_globals)
+    if not lines:
+        return None
+
+    key = kind, file_name
+    parsed = _PARSED_FILES.get(key)
+    if parsed is not None and parsed.lines is lines:
+        _PARSED_FILES.move_to_end(key)
+        return parsed
+
+    try:
+        result = _parse_file(''.join(lines), kind)
+    except (SyntaxError, cst.ParserSyntaxError):
+        return None
+    if result is None:
+        return None
+    parsed = _ParsedFile(lines, *result)
+    _PARSED_FILES[key] = parsed
+    while len(_PARSED_FILES) > _PARSED_FILES_SIZE:
+        _PARSED_FILES.popitem(last=False)
+    return parsed
+
+
+def _find_def(obj, parsed: _ParsedFile):
+    if isinstance(obj, types.ModuleType):
+        return parsed.module
+    elif isinstance(obj, types.FunctionType):
+        code = obj.__code__
+        node = parsed.functions.get(code.co_firstlineno)
+        if node is not None and _get_name(node) == code.co_name:
+            return node
+    elif isinstance(obj, type):
+        candidates = parsed.classes.get(obj.__qualname__, ())
+        if len(candidates) == 1:
+            return candidates[0]
+    return None
+
+
+def clear_source_cache() -> None:
+    """
+    Forgets all parsed source files
+    """
+    _PARSED_FILES.clear()
+
+
 _AST_CACHE: tp.MutableMapping[tp.Any, ast.AST] = weakref.WeakKeyDictionary()
 def get_ast(obj) -> ast.AST:
     """
     Given an object, get the corresponding AST
+
+    The file defining obj is parsed once and shared by every object
+    defined in it.
     """
     try:
         return _AST_CACHE[obj]
     except KeyError:
         pass
 
-    src = textwrap.dedent(inspect.getsource(obj))
+    node = None
+    parsed = _get_parsed_file(obj, 'ast')
+    if parsed is not None:
+        node = _find_def(obj, parsed)
+
+    if node is None:
+        src = textwrap.dedent(inspect.getsource(obj))
+    elif isinstance(obj, types.ModuleType):
+        src = ''.join(parsed.lines)
+    else:
+        # ast nodes are mutable so rather than sharing the node with the
+        # module reparse its lines (much cheaper than copying it)
+        first_line = min([node.lineno, *(d.lineno for d in node.decorator_list)])
+        src = textwrap.dedent(''.join(parsed.lines[first_line-1:node.end_lineno]))
 
     if isinstance(obj, types.ModuleType):
         tree = ast.parse(src)
@@ -159,44 +589,65 @@ _CST_CACHE: tp.MutableMapping[tp.Any, cst.CSTNode] = weakref.WeakKeyDictionary()
 def get_cst(obj) -> cst.CSTNode:
     """
     Given an object, get the corresponding CST
+
+    The file defining obj is parsed once and shared by every object
+    defined in it.
     """
     try:
         return _CST_CACHE[obj]
     except KeyError:
         pass
 
-    src = textwrap.dedent(inspect.getsource(obj))
-
-    if isinstance(obj, types.ModuleType):
-        tree = cst.parse_module(src)
-    else:
-        tree = cst.parse_statement(src)
+    tree = None
+    parsed = _get_parsed_file(obj, 'cst')
+    if parsed is not None:
+        tree = _find_def(obj, parsed)
+
+    if tree is None:
+        src = textwrap.dedent(inspect.getsource(obj))
+        if isinstance(obj, types.ModuleType):
+            tree = cst.parse_module(src)
+        else:
+            tree = cst.parse_statement(src)
+    elif not isinstance(obj, types.ModuleType):
+        # inspect.getsource does not include the preceding comments
+        tree = tree.with_changes(leading_lines=())
 
     return _CST_CACHE.setdefault(obj, tree)
 
 
+def _names_with_prefix(
+        tree: cst.CSTNode,
+        env: SymbolTable,
+        prefix: str) -> tp.AbstractSet[str]:
+    names = {name for name in bound_names(tree) if name.startswith(prefix)}
+    if isinstance(env, SymbolTable):
+        names.update(env.with_prefix(prefix))
+    else:
+        names.update(name for name in env.keys() if name.startswith(prefix))
+    return names
+
+
 def is_free_name(tree: cst.CSTNode, env: SymbolTable, name: str):
-    names = used_names(tree)
+    names = bound_names(tree)
     return name not in names and name not in env
 
 
 def is_free_prefix(tree: cst.CSTNode, env: SymbolTable, prefix: str):
-    names = used_names(tree)
-    return not any(
-            name.startswith(prefix)
-            for name in itertools.chain(names, env.keys()))
+    return not _names_with_prefix(tree, env, prefix)
 
 
 def gen_free_name(
         tree: cst.CSTNode,
         env: SymbolTable,
         prefix: tp.Optional[str] = None) -> str:
-    names = used_names(tree) | env.keys()
-    if prefix is not None and prefix not in names:
+    if prefix is not None and is_free_name(tree, env, prefix):
         return prefix
     elif prefix is None:
         prefix = '_auto_name_'
 
+    # only names starting with prefix can collide
+    names = _names_with_prefix(tree, env, prefix)
     f_str = prefix+'{}'
     c = 0
     name = f_str.format(c)
@@ -214,12 +665,14 @@ def gen_free_prefix(
     def check_prefix(prefix: str, used_names: tp.AbstractSet[str]) -> bool:
         return not any(name.startswith(prefix) for name in used_names)
 
-    names = used_names(tree) | env.keys()
+    auto = preprefix is None
+    if auto:
+        preprefix = '_auto_prefix_'
 
-    if preprefix is not None and check_prefix(preprefix, names):
+    # only names starting with preprefix can collide
+    names = _names_with_prefix(tree, env, preprefix)
+    if not auto and not names:
         return preprefix
-    elif preprefix is None:
-        preprefix = '_auto_prefix_'
 
     f_str = preprefix+'{}'
     c = 0
@@ -229,3 +682,223 @@ def gen_free_prefix(
         prefix = f_str.format(c)
 
     return prefix
+
+
+def _tree_names(tree) -> tp.Iterator[str]:
+    """
+    Yields every identifier in a CST or AST (a cheap superset of the names
+    it binds)
+    """
+    if isinstance(tree, ast.AST):
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                yield node.id
+            elif isinstance(node, ast.arg):
+                yield node.arg
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                yield node.name
+            elif isinstance(node, ast.alias):
+                yield (node.asname or node.name).partition('.')[0]
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                yield from node.names
+            elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+                yield node.name
+    else:
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, cst.Name):
+                yield node.value
+            else:
+                stack.extend(node.children)
+
+
+class _TrieNode:
+    __slots__ = 'children', 'is_name', 'is_prefix'
+
+    def __init__(self):
+        self.children = {}
+        self.is_name = False
+        self.is_prefix = False
+
+
+class NameAllocator:
+    """
+    Hands out names which are free in a tree and environment.
+
+    Names and prefixes handed out are reserved so they will not be handed
+    out again.  No name starting with a reserved prefix is handed out but
+    a reserved prefix may be extended to form a new prefix (e.g. to rename
+    a name generated from it).  Reserved names are kept in a trie, the
+    environment is queried on each allocation (see `SymbolTable.has_prefix`,
+    which uses an index of its names) so writes to it between allocations
+    are seen.
+
+    A rewrite shares a single allocator between its passes through metadata
+    (see `get_name_allocator`).
+    """
+    env: tp.Optional[tp.Mapping[str, tp.Any]]
+
+    def __init__(self,
+            tree=None,
+            env: tp.Optional[tp.Mapping[str, tp.Any]] = None,
+            reserved: tp.Iterable[str] = ()):
+        self._root = _TrieNode()
+        # prefix -> next counter to try
+        self._counters = {}
+        # the last tree whose names were reserved
+        self._tree = None
+        self.env = env
+        if tree is not None:
+            self.reserve_tree(tree)
+        if env is not None:
+            _builtins = env.get('__builtins__', builtins)
+            if isinstance(_builtins, types.ModuleType):
+                _builtins = vars(_builtins)
+            for name in _builtins:
+                self.reserve(name)
+        for name in reserved:
+            self.reserve(name)
+
+    def _node(self, s: str) -> _TrieNode:
+        node = self._root
+        for c in s:
+            try:
+                node = node.children[c]
+            except KeyError:
+                child = node.children[c] = _TrieNode()
+                node = child
+        return node
+
+    def reserve(self, name: str) -> None:
+        self._node(name).is_name = True
+
+    def reserve_prefix(self, prefix: str) -> None:
+        self._node(prefix).is_prefix = True
+
+    def reserve_tree(self, tree) -> None:
+        if tree is self._tree:
+            return
+        for name in _tree_names(tree):
+            self.reserve(name)
+        self._tree = tree
+
+    def track(self, tree) -> None:
+        """
+        Records that every name in tree is reserved, so a later
+        `reserve_tree(tree)` is free.  Passes which only introduce names
+        handed out by the allocator should call this on the tree they
+        return.
+        """
+        self._tree = tree
+
+    def _env_has(self, name: str) -> bool:
+        return self.env is not None and name in self.env
+
+    def _env_has_prefix(self, prefix: str) -> bool:
+        env = self.env
+        if env is None:
+            return False
+        elif isinstance(env, SymbolTable):
+            return env.has_prefix(prefix)
+        else:
+            return any(name.startswith(prefix) for name in env.keys())
+
+    def _under_prefix(self, name: str) -> bool:
+        # whether name starts with a reserved prefix
+        node = self._root
+        for c in name:
+            if node.is_prefix:
+                return True
+            node = node.children.get(c)
+            if node is None:
+                return False
+        return node.is_prefix
+
+    def is_free_name(self, name: str) -> bool:
+        if self._under_prefix(name):
+            return False
+        node = self._root
+        for c in name:
+            node = node.children.get(c)
+            if node is None:
+                break
+        else:
+            if node.is_name:
+                return False
+        return not self._env_has(name)
+
+    def is_free_prefix(self, prefix: str) -> bool:
+        node = self._root
+        for c in prefix:
+            node = node.children.get(c)
+            if node is None:
+                break
+        else:
+            # some reserved name or prefix starts with prefix
+            return False
+        return not self._env_has_prefix(prefix)
+
+    def _fresh(self, base: str, is_free: tp.Callable[[str], bool]) -> str:
+        c = self._counters.get(base, 0)
+        candidate = f'{base}{c}'
+        while not is_free(candidate):
+            c += 1
+            candidate = f'{base}{c}'
+        self._counters[base] = c + 1
+        return candidate
+
+    def fresh_name(self, prefix: tp.Optional[str] = None) -> str:
+        """
+        Returns and reserves a free name, prefix if it is free otherwise
+        prefix followed by a number (see `gen_free_name`)
+        """
+        if prefix is not None and self.is_free_name(prefix):
+            name = prefix
+        else:
+            if prefix is None:
+                prefix = '_auto_name_'
+            elif self._under_prefix(prefix):
+                raise ValueError(f'{prefix} starts with a reserved prefix')
+            name = self._fresh(prefix, self.is_free_name)
+        self.reserve(name)
+        return name
+
+    def fresh_prefix(self, preprefix: tp.Optional[str] = None) -> str:
+        """
+        Returns and reserves a prefix no free name starts with,
+        preprefix if it is free otherwise preprefix followed by a number
+        (see `gen_free_prefix`)
+        """
+        if preprefix is not None and self.is_free_prefix(preprefix):
+            prefix = preprefix
+        else:
+            if preprefix is None:
+                preprefix = '_auto_prefix_'
+            prefix = self._fresh(preprefix, self.is_free_prefix)
+        self.reserve_prefix(prefix)
+        return prefix
+
+
+# key of the NameAllocator in the metadata passed between passes
+NAME_ALLOCATOR = 'NAME-ALLOCATOR'
+
+
+def get_name_allocator(
+        tree,
+        env: tp.Mapping[str, tp.Any],
+        metadata: tp.MutableMapping) -> NameAllocator:
+    """
+    Returns the NameAllocator shared through metadata, creating it from tree
+    and env if there is none.  The names of tree are reserved unless it is
+    the tree the allocator last tracked (see `NameAllocator.track`).
+    """
+    try:
+        allocator = metadata[NAME_ALLOCATOR]
+    except KeyError:
+        allocator = metadata[NAME_ALLOCATOR] = NameAllocator(tree, env)
+    else:
+        # passes may have replaced env or added names to tree
+        allocator.env = env
+        allocator.reserve_tree(tree)
+    return allocator
@@ -1,2 +1,3 @@
 from .always_returns_provider import AlwaysReturnsProvider
 from .condition_provider import ConditionProvider, IncrementalConditionProvider
+from .manager import AnalysisManager, ANALYSIS_MANAGER, get_analysis_manager
@@ -0,0 +1,177 @@
+import typing as tp
+
+import libcst as cst
+from libcst.metadata import ProviderT
+
+from ast_tools.cst_utils import to_module
+
+# key of the AnalysisManager in the metadata passed between passes
+ANALYSIS_MANAGER = 'ANALYSIS-MANAGER'
+
+
+class AnalysisManager:
+    '''
+    Caches metadata resolved on a tree so that it can be reused by later
+    passes (or later stages of the same pass).
+
+    Results are valid for the tree object they were resolved on.  When a pass
+    returns a new tree all results are invalidated except those the pass
+    declares it preserves (see `Pass.preserves`), which are remapped onto
+    the nodes of the new tree.
+    '''
+    _tree: tp.Optional[cst.CSTNode]
+    _wrapper: tp.Optional[cst.MetadataWrapper]
+    _results: tp.MutableMapping[ProviderT, tp.Mapping[cst.CSTNode, tp.Any]]
+
+    def __init__(self):
+        self._tree = None
+        self._wrapper = None
+        self._results = {}
+
+    def _set_tree(self, tree: cst.CSTNode) -> None:
+        if tree is not self._tree:
+            self._tree = tree
+            self._wrapper = None
+            self._results = {}
+
+    def wrapper(self, tree: cst.CSTNode) -> cst.MetadataWrapper:
+        '''
+        Returns a MetadataWrapper around `tree`
+        '''
+        self._set_tree(tree)
+        if self._wrapper is None:
+            self._wrapper = cst.MetadataWrapper(to_module(tree), unsafe_skip_copy=True)
+        return self._wrapper
+
+    def resolve(self,
+            tree: cst.CSTNode,
+            provider: ProviderT,
+            ) -> tp.Mapping[cst.CSTNode, tp.Any]:
+        return self.resolve_many(tree, (provider,))[provider]
+
+    def resolve_many(self,
+            tree: cst.CSTNode,
+            providers: tp.Collection[ProviderT],
+            ) -> tp.Mapping[ProviderT, tp.Mapping[cst.CSTNode, tp.Any]]:
+        self._set_tree(tree)
+        missing = [p for p in providers if p not in self._results]
+        if missing:
+            self._results.update(self.wrapper(tree).resolve_many(missing))
+        return {p: self._results[p] for p in providers}
+
+    def visit(self,
+            tree: cst.CSTNode,
+            visitor: tp.Union[cst.CSTVisitor, cst.CSTTransformer],
+            ) -> cst.CSTNode:
+        '''
+        Visits `tree` with `visitor` resolving its metadata dependencies
+        through the cache
+        '''
+        visitor.metadata = self.resolve_many(tree, visitor.get_inherited_dependencies())
+        try:
+            return tree.visit(visitor)
+        finally:
+            visitor.metadata = {}
+
+    def cached(self, tree: cst.CSTNode) -> tp.AbstractSet[ProviderT]:
+        '''
+        Returns the providers whose results are cached for `tree`
+        '''
+        if tree is not self._tree:
+            return frozenset()
+        return frozenset(self._results)
+
+    def record(self,
+            tree: cst.CSTNode,
+            provider: ProviderT,
+            result: tp.Mapping[cst.CSTNode, tp.Any],
+            ) -> None:
+        '''
+        Records the result of `provider` on `tree` computed elsewhere
+        '''
+        self._set_tree(tree)
+        self._results[provider] = result
+
+    def update(self,
+            old_tree: cst.CSTNode,
+            new_tree: cst.CSTNode,
+            preserves: tp.Collection[ProviderT] = (),
+            ) -> None:
+        '''
+        Informs the manager that a pass rewrote `old_tree` to `new_tree`.
+        Results in `preserves` are carried over to `new_tree`, the rest are
+        invalidated.  Carried results are rekeyed on the corresponding nodes
+        of `new_tree` (see `_pair_nodes`), a result with a key that has no
+        corresponding node is dropped.
+        '''
+        if new_tree is old_tree or old_tree is not self._tree:
+            return
+        preserved = {
+            p: r for p, r in self._results.items() if p in preserves
+        }
+        self.clear()
+        if preserved and isinstance(new_tree, cst.CSTNode):
+            pairs, unpaired = _pair_nodes(old_tree, new_tree)
+            self._set_tree(new_tree)
+            for p, r in preserved.items():
+                if not unpaired.isdisjoint(r):
+                    continue
+                # keys outside of old_tree (e.g. the module built by
+                # `wrapper`) are dropped
+                self._results[p] = {
+                    pairs[n]: v for n, v in r.items() if n in pairs
+                }
+
+    def clear(self) -> None:
+        self._tree = self._wrapper = None
+        self._results = {}
+
+
+def _pair_nodes(
+        old_tree: cst.CSTNode,
+        new_tree: cst.CSTNode,
+        ) -> tp.Tuple[tp.Dict[cst.CSTNode, cst.CSTNode], tp.Set[cst.CSTNode]]:
+    '''
+    Pairs the nodes of old_tree with the nodes in the same position in
+    new_tree.  Returns the pairs and the nodes of old_tree without a pair,
+    nodes are unpaired below a node whose counterpart has a different type
+    or number of children.
+    '''
+    pairs = {}
+    unpaired = set()
+    todo = [(old_tree, new_tree)]
+    while todo:
+        old, new = todo.pop()
+        pairs[old] = new
+        if old is new:
+            # unchanged subtrees pair with themselves
+            pairs.update((n, n) for n in _descendants(old))
+            continue
+        old_children = old.children
+        new_children = new.children
+        if (len(old_children) == len(new_children)
+                and all(type(o) is type(n)
+                        for o, n in zip(old_children, new_children))):
+            todo.extend(zip(old_children, new_children))
+        else:
+            unpaired.update(_descendants(old))
+    return pairs, unpaired
+
+
+def _descendants(node: cst.CSTNode) -> tp.Iterator[cst.CSTNode]:
+    todo = list(node.children)
+    while todo:
+        node = todo.pop()
+        yield node
+        todo.extend(node.children)
+
+
+def get_analysis_manager(metadata: tp.Mapping) -> AnalysisManager:
+    '''
+    Returns the AnalysisManager shared through `metadata` or a new one
+    if there is none (e.g. when a pass is invoked directly).
+    '''
+    try:
+        return metadata[ANALYSIS_MANAGER]
+    except KeyError:
+        return AnalysisManager()
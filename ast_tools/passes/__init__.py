@@ -1,10 +1,14 @@
 from .base import * # This MUST be first
 
 from .bool_to_bit import bool_to_bit
+from .cache import BaseRewriteCache, RewriteCache, MemoryRewriteCache
+from .dce import dce
 from .debug import debug
 from .if_inline import if_inline
 from .if_to_phi import if_to_phi
 from .loop_unroll import loop_unroll
 from .remove_asserts import remove_asserts
 from .ssa import ssa
+from .stats import enable_stats, get_stats, reset_stats, report_stats
 from .util import  apply_passes, apply_ast_passes, apply_cst_passes
+from .batch import rewrite_all
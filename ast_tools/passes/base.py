@@ -1,20 +1,95 @@
 from abc import ABCMeta, abstractmethod
+import enum
+import functools
+import hashlib
+import sys
+import types
 import typing as tp
 
 import libcst as cst
+from libcst.metadata import ProviderT
 
 from ast_tools.stack import SymbolTable
+from ast_tools.transformers.fused import fuse
 
-__ALL__ = ['Pass', 'PASS_ARGS_T']
+__ALL__ = ['Pass', 'FusablePass', 'fuse_passes', 'inject', 'PASS_ARGS_T', 'INJECTED_NAMES']
 
 PASS_ARGS_T = tp.Tuple[cst.CSTNode, SymbolTable, tp.MutableMapping]
 
+# key of the names passes have added to env in metadata
+INJECTED_NAMES = 'INJECTED-NAMES'
+
+
+def inject(env: SymbolTable, metadata: tp.MutableMapping, name: str, value: tp.Any) -> None:
+    '''
+    Adds name to env and records it so it is kept when the environment
+    is compacted (see `apply_passes(..., compact_env=True)`).
+    '''
+    env.locals[name] = value
+    metadata.setdefault(INJECTED_NAMES, set()).add(name)
+
+
+def _stable_repr(obj) -> tp.Optional[str]:
+    '''
+    repr of obj which is stable across processes
+    or None if no such repr can be constructed
+    '''
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, enum.Enum)):
+        return repr(obj)
+    elif isinstance(obj, (tuple, list)):
+        items = [_stable_repr(o) for o in obj]
+        if None in items:
+            return None
+        return f'{type(obj).__name__}({", ".join(items)})'
+    elif isinstance(obj, (set, frozenset)):
+        items = [_stable_repr(o) for o in obj]
+        if None in items:
+            return None
+        return f'{type(obj).__name__}({", ".join(sorted(items))})'
+    elif isinstance(obj, dict):
+        items = [(_stable_repr(k), _stable_repr(v)) for k, v in obj.items()]
+        if any(k is None or v is None for k, v in items):
+            return None
+        return '{' + ', '.join(sorted(f'{k}: {v}' for k, v in items)) + '}'
+    elif isinstance(obj, (type, types.FunctionType, types.BuiltinFunctionType)):
+        qualname = getattr(obj, '__qualname__', None)
+        if qualname is None or '<locals>' in qualname:
+            return None
+        return f'{obj.__module__}.{qualname}'
+    else:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _module_digest(name: str) -> tp.Optional[str]:
+    '''
+    Hash of the source file of the module name or None if it has none
+    '''
+    path = getattr(sys.modules.get(name), '__file__', None)
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()[:16]
+    except OSError:
+        return None
+
 
 class Pass(metaclass=ABCMeta):
     """
     Abstract base class for passes
     Mostly a convience to unpack arguments
+
+    `requires` lists the metadata providers the pass uses, these are
+    resolved ahead of the pass and shared through the AnalysisManager in
+    `metadata` (see `ast_tools.metadata.get_analysis_manager`).
+    `preserves` lists the providers whose results remain valid on the
+    corresponding nodes of the tree returned by the pass (see
+    `AnalysisManager.update`).  If the pass returns the tree it was given
+    all results are preserved.
     """
+    requires: tp.Collection[ProviderT] = ()
+    preserves: tp.Collection[ProviderT] = ()
 
     def __call__(self, args: PASS_ARGS_T) -> PASS_ARGS_T:
         return self.rewrite(*args)
@@ -26,3 +101,78 @@ class Pass(metaclass=ABCMeta):
                 metadata: tp.MutableMapping,
                 ) -> PASS_ARGS_T:
         return tree, env, metadata
+
+    def fingerprint(self) -> tp.Optional[str]:
+        """
+        Returns a string identifying the rewrite performed by the pass which
+        is stable across processes or None if the rewrite cannot be cached.
+
+        Caches are keyed on the definition (see `rewrite_key`) and the
+        fingerprints of the passes, not on `env`, so the default is None.
+        Passes whose output does not depend on the values in `env` (they may
+        still use its names, e.g. to pick fresh names) and which do not
+        modify `env` can opt in by returning `args_fingerprint()`.
+        """
+        return None
+
+    def args_fingerprint(self) -> tp.Optional[str]:
+        """
+        Fingerprint built from the pass type, the source of the module
+        defining it and its constructor arguments (the attributes of the
+        pass) or None if they have no stable repr
+        """
+        t = type(self)
+        attrs = _stable_repr(vars(self))
+        if attrs is None or '<locals>' in t.__qualname__:
+            return None
+        digest = _module_digest(t.__module__)
+        if digest is None:
+            return None
+        return f'{t.__module__}.{t.__qualname__}{attrs}@{digest}'
+
+
+class FusablePass(Pass):
+    """
+    Abstract base class for passes implemented entirely by node-local
+    transformers (see `FusedTransformer`).
+
+    Consecutive fusable passes are run by `apply_passes` in a single traversal.
+    When fused, `transformers` is called for every pass in the group with the
+    tree before any of them have run.
+    """
+
+    @abstractmethod
+    def transformers(self,
+                tree: cst.CSTNode,
+                env: SymbolTable,
+                metadata: tp.MutableMapping,
+                ) -> tp.Sequence[cst.CSTTransformer]:
+        pass
+
+    def rewrite(self,
+                tree: cst.CSTNode,
+                env: SymbolTable,
+                metadata: tp.MutableMapping,
+                ) -> PASS_ARGS_T:
+        transformers = self.transformers(tree, env, metadata)
+        if transformers:
+            tree = tree.visit(fuse(transformers))
+        return tree, env, metadata
+
+
+def fuse_passes(
+        passes: tp.Sequence[FusablePass],
+        tree: cst.CSTNode,
+        env: SymbolTable,
+        metadata: tp.MutableMapping,
+        ) -> PASS_ARGS_T:
+    """
+    Runs a sequence of fusable passes in a single traversal
+    """
+    transformers = []
+    for p in passes:
+        transformers.extend(p.transformers(tree, env, metadata))
+    # transformers are node-local and do not use metadata
+    if transformers:
+        tree = tree.visit(fuse(transformers))
+    return tree, env, metadata
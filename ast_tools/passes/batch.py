@@ -0,0 +1,121 @@
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import inspect
+import logging
+import pickle
+import typing as tp
+
+from ast_tools.stack import SymbolTable
+from .stats import measure
+from .util import _Deferred, _PENDING
+
+__ALL__ = ['rewrite_all']
+
+
+def _key_env(env: SymbolTable) -> SymbolTable:
+    '''
+    Builds a picklable environment with the same names as `env` but no values.
+
+    Passes with a fingerprint (see `Pass.fingerprint`) only depend on the names
+    in the environment not their values.
+    '''
+    names = dict.fromkeys(env.keys())
+    # passes fall back to the builtins module when __builtins__ is missing
+    names.pop('__builtins__', None)
+    return SymbolTable(locals={}, globals=names)
+
+
+def _make_job(deferred: _Deferred) -> tp.Optional[bytes]:
+    '''
+    Serializes a pending rewrite for a worker process
+    or returns None if it must be performed in this process
+    '''
+    decorator = deferred.decorator
+    if decorator.fingerprint() is None:
+        return None
+
+    fn = deferred.fn
+    try:
+        source = inspect.getsource(fn)
+    except (OSError, TypeError):
+        return None
+
+    worker_decorator = copy.copy(decorator)
+    # drop the results of previous rewrites
+    for attr in ('i_tree', 'f_tree', 'metadata'):
+        vars(worker_decorator).pop(attr, None)
+    worker_decorator.env = _key_env(deferred.env)
+    worker_decorator.cache = None
+    worker_decorator.lazy = worker_decorator.batch = False
+    try:
+        return pickle.dumps((
+            worker_decorator,
+            source,
+            decorator.initial_metadata(fn),
+        ))
+    except Exception:
+        logging.debug(f'Cannot rewrite {fn.__qualname__} in a worker', exc_info=True)
+        return None
+
+
+def _run_job(job: bytes) -> bytes:
+    decorator, source, metadata = pickle.loads(job)
+    with measure('parse', metadata) as m:
+        tree = decorator.parse_source(source)
+        m.done(tree)
+    tree, _, metadata = decorator.run_passes(tree, decorator.env, metadata)
+    return pickle.dumps((tree, metadata))
+
+
+def rewrite_all(max_workers: tp.Optional[int] = None) -> None:
+    '''
+    Performs all rewrites registered with `apply_passes(..., batch=True)`
+
+    The passes of each rewrite are run on a pool of `max_workers` processes,
+    the rewritten definitions are then exec'd in this process.  Rewrites which
+    cannot be run in a worker (those whose passes depend on the values in
+    `env` or which cannot be pickled) are performed in this process.
+    '''
+    pending = [d for d in _PENDING if d.impl is None]
+    _PENDING.clear()
+
+    jobs = []
+    for deferred in pending:
+        decorator = deferred.decorator
+        key = None
+        if decorator.cache is not None:
+            key = decorator.cache_key(deferred.fn)
+            entry = None if key is None else decorator.cache.load(key)
+            if entry is not None:
+                deferred.resolve(decorator.exec_entry(entry, deferred.env))
+                continue
+
+        job = _make_job(deferred)
+        if job is None:
+            deferred.resolve()
+        else:
+            jobs.append((deferred, key, job))
+
+    if not jobs:
+        return
+
+    if max_workers == 1:
+        results = [_run_job(job) for _, _, job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_run_job, job) for _, _, job in jobs]
+            results = []
+            for f in futures:
+                try:
+                    results.append(f.result())
+                except Exception:
+                    # rewrite again in this process to raise the error
+                    results.append(None)
+
+    for (deferred, key, _), result in zip(jobs, results):
+        if result is None:
+            deferred.resolve()
+            continue
+        decorator = deferred.decorator
+        tree, metadata = pickle.loads(result)
+        deferred.resolve(decorator.finalize(tree, deferred.env, metadata, key))
@@ -2,9 +2,9 @@ import typing as tp
 
 import libcst as cst
 
-from . import Pass
-from . import PASS_ARGS_T
+from . import FusablePass
 
+from ast_tools.metadata import AlwaysReturnsProvider
 from ast_tools.stack import SymbolTable
 
 __ALL__ = ['bool_to_bit']
@@ -51,11 +51,14 @@ class NotTransformer(cst.CSTTransformer):
         return cst.BitInvert()
 
 
-class bool_to_bit(Pass):
+class bool_to_bit(FusablePass):
     '''
     Pass to replace bool operators (and, or, not)
     with bit operators (&, |, ~)
     '''
+    # only expressions are rewritten
+    preserves = (AlwaysReturnsProvider,)
+
     def __init__(self,
             replace_and: bool = True,
             replace_or:  bool = True,
@@ -65,20 +68,21 @@ class bool_to_bit(Pass):
         self.replace_or = replace_or
         self.replace_not = replace_not
 
-    def rewrite(self,
+    def transformers(self,
             tree: cst.CSTNode,
             env: SymbolTable,
-            metadata: tp.MutableMapping) -> PASS_ARGS_T:
+            metadata: tp.MutableMapping) -> tp.Sequence[cst.CSTTransformer]:
+        transformers = []
         if self.replace_and:
-            visitor = AndTransformer()
-            tree = tree.visit(visitor)
+            transformers.append(AndTransformer())
 
         if self.replace_or:
-            visitor = OrTransformer()
-            tree = tree.visit(visitor)
+            transformers.append(OrTransformer())
 
         if self.replace_not:
-            visitor = NotTransformer()
-            tree = tree.visit(visitor)
+            transformers.append(NotTransformer())
+
+        return transformers
 
-        return tree, env, metadata
+    def fingerprint(self) -> tp.Optional[str]:
+        return self.args_fingerprint()
@@ -0,0 +1,167 @@
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import copy
+import hashlib
+import importlib.util
+import logging
+import marshal
+import os
+import pickle
+import sys
+import tempfile
+import types
+import typing as tp
+
+import ast_tools
+
+__ALL__ = ['CacheEntry', 'BaseRewriteCache', 'RewriteCache', 'MemoryRewriteCache', 'rewrite_key']
+
+
+class CacheEntry(tp.NamedTuple):
+    '''
+    The result of rewriting a definition
+    '''
+    # name of the definition
+    name: str
+    # code object which defines the definition when exec'd
+    code: types.CodeType
+    # source written to code.co_filename
+    serialized_source: str
+    metadata: tp.MutableMapping
+
+
+def rewrite_key(source: str, fingerprint: str) -> str:
+    '''
+    Builds a cache key from the source of a definition (or an identifier
+    of it, see `_apply_passes.cache_key`), a fingerprint of
+    the rewrite applied to it and the interpreter and ast_tools versions
+    '''
+    h = hashlib.sha256()
+    for part in (sys.version, importlib.util.MAGIC_NUMBER.hex(),
+                 ast_tools.__version__, fingerprint, source):
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class BaseRewriteCache(metaclass=ABCMeta):
+    '''
+    Abstract base class for caches of rewritten definitions
+    '''
+    @abstractmethod
+    def load(self, key: str) -> tp.Optional[CacheEntry]: pass
+
+    @abstractmethod
+    def store(self, key: str, entry: CacheEntry) -> None: pass
+
+    @abstractmethod
+    def clear(self) -> None: pass
+
+
+class RewriteCache(BaseRewriteCache):
+    '''
+    On-disk cache of rewritten definitions
+
+    Entries store the final rewritten source and the marshaled code object
+    produced by `apply_passes` so that on a hit parsing and the pass pipeline
+    can be skipped entirely.  It is assumed that the rewrite of a definition
+    is fully determined by the key (see `rewrite_key`), only passes for which
+    this holds return a fingerprint (see `Pass.fingerprint`).
+    '''
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + '.pickle')
+
+    def load(self, key: str) -> tp.Optional[CacheEntry]:
+        try:
+            with open(self._entry_path(key), 'rb') as fp:
+                name, code, serialized_source, metadata = pickle.load(fp)
+            code = marshal.loads(code)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logging.debug(f'Ignoring corrupt cache entry {key}', exc_info=True)
+            return None
+        return CacheEntry(name, code, serialized_source, metadata)
+
+    def store(self, key: str, entry: CacheEntry) -> None:
+        try:
+            data = pickle.dumps((
+                entry.name,
+                marshal.dumps(entry.code),
+                entry.serialized_source,
+                entry.metadata,
+            ))
+        except Exception:
+            logging.debug(f'Cannot serialize cache entry for {entry.name}', exc_info=True)
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        # write then rename so concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp, self._entry_path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def clear(self) -> None:
+        if not os.path.isdir(self.path):
+            return
+        for f in os.listdir(self.path):
+            if f.endswith('.pickle'):
+                os.unlink(os.path.join(self.path, f))
+
+
+class MemoryRewriteCache(BaseRewriteCache):
+    '''
+    In-process LRU cache of rewritten definitions
+
+    Useful when the same decorated definition is rewritten many times with the
+    same passes (e.g. in class factories).  On a hit the cached code object is
+    exec'd directly in the current environment.
+    '''
+    maxsize: tp.Optional[int]
+    hits: int
+    misses: int
+    _entries: tp.MutableMapping[str, CacheEntry]
+
+    def __init__(self, maxsize: tp.Optional[int] = 128):
+        if maxsize is not None and maxsize < 1:
+            raise ValueError('maxsize must be >= 1')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def load(self, key: str) -> tp.Optional[CacheEntry]:
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        # metadata is mutable so each hit gets its own copy
+        return entry._replace(metadata=copy.copy(entry.metadata))
+
+    def store(self, key: str, entry: CacheEntry) -> None:
+        self._entries[key] = entry._replace(metadata=copy.copy(entry.metadata))
+        self._entries.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
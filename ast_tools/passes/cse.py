@@ -11,7 +11,6 @@ from . import PASS_ARGS_T
 from ast_tools.common import gen_free_prefix, gen_free_name, is_free_name
 from ast_tools.immutable_ast import immutable, mutable
 from ast_tools.stack import SymbolTable
-from ast_tools.transformers.node_replacer import NodeReplacer
 from ast_tools.visitors.node_finder import NodeFinder
 
 __all__ = ['cse']
@@ -41,7 +40,25 @@ class ExprKeyGetter:
 class ExprFinder(ExprKeyGetter, NodeFinder): pass
 
 
-class ExprReplacer(ExprKeyGetter, NodeReplacer): pass
+class ExprReplacer(ExprKeyGetter, ast.NodeTransformer):
+    # NodeReplacer is a libcst transformer
+    def __init__(self, node_table: tp.Optional[tp.MutableMapping[tp.Any, ast.AST]] = None):
+        if node_table is None:
+            node_table = {}
+        self.node_table = node_table
+
+    def visit(self, node: ast.AST) -> ast.AST:
+        key = self._get_key(node)
+        if key is None or key not in self.node_table:
+            return super().visit(node)
+        else:
+            return deepcopy(self.node_table[key])
+
+    def add_replacement(self, node: ast.AST, replacement: ast.AST):
+        key = self._get_key(node)
+        if key is None:
+            raise TypeError(f'Unsupported node {node}')
+        self.node_table[key] = replacement
 
 
 class ExprCounter(ast.NodeVisitor):
@@ -226,3 +243,7 @@ class cse(Pass):
 
 
         return tree, env, metadata
+
+    def fingerprint(self) -> tp.Optional[str]:
+        # env is only used to pick a fresh prefix
+        return self.args_fingerprint()
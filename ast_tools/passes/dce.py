@@ -0,0 +1,217 @@
+from collections import Counter
+import typing as tp
+
+import libcst as cst
+
+from . import Pass, PASS_ARGS_T
+from ast_tools.stack import SymbolTable
+
+__ALL__ = ['dce']
+
+# names which can read locals without naming them
+_INTROSPECTION = frozenset(('locals', 'vars', 'eval', 'exec', 'dir'))
+
+_LITERALS = (cst.Integer, cst.Float, cst.Imaginary, cst.SimpleString, cst.Ellipsis)
+
+
+def _is_pure(node: cst.BaseExpression, assume_pure: bool) -> bool:
+    '''
+    Whether evaluating node has no side effects (truth testing is assumed
+    to be side effect free).  If assume_pure operators, attribute accesses
+    and subscripts are also assumed to be side effect free, calls never are.
+    '''
+    if isinstance(node, (cst.Name, *_LITERALS)):
+        return True
+    elif isinstance(node, cst.ConcatenatedString):
+        return _is_pure(node.left, assume_pure) and _is_pure(node.right, assume_pure)
+    elif isinstance(node, (cst.Tuple, cst.List)):
+        return all(isinstance(e, cst.Element) and _is_pure(e.value, assume_pure)
+                   for e in node.elements)
+    elif isinstance(node, cst.IfExp):
+        return (_is_pure(node.test, assume_pure)
+                and _is_pure(node.body, assume_pure)
+                and _is_pure(node.orelse, assume_pure))
+    elif isinstance(node, cst.BooleanOperation):
+        return _is_pure(node.left, assume_pure) and _is_pure(node.right, assume_pure)
+    elif isinstance(node, cst.UnaryOperation):
+        return ((assume_pure or isinstance(node.operator, cst.Not))
+                and _is_pure(node.expression, assume_pure))
+    elif not assume_pure:
+        return False
+    elif isinstance(node, cst.BinaryOperation):
+        return _is_pure(node.left, assume_pure) and _is_pure(node.right, assume_pure)
+    elif isinstance(node, cst.Comparison):
+        return _is_pure(node.left, assume_pure) and all(
+                _is_pure(c.comparator, assume_pure) for c in node.comparisons)
+    elif isinstance(node, cst.Attribute):
+        return _is_pure(node.value, assume_pure)
+    elif isinstance(node, cst.Subscript):
+        if not _is_pure(node.value, assume_pure):
+            return False
+        for element in node.slice:
+            s = element.slice
+            if isinstance(s, cst.Index):
+                parts = (s.value,)
+            else:
+                parts = (s.lower, s.upper, s.step)
+            if not all(p is None or _is_pure(p, assume_pure) for p in parts):
+                return False
+        return True
+    return False
+
+
+class _Def(tp.NamedTuple):
+    node: cst.Assign
+    targets: tp.Tuple[str, ...]
+    reads: tp.Sequence[str]
+
+
+class _UseDefIndex:
+    '''
+    Counts the reads of every name in a function and records the side
+    effect free assignments to names in its scope (the candidates for
+    removal) along with the names they read.
+    '''
+    uses: tp.Counter[str]
+    defs: tp.MutableSequence[_Def]
+    defs_by_name: tp.MutableMapping[str, tp.MutableSequence[_Def]]
+    pinned: tp.MutableSet[str]
+
+    def __init__(self, tree: cst.FunctionDef, assume_pure: bool):
+        self.uses = Counter()
+        self.defs = []
+        self.defs_by_name = {}
+        self.pinned = set()
+        self.assume_pure = assume_pure
+        # (node, whether node is in the scope of the function)
+        stack = [(tree.body, True)]
+        while stack:
+            node, in_scope = stack.pop()
+            if isinstance(node, cst.Name):
+                self.uses[node.value] += 1
+            elif isinstance(node, cst.Attribute):
+                stack.append((node.value, in_scope))
+            elif isinstance(node, cst.Arg):
+                # skip keywords
+                stack.append((node.value, in_scope))
+            elif isinstance(node, (cst.Global, cst.Nonlocal)):
+                self.pinned.update(item.name.value for item in node.names)
+            elif isinstance(node, (cst.FunctionDef, cst.ClassDef)):
+                stack.extend((child, False) for child in node.children)
+            elif in_scope and isinstance(node, cst.Assign) and self._is_candidate(node):
+                self._add_def(node)
+            else:
+                stack.extend((child, in_scope) for child in node.children)
+
+    def _is_candidate(self, node: cst.Assign) -> bool:
+        return (all(isinstance(t.target, cst.Name) for t in node.targets)
+                and _is_pure(node.value, self.assume_pure))
+
+    def _add_def(self, node: cst.Assign) -> None:
+        reads = []
+        stack = [node.value]
+        while stack:
+            n = stack.pop()
+            if isinstance(n, cst.Name):
+                reads.append(n.value)
+            elif isinstance(n, cst.Attribute):
+                stack.append(n.value)
+            else:
+                stack.extend(n.children)
+        self.uses.update(reads)
+        d = _Def(node, tuple(t.target.value for t in node.targets), reads)
+        self.defs.append(d)
+        for name in d.targets:
+            self.defs_by_name.setdefault(name, []).append(d)
+
+    def is_dead(self, d: _Def) -> bool:
+        return all(not self.uses[name] and name not in self.pinned for name in d.targets)
+
+    def dead_defs(self) -> tp.AbstractSet[cst.Assign]:
+        '''
+        Returns the assignments which can be removed, removing an assignment
+        removes its reads so assignments are removed until a fixed point
+        '''
+        if not _INTROSPECTION.isdisjoint(self.uses):
+            return frozenset()
+
+        dead = set()
+        work = [d for d in self.defs if self.is_dead(d)]
+        while work:
+            d = work.pop()
+            if d.node in dead or not self.is_dead(d):
+                continue
+            dead.add(d.node)
+            for name in d.reads:
+                self.uses[name] -= 1
+                if not self.uses[name]:
+                    work.extend(self.defs_by_name.get(name, ()))
+        return dead
+
+
+class _DeadCodeRemover(cst.CSTTransformer):
+    def __init__(self, dead: tp.AbstractSet[cst.Assign]):
+        self.dead = dead
+
+    def _filter(self, original_node, updated_node):
+        return [u for o, u in zip(original_node.body, updated_node.body)
+                if o not in self.dead]
+
+    def leave_SimpleStatementLine(self,
+            original_node: cst.SimpleStatementLine,
+            updated_node: cst.SimpleStatementLine,
+            ) -> tp.Union[cst.SimpleStatementLine, cst.RemovalSentinel]:
+        body = self._filter(original_node, updated_node)
+        if not body:
+            return cst.RemoveFromParent()
+        return updated_node.with_changes(body=body)
+
+    def leave_SimpleStatementSuite(self,
+            original_node: cst.SimpleStatementSuite,
+            updated_node: cst.SimpleStatementSuite,
+            ) -> cst.SimpleStatementSuite:
+        body = self._filter(original_node, updated_node)
+        if not body:
+            body = [cst.Pass()]
+        return updated_node.with_changes(body=body)
+
+    def leave_IndentedBlock(self,
+            original_node: cst.IndentedBlock,
+            updated_node: cst.IndentedBlock,
+            ) -> cst.IndentedBlock:
+        if not updated_node.body:
+            return updated_node.with_changes(body=[cst.SimpleStatementLine([cst.Pass()])])
+        return updated_node
+
+
+class dce(Pass):
+    '''
+    Dead code elimination, removes assignments to names which are never
+    read if the assigned value is side effect free (see `_is_pure`).
+    Meant to clean up after `ssa` which leaves unused conditions, muxes
+    and attribute reads.
+
+    If assume_pure operators, attribute accesses and subscripts are assumed
+    to be side effect free.
+
+    Uses are counted once and assignments are removed from a worklist so
+    the whole function is only traversed twice.  Functions which use
+    locals, vars, eval, exec or dir are not changed.
+    '''
+    def __init__(self, assume_pure: bool = False):
+        self.assume_pure = assume_pure
+
+    def rewrite(self,
+            tree: cst.FunctionDef,
+            env: SymbolTable,
+            metadata: tp.MutableMapping) -> PASS_ARGS_T:
+        if not isinstance(tree, cst.FunctionDef):
+            raise TypeError('dce must be run on a FunctionDef')
+
+        dead = _UseDefIndex(tree, self.assume_pure).dead_defs()
+        if dead:
+            tree = tree.visit(_DeadCodeRemover(dead))
+        return tree, env, metadata
+
+    def fingerprint(self) -> tp.Optional[str]:
+        return self.args_fingerprint()
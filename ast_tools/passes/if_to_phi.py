@@ -3,10 +3,9 @@ import warnings
 
 import libcst as cst
 
-from . import Pass
-from . import PASS_ARGS_T
+from . import FusablePass, inject
 
-from ast_tools.common import gen_free_name
+from ast_tools.common import get_name_allocator
 from ast_tools.stack import SymbolTable
 
 __ALL__ = ['if_to_phi']
@@ -14,6 +13,7 @@ __ALL__ = ['if_to_phi']
 
 class IfExpTransformer(cst.CSTTransformer):
     def __init__(self, phi_name: str):
+        super().__init__()
         self.phi_name = phi_name
 
     def leave_IfExp(
@@ -32,7 +32,7 @@ class IfExpTransformer(cst.CSTTransformer):
                 ],
         )
 
-class if_to_phi(Pass):
+class if_to_phi(FusablePass):
     '''
     Pass to convert IfExp to call to phi functions
     phi should have signature:
@@ -55,17 +55,22 @@ class if_to_phi(Pass):
 
         self.phi_name_prefix = phi_name_prefix
 
-    def rewrite(self,
+    def transformers(self,
             tree: cst.CSTNode,
             env: SymbolTable,
-            metadata: tp.MutableMapping) -> PASS_ARGS_T:
+            metadata: tp.MutableMapping) -> tp.Sequence[cst.CSTTransformer]:
 
         if not isinstance(self.phi, str):
-            phi_name = gen_free_name(tree, env, self.phi_name_prefix)
-            env.locals[phi_name] = self.phi
+            allocator = get_name_allocator(tree, env, metadata)
+            phi_name = allocator.fresh_name(self.phi_name_prefix)
+            inject(env, metadata, phi_name, self.phi)
         else:
             phi_name = self.phi
 
-        visitor = IfExpTransformer(phi_name)
-        tree = tree.visit(visitor)
-        return tree, env, metadata
+        return [IfExpTransformer(phi_name)]
+
+    def fingerprint(self) -> tp.Optional[str]:
+        # phi is injected into env
+        if not isinstance(self.phi, str):
+            return None
+        return self.args_fingerprint()
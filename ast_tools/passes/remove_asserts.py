@@ -2,7 +2,8 @@ import typing as tp
 
 import libcst as cst
 
-from . import Pass, PASS_ARGS_T
+from . import FusablePass
+from ast_tools.metadata import AlwaysReturnsProvider
 from ast_tools.stack import SymbolTable
 from ast_tools.transformers.node_replacer import NodeReplacer
 
@@ -14,13 +15,16 @@ class AssertRemover(NodeReplacer):
     def _get_key(self, node): return type(node)
 
 
-class remove_asserts(Pass):
-    def rewrite(self,
+class remove_asserts(FusablePass):
+    # asserts are replaced in place by pass
+    preserves = (AlwaysReturnsProvider,)
+
+    def transformers(self,
             tree: cst.CSTNode,
             env: SymbolTable,
-            metadata: tp.MutableMapping) -> PASS_ARGS_T:
+            metadata: tp.MutableMapping) -> tp.Sequence[cst.CSTTransformer]:
+        return [AssertRemover()]
 
-        visitor = AssertRemover()
-        tree =  tree.visit(visitor)
-        return tree, env, metadata
+    def fingerprint(self) -> tp.Optional[str]:
+        return self.args_fingerprint()
 
@@ -1,4 +1,5 @@
 from collections import ChainMap, Counter
+import bisect
 import builtins
 import types
 import functools as ft
@@ -8,18 +9,16 @@ import libcst as cst
 from libcst.metadata import ExpressionContext, ExpressionContextProvider, PositionProvider
 from libcst import matchers as m
 
-from ast_tools.common import gen_free_prefix
+from ast_tools.common import gen_free_prefix, get_name_allocator, NameAllocator
 from ast_tools.cst_utils import DeepNode
 from ast_tools.cst_utils import to_module, make_assign, to_stmt
-from ast_tools.metadata import AlwaysReturnsProvider, IncrementalConditionProvider
+from ast_tools.metadata import get_analysis_manager
 from ast_tools.stack import SymbolTable
-from ast_tools.transformers.node_tracker import NodeTrackingTransformer, with_tracking
-from ast_tools.transformers.node_replacer import NodeReplacer
-from ast_tools.transformers.normalizers import ElifToElse
-from ast_tools.utils import BiMap
+from ast_tools.transformers.node_tracker import ProvenanceTable, with_tracking
+from ast_tools.visitors.bound_names import _cst_target_names
 from . import Pass, PASS_ARGS_T
 
-__ALL__ = ['ssa']
+__ALL__ = ['ssa', 'SSASymbolTable']
 
 #([gaurds], expr])
 _GAURDED_EXPR = tp.Tuple[tp.Sequence[cst.BaseExpression], cst.BaseExpression]
@@ -121,130 +120,331 @@ def _fold_conditions(
         return conditional
 
 
-class NameTests(NodeTrackingTransformer):
-    '''
-    Rewrites if statements so that their tests are a single name
-    This gaurentees that the conditions are ssa
-    e.g:
-        if x == 0:
-            ...
-        else:
-            ...
-    becomes:
-        cond = x == 0
-        if cond:
-            ...
-        else:
-            ...
-    '''
-    format: str
-    added_names: tp.MutableSet[str]
+def _and_all(exprs: tp.Sequence[cst.BaseExpression]) -> tp.Optional[cst.BaseExpression]:
+    if not exprs:
+        return None
+    return ft.reduce(
+            lambda left, right: cst.BooleanOperation(left=left, operator=cst.And(), right=right),
+            exprs)
 
-    def __init__(self, prefix):
-        super().__init__()
-        self.format = prefix+'_{}'
-        self.added_names = set()
 
-    def leave_If(self,
-            original_node: cst.If,
-            updated_node: cst.If,
-            ) -> cst.If:
-        c_name = cst.Name(value=self.format.format(len(self.added_names)))
-        self.added_names.add(c_name.value)
-        assign = to_stmt(make_assign(c_name, updated_node.test))
-        final_node = updated_node.with_changes(test=c_name)
-        return cst.FlattenSentinel([assign, final_node])
+def _parenthesize(node: cst.BaseExpression) -> cst.BaseExpression:
+    # parenthesize node if it binds less tightly than an operand of `and`
+    if isinstance(node, (cst.BooleanOperation, cst.IfExp, cst.Lambda, cst.NamedExpr, cst.Yield)) \
+            and not node.lpar:
+        return node.with_changes(lpar=[cst.LeftParen()], rpar=[cst.RightParen()])
+    return node
+
 
+class _Untracked(cst.CSTTransformer):
+    '''
+    Base of the transformers used by ssa, which only track nodes when
+    wrapped with `with_tracking`
+    '''
+    def track_with_children(self, original_node, updated_node) -> None:
+        pass
 
-class SingleReturn(NodeTrackingTransformer):
-    METADATA_DEPENDENCIES = (IncrementalConditionProvider, AlwaysReturnsProvider)
 
-    attr_format: tp.Optional[str]
-    attr_states: tp.MutableMapping[str, tp.MutableSequence[_GAURDED_EXPR]]
+class PrepareSSA(_Untracked):
+    '''
+    Prepares a function for SSATransformer in a single traversal:
+        - converts `elif cond:` to `else: if cond:`
+        - replaces written attributes with names (see `ssa.rewrite`)
+        - rewrites if statements so that their tests are a single name
+          which gaurentees that the conditions are ssa e.g:
+            if x == 0:
+                ...
+          becomes:
+            cond = x == 0
+            if cond:
+                ...
+        - transforms the function to single return format, returns become
+          assignments and `tail` holds the statements to write back the
+          attributes and the final return
+
+        - guards loops with the conditions of the enclosing if statements
+          (and the conditions of the preceding returns) as the bodies of if
+          statements are flattened by SSATransformer e.g:
+            if x:
+                while y:
+                    ...
+          becomes:
+            cond = x
+            if cond:
+                while cond and y:
+                    ...
+
+    Loops can't contain return, break or continue as the bodies of if
+    statements are flattened by SSATransformer.
+
+    Conditions are tracked as in IncrementalConditionProvider
+    (and always returning blocks as in AlwaysReturnsProvider) while
+    transforming instead of resolving them on an intermediate tree.
+    '''
+    attr_format: str
+    attr_states: tp.MutableMapping[str, tp.MutableSequence[tp.Tuple[tp.Sequence, cst.Name]]]
+    attr_table: tp.Mapping[DeepNode, cst.Name]
+    cond_format: str
     strict: bool
-    debug: bool
-    env: tp.Mapping[str, tp.Any]
     names_to_attr: tp.Mapping[str, cst.Attribute]
-    return_format: tp.Optional[str]
-    returns: tp.MutableSequence[_GAURDED_EXPR]
+    return_format: str
+    returns: tp.MutableSequence[tp.Tuple[tp.Sequence, cst.Name]]
     scope: tp.Optional[cst.FunctionDef]
     tail: tp.MutableSequence[cst.BaseStatement]
     added_names: tp.MutableSet[str]
     returning_blocks: tp.MutableSet[cst.BaseSuite]
 
     def __init__(self,
-            env: tp.Mapping[str, tp.Any],
             names_to_attr: tp.Mapping[str, cst.Attribute],
+            attr_table: tp.Mapping[DeepNode, cst.Name],
+            cond_prefix: str,
+            prefix: str,
             strict: bool = True,
             ):
-
         super().__init__()
-        self.attr_format = None
+        self.attr_format = prefix + '_final_{}_{}_{}'
         self.attr_states = {}
+        self.attr_table = attr_table
+        self.cond_format = cond_prefix + '_{}'
         self.strict = strict
-        self.env = env
         self.names_to_attr = names_to_attr
+        self.return_format = prefix + '_return_{}'
         self.returns = []
-        self.return_format = None
         self.scope = None
         self.tail = []
         self.added_names = set()
         self.returning_blocks = set()
+        # number of functions / classes entered inside of scope
+        self._depth = 0
+        # (if node, branch) of the enclosing if statements
+        self._conds = []
+        # original if node -> name of its test
+        self._cond_names = {}
+        self._neg_conds = {}
+        self._elifs = set()
+        # original node -> whether it always returns
+        self._always_returns = {}
+        # number of loops entered inside of scope
+        self._loops = 0
+        # len(self._conds) at the entry of the enclosing loops
+        self._loop_conds = []
+        # original loop node -> the condition under which it executes
+        self._loop_gaurds = {}
+
+    def _in_scope(self) -> bool:
+        return self.scope is not None and not self._depth
+
+    def _cond_name(self, node: cst.If) -> cst.Name:
+        # conditions are named when first referenced, a loop references the
+        # conditions of the if statements enclosing it before they are left
+        try:
+            return self._cond_names[node]
+        except KeyError:
+            pass
+        c_name = cst.Name(value=self.cond_format.format(len(self._cond_names)))
+        self.added_names.add(c_name.value)
+        self._cond_names[node] = c_name
+        return c_name
+
+    def _gaurd(self, conds) -> tp.Tuple[cst.BaseExpression, ...]:
+        gaurd = []
+        for node, branch in conds:
+            if branch:
+                gaurd.append(self._cond_name(node))
+            else:
+                try:
+                    neg = self._neg_conds[node]
+                except KeyError:
+                    neg = self._neg_conds[node] = cst.UnaryOperation(
+                            cst.Not(), self._cond_name(node))
+                gaurd.append(neg)
+        return tuple(gaurd)
+
+    def _loop_gaurd(self) -> tp.Optional[cst.BaseExpression]:
+        # The condition under which a loop entered now executes.  An
+        # enclosing loop only executes under its own gaurd so only the if
+        # statements entered since are considered, returns can't be in loops
+        # so only the returns preceding an outermost loop are considered.
+        if self._loop_conds:
+            return _and_all(self._gaurd(self._conds[self._loop_conds[-1]:]))
+
+        gaurd = list(self._gaurd(self._conds))
+        for conds, _ in self.returns:
+            ret_gaurd = self._gaurd(conds)
+            if not ret_gaurd:
+                # unreachable
+                return cst.Name('False')
+            ret_cond = _and_all(ret_gaurd)
+            if isinstance(ret_cond, cst.BooleanOperation):
+                ret_cond = _parenthesize(ret_cond)
+            gaurd.append(cst.UnaryOperation(cst.Not(), ret_cond))
+        return _and_all(gaurd)
+
+    def on_leave(self, original_node, updated_node):
+        if self.attr_table and isinstance(original_node, cst.Attribute):
+            replacement = self.attr_table.get(DeepNode(original_node))
+            if replacement is not None:
+                self.track_with_children(original_node, replacement)
+                return replacement
+        return super().on_leave(original_node, updated_node)
 
     def visit_FunctionDef(self,
             node: cst.FunctionDef) -> tp.Optional[bool]:
-        # prevent recursion into inner functions
-        super().visit_FunctionDef(node)
         if self.scope is None:
             self.scope = node
-            prefix = gen_free_prefix(node, self.env, '__')
-            self.attr_format = prefix + '_final_{}_{}_{}'
-            self.return_format = prefix + '_return_{}'
-
-            return True
-        return False
+        else:
+            self._depth += 1
+        return True
 
     def leave_FunctionDef(self,
             original_node: cst.FunctionDef,
             updated_node: cst.FunctionDef
             ) -> cst.FunctionDef:
-        final_node = updated_node
-        if original_node is self.scope:
-            suite = updated_node.body
-            tail = self.tail
-            for name, attr in self.names_to_attr.items():
-                state = self.attr_states.get(name, [])
-                # default writeback initial value
-                state.append(([], cst.Name(name)))
-                attr_val = _fold_conditions(_simplify_gaurds(state), self.strict)
-                write = to_stmt(make_assign(attr, attr_val))
-                tail.append(write)
-
-            if self.returns:
-                strict = self.strict
-
-                try:
-                    return_val = _fold_conditions(_simplify_gaurds(self.returns), strict)
-                except IncompleteGaurdError:
-                    raise SyntaxError('Cannot prove function always returns') from None
-                return_stmt = cst.SimpleStatementLine([cst.Return(value=return_val)])
-                tail.append(return_stmt)
+        if original_node is not self.scope:
+            self._depth -= 1
+            return updated_node
 
-        return final_node
+        tail = self.tail
+        for name, attr in self.names_to_attr.items():
+            state = [(self._gaurd(c), n) for c, n in self.attr_states.get(name, [])]
+            # default writeback initial value
+            state.append(([], cst.Name(name)))
+            attr_val = _fold_conditions(_simplify_gaurds(state), self.strict)
+            write = to_stmt(make_assign(attr, attr_val))
+            tail.append(write)
+
+        if self.returns:
+            returns = [(self._gaurd(c), n) for c, n in self.returns]
+            try:
+                return_val = _fold_conditions(_simplify_gaurds(returns), self.strict)
+            except IncompleteGaurdError:
+                raise SyntaxError('Cannot prove function always returns') from None
+            return_stmt = cst.SimpleStatementLine([cst.Return(value=return_val)])
+            tail.append(return_stmt)
+        return updated_node
 
     def visit_ClassDef(self,
             node: cst.ClassDef) -> tp.Optional[bool]:
-        return False
+        self._depth += 1
+        return True
+
+    def leave_ClassDef(self,
+            original_node: cst.ClassDef,
+            updated_node: cst.ClassDef
+            ) -> cst.ClassDef:
+        self._depth -= 1
+        return updated_node
+
+    def _visit_loop(self, node: tp.Union[cst.For, cst.While]) -> tp.Optional[bool]:
+        if self._in_scope():
+            gaurd = self._loop_gaurd()
+            if gaurd is not None:
+                self._loop_gaurds[node] = gaurd
+            self._loops += 1
+            self._loop_conds.append(len(self._conds))
+        return True
+
+    def _leave_loop(self, original_node, updated_node):
+        if self._in_scope():
+            self._loops -= 1
+            self._loop_conds.pop()
+        return updated_node
+
+    visit_For = visit_While = _visit_loop
+
+    def leave_For(self,
+            original_node: cst.For,
+            updated_node: cst.For,
+            ) -> cst.For:
+        final_node = self._leave_loop(original_node, updated_node)
+        gaurd = self._loop_gaurds.get(original_node)
+        if gaurd is not None:
+            # don't evaluate iter if the loop doesn't execute
+            new_iter = cst.IfExp(
+                    test=gaurd,
+                    body=_parenthesize(final_node.iter),
+                    orelse=cst.Tuple([]),
+            )
+            final_node = final_node.with_changes(iter=new_iter)
+        return final_node
+
+    def leave_While(self,
+            original_node: cst.While,
+            updated_node: cst.While,
+            ) -> cst.While:
+        final_node = self._leave_loop(original_node, updated_node)
+        gaurd = self._loop_gaurds.get(original_node)
+        if gaurd is not None:
+            new_test = cst.BooleanOperation(
+                    left=gaurd,
+                    operator=cst.And(),
+                    right=_parenthesize(final_node.test),
+            )
+            final_node = final_node.with_changes(test=new_test)
+        return final_node
+
+    def _visit_jump(self, node: tp.Union[cst.Break, cst.Continue]) -> tp.Optional[bool]:
+        if self._in_scope() and self._loops:
+            raise NotImplementedError('ssa does not support break or continue')
+        return True
+
+    visit_Break = visit_Continue = _visit_jump
+
+    def visit_If(self, node: cst.If) -> tp.Optional[bool]:
+        if isinstance(node.orelse, cst.If):
+            self._elifs.add(node.orelse)
+        return True
+
+    def visit_If_body(self, node: cst.If) -> None:
+        if self._in_scope():
+            self._conds.append((node, True))
+
+    def leave_If_body(self, node: cst.If) -> None:
+        if self._in_scope():
+            self._conds.pop()
+
+    def visit_If_orelse(self, node: cst.If) -> None:
+        if self._in_scope() and not self._always_returns.get(node.body, False):
+            self._conds.append((node, False))
+
+    def leave_If_orelse(self, node: cst.If) -> None:
+        if self._in_scope() and not self._always_returns.get(node.body, False):
+            self._conds.pop()
+
+    def leave_If(self,
+            original_node: cst.If,
+            updated_node: cst.If,
+            ) -> tp.Union[cst.Else, cst.FlattenSentinel]:
+        always_returns = self._always_returns
+        always_returns[original_node] = (original_node.orelse is not None
+                and always_returns.get(original_node.body, False)
+                and always_returns.get(original_node.orelse, False))
+
+        c_name = self._cond_name(original_node)
+        assign = to_stmt(make_assign(c_name, updated_node.test))
+        final_node = updated_node.with_changes(test=c_name)
+        if original_node in self._elifs:
+            return cst.Else(body=cst.IndentedBlock(body=[assign, final_node]))
+        return cst.FlattenSentinel([assign, final_node])
+
+    def leave_Else(self,
+            original_node: cst.Else,
+            updated_node: cst.Else,
+            ) -> cst.Else:
+        self._always_returns[original_node] = self._always_returns.get(original_node.body, False)
+        return updated_node
 
     def leave_Return(self,
             original_node: cst.Return,
             updated_node: cst.Return
-            ) -> cst.RemovalSentinel:
-        assert self.return_format is not None
-        assert self.attr_format is not None
+            ) -> tp.Union[cst.Return, cst.FlattenSentinel]:
+        if not self._in_scope():
+            return updated_node
+        elif self._loops:
+            raise NotImplementedError('ssa does not support returning from a loop')
 
         assignments = []
-        cond = self.get_metadata(IncrementalConditionProvider, original_node)
+        cond = tuple(self._conds)
 
         for name, attr in self.names_to_attr.items():
             assert isinstance(attr.value, cst.Name)
@@ -273,13 +473,26 @@ class SingleReturn(NodeTrackingTransformer):
 
         return cst.FlattenSentinel(assignments)
 
+    def _leave_simple_block(self, original_node, final_node) -> None:
+        returns = any(isinstance(child, cst.Return) for child in original_node.body)
+        self._always_returns[original_node] = returns
+        if returns and self._in_scope() and not isinstance(final_node, cst.SimpleStatementLine):
+            self.returning_blocks.add(final_node)
+
+    def leave_SimpleStatementLine(self,
+            original_node: cst.SimpleStatementLine,
+            updated_node: cst.SimpleStatementLine,
+            ) -> cst.SimpleStatementLine:
+        final_node = super().leave_SimpleStatementLine(original_node, updated_node)
+        self._leave_simple_block(original_node, final_node)
+        return final_node
+
     def leave_SimpleStatementSuite(self,
             original_node: cst.SimpleStatementSuite,
             updated_node: cst.SimpleStatementSuite,
             ) -> cst.SimpleStatementSuite:
         final_node = super().leave_SimpleStatementSuite(original_node, updated_node)
-        if self.get_metadata(AlwaysReturnsProvider, original_node):
-            self.returning_blocks.add(final_node)
+        self._leave_simple_block(original_node, final_node)
         return final_node
 
     def leave_IndentedBlock(self,
@@ -287,63 +500,166 @@ class SingleReturn(NodeTrackingTransformer):
             updated_node: cst.IndentedBlock,
             ) -> cst.IndentedBlock:
         final_node = super().leave_IndentedBlock(original_node, updated_node)
-        if self.get_metadata(AlwaysReturnsProvider, original_node):
+        returns = any(self._always_returns.get(child, False) for child in original_node.body)
+        self._always_returns[original_node] = returns
+        if returns and self._in_scope():
             self.returning_blocks.add(final_node)
         return final_node
 
 
-class WrittenAttrs(cst.CSTVisitor):
-    METADATA_DEPENDENCIES = (ExpressionContextProvider,)
-
-    written_attrs: tp.MutableSet[cst.Attribute]
-
-    def __init__(self):
-        super().__init__()
-        self.written_attrs = set()
-
+def _loop_assigned_names(node: tp.Union[cst.For, cst.While]) -> tp.AbstractSet[str]:
+    # Names assigned in a loop which SSATransformer renames.  Other bindings
+    # (e.g. def, class and import) keep their names so must not be merged
+    # at the loop header.
+    names = set()
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        if isinstance(n, cst.Assign):
+            for t in n.targets:
+                _cst_target_names(t.target, names)
+        elif isinstance(n, (cst.AugAssign, cst.AnnAssign, cst.For, cst.NamedExpr)):
+            _cst_target_names(n.target, names)
+        elif isinstance(n, (cst.FunctionDef, cst.ClassDef, cst.Lambda, cst.BaseComp)):
+            # new scope
+            continue
+        stack.extend(n.children)
+    return names
+
+
+def _read_names(node: cst.CSTNode) -> tp.Set[str]:
+    # every name in node which could be read (an over approximation)
+    names = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, cst.Name):
+            names.add(node.value)
+        elif isinstance(node, cst.Attribute):
+            stack.append(node.value)
+        else:
+            stack.extend(node.children)
+    return names
 
-    def visit_Attribute(self,
-            node: cst.Attribute) -> tp.Optional[bool]:
-        ctx = self.get_metadata(ExpressionContextProvider, node)
-        if ctx is ExpressionContext.STORE:
-            self.written_attrs.add(node)
 
+class _Liveness:
+    '''
+    Backward liveness analysis of a function which has been prepared for
+    SSATransformer (see PrepareSSA).  Computes the (original) names which
+    are live after each if statement and at the header of each loop, i.e.
+    the names which need to be merged.
 
-class AttrReplacer(NodeReplacer):
-    def _get_key(self, node):
-        if isinstance(node, cst.Attribute):
-            return DeepNode(node)
+    Conservative: any name which may be read is a use and only plain
+    assignments to names kill.
+    '''
+    live: tp.MutableMapping[tp.Union[cst.If, cst.For, cst.While], tp.AbstractSet[str]]
+
+    def __init__(self, tree: cst.FunctionDef):
+        self.live = {}
+        self.visit_suite(tree.body, set())
+
+    def visit_suite(self,
+            suite: cst.BaseSuite,
+            live: tp.Set[str]) -> tp.Set[str]:
+        if isinstance(suite, cst.SimpleStatementSuite):
+            return self.visit_simple(suite.body, live)
+        for stmt in reversed(suite.body):
+            if isinstance(stmt, cst.SimpleStatementLine):
+                live = self.visit_simple(stmt.body, live)
+            elif isinstance(stmt, cst.If):
+                live = self.visit_If(stmt, live)
+            elif isinstance(stmt, (cst.For, cst.While)):
+                live = self.visit_loop(stmt, live)
+            else:
+                live |= _read_names(stmt)
+        return live
+
+    def visit_simple(self,
+            stmts: tp.Sequence[cst.BaseSmallStatement],
+            live: tp.Set[str]) -> tp.Set[str]:
+        for stmt in reversed(stmts):
+            if isinstance(stmt, cst.Assign):
+                for t in stmt.targets:
+                    if isinstance(t.target, cst.Name):
+                        live.discard(t.target.value)
+                    else:
+                        live |= _read_names(t.target)
+                live |= _read_names(stmt.value)
+            else:
+                live |= _read_names(stmt)
+        return live
+
+    def visit_If(self, node: cst.If, live: tp.Set[str]) -> tp.Set[str]:
+        self.live[node] = frozenset(live)
+        t_live = self.visit_suite(node.body, set(live))
+        orelse = node.orelse
+        if isinstance(orelse, cst.If):
+            f_live = self.visit_If(orelse, live)
+        elif orelse is not None:
+            f_live = self.visit_suite(orelse.body, live)
         else:
-            return None
-
+            f_live = live
+        f_live |= t_live
+        f_live |= _read_names(node.test)
+        return f_live
+
+    def visit_loop(self,
+            node: tp.Union[cst.For, cst.While],
+            live: tp.Set[str]) -> tp.Set[str]:
+        if node.orelse is not None:
+            live = self.visit_suite(node.orelse.body, live)
+
+        header = live
+        if isinstance(node, cst.While):
+            header |= _read_names(node.test)
+
+        # iterate to a fixed point, the body is revisited until the names
+        # live at the header are stable
+        while True:
+            body_live = self.visit_suite(node.body, set(header))
+            if isinstance(node, cst.For):
+                if isinstance(node.target, cst.Name):
+                    body_live.discard(node.target.value)
+                else:
+                    body_live |= _read_names(node.target)
+            if body_live <= header:
+                break
+            header |= body_live
 
-def _wrap(tree: cst.CSTNode) -> cst.MetadataWrapper:
-    return cst.MetadataWrapper(tree, unsafe_skip_copy=True)
+        self.live[node] = frozenset(header)
+        if isinstance(node, cst.For):
+            header |= _read_names(node.iter)
+        return header
 
 
-class SSATransformer(NodeTrackingTransformer):
+class SSATransformer(_Untracked):
     env: tp.Mapping[str, tp.Any]
     ctxs: tp.Mapping[cst.Name, ExpressionContext]
     scope: tp.Optional[cst.FunctionDef]
     name_table: tp.ChainMap[str, str]
     name_idx: Counter
     name_formats: tp.MutableMapping[str, str]
-    name_assignments: tp.MutableMapping[str, tp.Union[cst.Assign, cst.Param]]
+    name_assignments: tp.MutableMapping[str, tp.Union[cst.Assign, cst.Param, cst.For]]
     original_names: tp.MutableMapping[str, str]
     final_names: tp.AbstractSet[str]
     returning_blocks: tp.AbstractSet[cst.BaseSuite]
+    live: tp.Optional[tp.Mapping[cst.CSTNode, tp.AbstractSet[str]]]
     _skip: bool
     _assigned_names: tp.MutableSequence[str]
 
 
     def __init__(self,
             env: tp.Mapping[str, tp.Any],
-            ctxs: tp.Mapping[cst.Name, ExpressionContext],
+            ctxs: tp.Optional[tp.Mapping[cst.Name, ExpressionContext]],
             final_names: tp.AbstractSet[str],
             returning_blocks: tp.AbstractSet[cst.BaseSuite],
             strict: bool = True,
+            allocator: tp.Optional[NameAllocator] = None,
+            live: tp.Optional[tp.Mapping[cst.CSTNode, tp.AbstractSet[str]]] = None,
             ):
         super().__init__()
+        self.allocator = allocator
+        self.live = live
         _builtins = env.get('__builtins__', builtins)
         if isinstance(_builtins, types.ModuleType):
             _builtins = builtins.__dict__
@@ -360,11 +676,69 @@ class SSATransformer(NodeTrackingTransformer):
         self.returning_blocks = returning_blocks
         self._skip = 0
         self._assigned_names = []
+        # node -> context of its subtree, see _push_ctxs
+        self._ctx_roots = {}
+        self._ctx_stack = [(None, ExpressionContext.LOAD)]
+
+
+    def _push_ctxs(self, node: cst.CSTNode) -> None:
+        # Infers expression contexts while transforming the same way
+        # ExpressionContextProvider does instead of resolving it on the tree
+        roots = self._ctx_roots
+        if isinstance(node, cst.Assign):
+            for t in node.targets:
+                roots[t] = ExpressionContext.STORE
+        elif isinstance(node, cst.Attribute):
+            roots[node.value] = ExpressionContext.LOAD
+            roots[node.attr] = None
+        elif isinstance(node, cst.Subscript):
+            roots[node.value] = ExpressionContext.LOAD
+            for element in node.slice:
+                roots[element] = ExpressionContext.LOAD
+        elif isinstance(node, (cst.AnnAssign, cst.AugAssign, cst.NamedExpr, cst.For, cst.CompFor)):
+            roots[node.target] = ExpressionContext.STORE
+        elif isinstance(node, cst.AsName):
+            roots[node.name] = ExpressionContext.STORE
+        elif isinstance(node, cst.Del):
+            roots[node.target] = ExpressionContext.DEL
+        elif isinstance(node, (cst.FunctionDef, cst.ClassDef, cst.Param)):
+            roots[node.name] = ExpressionContext.STORE
+
+        try:
+            ctx = roots.pop(node)
+        except KeyError:
+            return
+        self._ctx_stack.append((node, ctx))
+
+    def on_visit(self, node: cst.CSTNode) -> bool:
+        if self.ctxs is None:
+            self._push_ctxs(node)
+        return super().on_visit(node)
+
+    def on_leave(self, original_node, updated_node):
+        final_node = super().on_leave(original_node, updated_node)
+        if self._ctx_stack[-1][0] is original_node:
+            self._ctx_stack.pop()
+        return final_node
 
+    def _get_ctx(self, node: cst.Name) -> tp.Optional[ExpressionContext]:
+        if self.ctxs is None:
+            return self._ctx_stack[-1][1]
+        return self.ctxs[node]
+
+    def _get_live(self, node: cst.CSTNode) -> tp.Optional[tp.AbstractSet[str]]:
+        # names which need to be merged at node (see _Liveness), or None if
+        # every name does
+        if self.live is None:
+            return None
+        return self.live.get(node)
 
     def _make_name(self, name):
         if name not in self.name_formats:
-            prefix = gen_free_prefix(self.scope, self.env, f'{name}_')
+            if self.allocator is None:
+                prefix = gen_free_prefix(self.scope, self.env, f'{name}_')
+            else:
+                prefix = self.allocator.fresh_prefix(f'{name}_')
             self.name_formats[name] = prefix + '{}'
 
         ssa_name = self.name_formats[name].format(self.name_idx[name])
@@ -456,14 +830,13 @@ class SSATransformer(NodeTrackingTransformer):
             stmt = to_stmt(assign)
 
             assert isinstance(original_node, cst.If)
-            assert isinstance(self.name_assignments[t_name], (cst.Assign, cst.Param))
-            assert isinstance(self.name_assignments[f_name], (cst.Assign, cst.Param))
+            assert isinstance(self.name_assignments[t_name], (cst.Assign, cst.Param, cst.For))
+            assert isinstance(self.name_assignments[f_name], (cst.Assign, cst.Param, cst.For))
             self.track_with_children((
                 self.name_assignments[t_name],
                 self.name_assignments[f_name],
                 original_node,
                 ),  stmt)
-            assert assign in self.node_tracking_table.i
             return stmt
 
         if t_returns and f_returns:
@@ -476,9 +849,12 @@ class SSATransformer(NodeTrackingTransformer):
             # fall through from body
             nt.update(t_nt)
         else:
-            # Mux names
+            # Mux names which are live after the if
+            live = self._get_live(original_node)
             for name in sorted(t_nt.keys() | f_nt.keys()):
-                if name in t_nt and name in f_nt:
+                if live is not None and name not in live:
+                    continue
+                elif name in t_nt and name in f_nt:
                     # mux between true and false
                     suite.append(_mux_name(name, t_nt[name], f_nt[name]))
                 elif name in t_nt and name in nt:
@@ -497,6 +873,126 @@ class SSATransformer(NodeTrackingTransformer):
 
         return cst.FlattenSentinel(suite)
 
+    def _enter_loop(self,
+            original_node: tp.Union[cst.For, cst.While],
+            ) -> tp.Tuple[tp.MutableSequence[cst.BaseStatement], tp.Mapping[str, str]]:
+        # Names which are live before the loop and assigned in it are merged
+        # at the loop header.  As python has no phi nodes the header name is
+        # assigned before the loop and at the end of its body e.g:
+        #     x = 0
+        #     for i in range(n):
+        #         x = x + i
+        # becomes:
+        #     x_0 = 0
+        #     x_1 = x_0
+        #     for i_0 in range(n):
+        #         x_2 = x_1 + i_0
+        #         x_1 = x_2
+        # and x_1 is also the name of x at the loop exit.
+        suite = []
+        headers = {}
+        live = self._get_live(original_node)
+        for name in sorted(_loop_assigned_names(original_node)):
+            if name in self.final_names or name not in self.name_table:
+                continue
+            elif live is not None and name not in live:
+                continue
+            old_name = self.name_table[name]
+            header = self._make_name(name)
+            assign = make_assign(cst.Name(header), cst.Name(old_name))
+            self.name_assignments[header] = assign
+            stmt = to_stmt(assign)
+            self.track_with_children(original_node, stmt)
+            headers[name] = header
+            suite.append(stmt)
+        return suite, headers
+
+    def _leave_loop(self,
+            original_node: tp.Union[cst.For, cst.While],
+            body: cst.BaseSuite,
+            headers: tp.Mapping[str, str],
+            ) -> cst.BaseSuite:
+        # merge the names at the end of the body into the header names
+        assigns = []
+        for name, header in headers.items():
+            current = self.name_table[name]
+            if current != header:
+                assigns.append(make_assign(cst.Name(header), cst.Name(current)))
+
+        if isinstance(body, cst.SimpleStatementSuite):
+            back_edge = assigns
+        else:
+            back_edge = [to_stmt(assign) for assign in assigns]
+        self.track_with_children(original_node, back_edge)
+
+        # the header names are the names at the loop exit
+        local_table = self.name_table.maps[0]
+        for name in _loop_assigned_names(original_node):
+            if name in headers:
+                self.name_table[name] = headers[name]
+            elif self.strict:
+                # Only defined if the loop executes
+                local_table.pop(name, None)
+            # else assume the loop executes and name will fall through
+
+        return body.with_changes(body=(*body.body, *back_edge))
+
+    def _visit_orelse(self,
+            orelse: tp.Optional[cst.Else],
+            suite: tp.MutableSequence[cst.BaseStatement]) -> None:
+        # break is not supported so orelse always executes after the loop
+        if orelse is not None:
+            new_orelse = orelse.visit(self)
+            suite.extend(new_orelse.body.body)
+
+    def visit_For(self, node: cst.For) -> tp.Optional[bool]:
+        # Control recursion order
+        return False
+
+    def leave_For(self,
+            original_node: cst.For,
+            updated_node: cst.For,
+            ) -> cst.FlattenSentinel:
+        # iter is evaluated once before the loop
+        new_iter = updated_node.iter.visit(self)
+        suite, headers = self._enter_loop(original_node)
+        assert not self._assigned_names, self._assigned_names
+        new_target = updated_node.target.visit(self)
+        for name in self._assigned_names:
+            self.name_assignments[name] = original_node
+        self._assigned_names = []
+        new_body = updated_node.body.visit(self)
+        new_body = self._leave_loop(original_node, new_body, headers)
+        suite.append(updated_node.with_changes(
+            target=new_target,
+            iter=new_iter,
+            body=new_body,
+            orelse=None,
+        ))
+        self._visit_orelse(updated_node.orelse, suite)
+        return cst.FlattenSentinel(suite)
+
+    def visit_While(self, node: cst.While) -> tp.Optional[bool]:
+        # Control recursion order
+        return False
+
+    def leave_While(self,
+            original_node: cst.While,
+            updated_node: cst.While,
+            ) -> cst.FlattenSentinel:
+        suite, headers = self._enter_loop(original_node)
+        # test is evaluated at the loop header
+        new_test = updated_node.test.visit(self)
+        new_body = updated_node.body.visit(self)
+        new_body = self._leave_loop(original_node, new_body, headers)
+        suite.append(updated_node.with_changes(
+            test=new_test,
+            body=new_body,
+            orelse=None,
+        ))
+        self._visit_orelse(updated_node.orelse, suite)
+        return cst.FlattenSentinel(suite)
+
     def visit_Assign(self, node: cst.Assign) -> tp.Optional[bool]:
         # Control recursion order
         return False
@@ -550,7 +1046,7 @@ class SSATransformer(NodeTrackingTransformer):
         if name in self.final_names:
             return updated_node
 
-        ctx = self.ctxs[original_node]
+        ctx = self._get_ctx(original_node)
         if ctx is ExpressionContext.LOAD:
             # Names in Load context should not be added to the name table
             # as it makes them seem like they have been modified.
@@ -568,8 +1064,91 @@ class SSATransformer(NodeTrackingTransformer):
         else:
             return updated_node
 
+class SSASymbolTable(tp.Mapping[int, tp.Mapping[str, str]]):
+    '''
+    Maps each line of a function to the ssa names of the original names
+    which are defined at that line.
+
+    Stored as intervals: for each original name a sorted list of
+    (start line, ssa name), each ssa name is live until the start of the
+    next interval or the end of the function.  Use `resolve` to look up a
+    single name, indexing by line builds the dict for that line.
+    '''
+    start_ln: int
+    end_ln: int
+
+    def __init__(self, start_ln: int, end_ln: int):
+        self.start_ln = start_ln
+        self.end_ln = end_ln
+        # name -> ([start line], [ssa name])
+        self._intervals = {}
+
+    def set(self, line: int, name: str, ssa_name: str) -> None:
+        '''
+        Sets name to ssa_name from line to the end of the function
+        (overriding any later definitions)
+        '''
+        if line > self.end_ln:
+            return
+        line = max(line, self.start_ln)
+        try:
+            lines, ssa_names = self._intervals[name]
+        except KeyError:
+            lines, ssa_names = self._intervals[name] = [], []
+        i = bisect.bisect_left(lines, line)
+        del lines[i:], ssa_names[i:]
+        lines.append(line)
+        ssa_names.append(ssa_name)
+
+    def resolve(self, line: int, name: str) -> str:
+        '''
+        Returns the ssa name of name at line, raises KeyError if name is not
+        defined at line
+        '''
+        if self.start_ln <= line <= self.end_ln:
+            try:
+                lines, ssa_names = self._intervals[name]
+            except KeyError:
+                pass
+            else:
+                i = bisect.bisect_right(lines, line)
+                if i:
+                    return ssa_names[i-1]
+        raise KeyError((line, name))
+
+    def export(self) -> tp.Dict[str, tp.Tuple[tp.Tuple[int, int, str], ...]]:
+        '''
+        Returns {name: ((first line, last line, ssa name), ...)}
+        '''
+        exported = {}
+        for name, (lines, ssa_names) in self._intervals.items():
+            ends = [l - 1 for l in lines[1:]]
+            ends.append(self.end_ln)
+            exported[name] = tuple(zip(lines, ends, ssa_names))
+        return exported
+
+    def __getitem__(self, line: int) -> tp.Dict[str, str]:
+        if not self.start_ln <= line <= self.end_ln:
+            raise KeyError(line)
+        table = {}
+        for name, (lines, ssa_names) in self._intervals.items():
+            i = bisect.bisect_right(lines, line)
+            if i:
+                table[name] = ssa_names[i-1]
+        return table
+
+    def __iter__(self) -> tp.Iterator[int]:
+        yield from range(self.start_ln, self.end_ln + 1)
+
+    def __len__(self) -> int:
+        return max(0, self.end_ln - self.start_ln + 1)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.export()})'
+
+
 class GenerateSymbolTable(cst.CSTVisitor):
-    node_tracking_table: BiMap[cst.CSTNode, cst.CSTNode]
+    node_tracking_table: ProvenanceTable
 
     def __init__(self, node_tracking_table, original_names, pos_info, start_ln, end_ln):
         self.node_tracking_table = node_tracking_table
@@ -577,9 +1156,7 @@ class GenerateSymbolTable(cst.CSTVisitor):
         self.pos_info = pos_info
         self.start_ln = start_ln
         self.end_ln = end_ln
-        self.symbol_table = {
-            i: {} for i in range(start_ln, end_ln+1)
-        }
+        self.symbol_table = SSASymbolTable(start_ln, end_ln)
         self.scope = None
 
 
@@ -594,8 +1171,7 @@ class GenerateSymbolTable(cst.CSTVisitor):
                 assert isinstance(origin, cst.BaseCompoundStatement)
                 ln = max(ln, pos.end.line + 1)
 
-        for i in range(ln, self.end_ln+1):
-            self.symbol_table[i][name] = new_name
+        self.symbol_table.set(ln, name, new_name)
 
 
     def visit_FunctionDef(self,
@@ -625,9 +1201,31 @@ class GenerateSymbolTable(cst.CSTVisitor):
                         continue
                     self._set_name(name, ssa_name, origins)
 
+_TrackedPrepareSSA = with_tracking(PrepareSSA)
+_TrackedSSATransformer = with_tracking(SSATransformer)
+
+
 class ssa(Pass):
-    def __init__(self, strict: bool = True):
+    '''
+    Converts a function to static single assignment form.
+
+    If track the origins of the rewritten nodes are tracked to generate
+    the symbol table (`metadata['SYMBOL-TABLE']`), without it the pass is
+    considerably faster.
+
+    If validate the types of the rewritten tree are checked
+    (cst.CSTNode.validate_types_deep), this is slow and only useful for
+    debugging the pass.
+    '''
+    requires = (PositionProvider, ExpressionContextProvider)
+
+    def __init__(self, strict: bool = True, validate: bool = False, track: bool = True):
         self.strict = strict
+        self.validate = validate
+        self.track = track
+        if not track:
+            # positions are only needed for the symbol table
+            self.requires = (ExpressionContextProvider,)
 
     def rewrite(self,
             original_tree: cst.FunctionDef,
@@ -637,39 +1235,33 @@ class ssa(Pass):
             raise TypeError('ssa must be run on a FunctionDef')
 
 
-        # resolve position information necessary for generating symbol table
-        wrapper = _wrap(to_module(original_tree))
-        pos_info = wrapper.resolve(PositionProvider)
-
-        # convert `elif cond:` to `else: if cond:`
-        # (simplifies ssa logic)
-        transformer = with_tracking(ElifToElse)()
-        tree = original_tree.visit(transformer)
-
-        # original node -> generated nodes
-        node_tracking_table = transformer.node_tracking_table
-        # node_tracking_table.i
-        # generated node -> original nodes
+        manager = get_analysis_manager(metadata)
+        allocator = get_name_allocator(original_tree, env, metadata)
 
-        wrapper = _wrap(to_module(tree))
-        writter_attr_visitor = WrittenAttrs()
-        wrapper.visit(writter_attr_visitor)
+        # The only metadata resolved, everything else is tracked while
+        # transforming.  Position information is necessary for generating
+        # the symbol table.
+        resolved = manager.resolve_many(original_tree, self.requires)
+        ctxs = resolved[ExpressionContextProvider]
+        if self.track:
+            prepare_t, ssa_t = _TrackedPrepareSSA, _TrackedSSATransformer
+        else:
+            prepare_t, ssa_t = PrepareSSA, SSATransformer
 
-        replacer = with_tracking(AttrReplacer)()
-        attr_format = gen_free_prefix(tree, env, '_attr') + '_{}_{}'
+        attr_format = allocator.fresh_prefix('_attr') + '_{}_{}'
         init_reads = []
         names_to_attr = {}
-        seen = set()
+        attr_table = {}
 
-        for written_attr in writter_attr_visitor.written_attrs:
+        for written_attr, ctx in ctxs.items():
+            if not (ctx is ExpressionContext.STORE and isinstance(written_attr, cst.Attribute)):
+                continue
             d_attr = DeepNode(written_attr)
-            if d_attr in seen:
+            if d_attr in attr_table:
                 continue
             if not isinstance(written_attr.value, cst.Name):
                 raise NotImplementedError('writing non name nodes is not supported')
 
-            seen.add(d_attr)
-
             attr_name = attr_format.format(
                     written_attr.value.value,
                     written_attr.attr.value,
@@ -681,66 +1273,65 @@ class ssa(Pass):
             norm = d_attr.normal_node
             names_to_attr[attr_name] = norm
             name = cst.Name(attr_name)
-            replacer.add_replacement(written_attr, name)
+            attr_table[d_attr] = name
             read = to_stmt(make_assign(name, norm))
             init_reads.append(read)
 
-        # Replace references to attr with the name generated above
-        tree = tree.visit(replacer)
-
-
-        node_tracking_table = replacer.trace_origins(node_tracking_table)
-
-        # Rewrite conditions to be ssa
-        cond_prefix = gen_free_prefix(tree, env, '_cond')
-        wrapper = _wrap(tree)
-        name_tests = NameTests(cond_prefix)
-        tree = wrapper.visit(name_tests)
-
-        node_tracking_table = name_tests.trace_origins(node_tracking_table)
+        cond_prefix = allocator.fresh_prefix('_cond')
+        prefix = allocator.fresh_prefix('__')
 
-
-        # Transform to single return format
-        wrapper = _wrap(tree)
-        single_return = SingleReturn(env, names_to_attr, self.strict)
-        tree = wrapper.visit(single_return)
-
-        node_tracking_table = single_return.trace_origins(node_tracking_table)
+        # normalize elifs, replace references to attrs with the names generated
+        # above, name conditions and transform to single return format
+        prepare = prepare_t(names_to_attr, attr_table, cond_prefix, prefix, self.strict)
+        tree = original_tree.visit(prepare)
 
         # insert the initial reads / final writes / return
         body = tree.body
-        body = body.with_changes(body=(*init_reads, *body.body, *single_return.tail))
+        body = body.with_changes(body=(*init_reads, *body.body, *prepare.tail))
         tree = tree.with_changes(body=body)
 
         # perform ssa
-        wrapper = _wrap(to_module(tree))
-        ctxs = wrapper.resolve(ExpressionContextProvider)
         # These names were constructed in such a way that they are
         # guaranteed to be ssa and shouldn't be touched by the
         # transformer
-        final_names = single_return.added_names | name_tests.added_names
-        ssa_transformer = SSATransformer(
+        final_names = prepare.added_names
+        ssa_transformer = ssa_t(
                 env,
-                ctxs,
+                None,
                 final_names,
-                single_return.returning_blocks,
-                strict=self.strict)
+                prepare.returning_blocks,
+                strict=self.strict,
+                allocator=allocator,
+                live=_Liveness(tree).live)
         tree = tree.visit(ssa_transformer)
 
-        node_tracking_table = ssa_transformer.trace_origins(node_tracking_table)
-
-        tree.validate_types_deep()
-        # generate symbol table
-        start_ln = pos_info[original_tree].start.line
-        end_ln = pos_info[original_tree].end.line
-        visitor = GenerateSymbolTable(
-                node_tracking_table,
-                ssa_transformer.original_names,
-                pos_info,
-                start_ln,
-                end_ln,
-        )
+        if self.validate:
+            tree.validate_types_deep()
+
+        if self.track:
+            # original node -> generated nodes
+            # (node_tracking_table.i generated node -> original nodes)
+            node_tracking_table = ssa_transformer.trace_origins(prepare.node_tracking_table)
+
+            # generate symbol table
+            pos_info = resolved[PositionProvider]
+            start_ln = pos_info[original_tree].start.line
+            end_ln = pos_info[original_tree].end.line
+            visitor = GenerateSymbolTable(
+                    node_tracking_table,
+                    ssa_transformer.original_names,
+                    pos_info,
+                    start_ln,
+                    end_ln,
+            )
 
-        tree.visit(visitor)
-        metadata.setdefault('SYMBOL-TABLE', list()).append((type(self), visitor.symbol_table))
+            tree.visit(visitor)
+            metadata.setdefault('SYMBOL-TABLE', list()).append((type(self), visitor.symbol_table))
+        # every name introduced above was handed out by the allocator
+        allocator.track(tree)
         return tree, env, metadata
+
+    def fingerprint(self) -> tp.Optional[str]:
+        # env is only used for its names (to pick fresh names and check
+        # that free names are defined)
+        return self.args_fingerprint()
@@ -0,0 +1,238 @@
+import ast
+import atexit
+import os
+import sys
+import time
+import tracemalloc
+import typing as tp
+
+import libcst as cst
+
+__ALL__ = ['PassStats', 'AggregateStats', 'PASS_STATS', 'count_nodes',
+           'enable_stats', 'stats_enabled', 'set_memory_tracing', 'get_stats',
+           'reset_stats', 'report_stats']
+
+# key of the list of PassStats in the metadata of an instrumented rewrite
+PASS_STATS = 'PASS-STATS'
+
+# set to a non empty value other than 0 to collect stats for every rewrite
+# and print a report at exit
+STATS_ENV_VAR = 'AST_TOOLS_STATS'
+
+
+class PassStats(tp.NamedTuple):
+    '''
+    Measurements of one stage of a rewrite
+    '''
+    # name of the stage (the pass name or parse, prologue, strip, ...)
+    name: str
+    # seconds
+    wall: float
+    cpu: float
+    # number of nodes in the tree given to and returned by the stage
+    # None if the stage does not take / return a tree
+    nodes_in: tp.Optional[int]
+    nodes_out: tp.Optional[int]
+    # bytes allocated at the peak of the stage (as reported by tracemalloc)
+    # None if memory tracing is disabled (see `set_memory_tracing`)
+    peak_mem: tp.Optional[int]
+
+
+class AggregateStats(tp.NamedTuple):
+    '''
+    Measurements of a stage summed over every instrumented rewrite
+    '''
+    name: str
+    calls: int
+    wall: float
+    cpu: float
+    nodes_in: int
+    nodes_out: int
+    # largest peak_mem of any call
+    peak_mem: int
+
+
+def count_nodes(tree) -> tp.Optional[int]:
+    if isinstance(tree, ast.AST):
+        return sum(1 for _ in ast.walk(tree))
+    elif isinstance(tree, cst.CSTNode):
+        count = 0
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            count += 1
+            stack.extend(node.children)
+        return count
+    else:
+        return None
+
+
+class _Measurement:
+    '''
+    Context manager which measures a stage and appends the result to `stats`
+
+    The stage should report its result with `done` before exiting.  Nodes
+    are counted outside of the measured region.
+    '''
+    def __init__(self, name: str, stats: tp.MutableSequence[PassStats], tree):
+        self.name = name
+        self.stats = stats
+        self.nodes_in = count_nodes(tree)
+        self.tree_out = None
+        # largest peak (absolute) observed before a nested stage reset it
+        self._nested_peak = 0
+
+    def done(self, tree) -> None:
+        self.tree_out = tree
+
+    def __enter__(self):
+        self._trace_memory = _TRACE_MEMORY
+        if self._trace_memory:
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                # peak is measured relative to the memory in use on entry,
+                # save the peak of the enclosing stages before resetting it
+                _, peak = tracemalloc.get_traced_memory()
+                for m in _ACTIVE:
+                    m._nested_peak = max(m._nested_peak, peak)
+                tracemalloc.reset_peak()
+            self._mem, self._entry_peak = tracemalloc.get_traced_memory()
+            _ACTIVE.append(self)
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        peak = None
+        if self._trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if peak <= self._entry_peak and not self._started_tracing:
+                # the peak could not be reset (python < 3.9) and the stage
+                # did not exceed it, fall back to the memory still in use
+                peak = current
+            peak = max(peak, self._nested_peak)
+            peak = max(peak - self._mem, 0)
+            _ACTIVE.remove(self)
+            if self._started_tracing:
+                tracemalloc.stop()
+        if exc_type is None:
+            nodes_out = count_nodes(self.tree_out)
+            self.stats.append(PassStats(
+                self.name, wall, cpu, self.nodes_in, nodes_out, peak,
+            ))
+        self.tree_out = None
+
+
+# measurements of memory in progress, outermost first
+_ACTIVE: tp.MutableSequence[_Measurement] = []
+
+
+class _NullMeasurement:
+    def done(self, tree) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_MEASUREMENT = _NullMeasurement()
+
+
+def measure(name: str, metadata: tp.Optional[tp.Mapping], tree=None):
+    '''
+    Returns a context manager which measures a stage of a rewrite if the
+    rewrite is instrumented (`metadata` holds PASS_STATS)
+    '''
+    stats = None if metadata is None else metadata.get(PASS_STATS)
+    if stats is None:
+        return _NULL_MEASUREMENT
+    return _Measurement(name, stats, tree)
+
+
+_ENABLED: bool = False
+_TRACE_MEMORY: bool = True
+_AGGREGATE: tp.MutableMapping[str, AggregateStats] = {}
+
+
+def enable_stats(enabled: bool = True) -> None:
+    '''
+    Enables (or disables) instrumentation of every rewrite
+    '''
+    global _ENABLED
+    _ENABLED = enabled
+
+
+def stats_enabled() -> bool:
+    return _ENABLED
+
+
+def set_memory_tracing(enabled: bool = True) -> None:
+    '''
+    Enables (or disables) measuring peak memory with tracemalloc.
+
+    Tracing memory slows the rewrite considerably so the times measured
+    while it is enabled are inflated.
+    '''
+    global _TRACE_MEMORY
+    _TRACE_MEMORY = enabled
+
+
+def record_stats(stats: tp.Iterable[PassStats]) -> None:
+    '''
+    Adds the stats of a rewrite to the process wide stats
+    '''
+    for s in stats:
+        try:
+            a = _AGGREGATE[s.name]
+        except KeyError:
+            a = AggregateStats(s.name, 0, 0.0, 0.0, 0, 0, 0)
+        _AGGREGATE[s.name] = AggregateStats(
+            s.name,
+            a.calls + 1,
+            a.wall + s.wall,
+            a.cpu + s.cpu,
+            a.nodes_in + (s.nodes_in or 0),
+            a.nodes_out + (s.nodes_out or 0),
+            max(a.peak_mem, s.peak_mem or 0),
+        )
+
+
+def get_stats() -> tp.Mapping[str, AggregateStats]:
+    '''
+    Returns the stats of every instrumented rewrite in this process by stage
+    '''
+    return dict(_AGGREGATE)
+
+
+def reset_stats() -> None:
+    _AGGREGATE.clear()
+
+
+def report_stats(file: tp.Optional[tp.TextIO] = None, sort: str = 'wall') -> None:
+    '''
+    Prints the process wide stats sorted by the field `sort` (descending)
+    '''
+    if file is None:
+        file = sys.stderr
+    if sort not in AggregateStats._fields:
+        raise ValueError(f'Cannot sort by {sort}')
+    rows = sorted(_AGGREGATE.values(), key=lambda a: getattr(a, sort), reverse=sort != 'name')
+    if not rows:
+        return
+    width = max(len('stage'), *(len(a.name) for a in rows))
+    print(f'{"stage":<{width}} {"calls":>7} {"wall (s)":>10} {"cpu (s)":>10} '
+          f'{"nodes in":>10} {"nodes out":>10} {"peak (KiB)":>11}', file=file)
+    for a in rows:
+        print(f'{a.name:<{width}} {a.calls:>7} {a.wall:>10.4f} {a.cpu:>10.4f} '
+              f'{a.nodes_in:>10} {a.nodes_out:>10} {a.peak_mem / 1024:>11.1f}', file=file)
+
+
+if os.environ.get(STATS_ENV_VAR, '0') not in ('', '0'):
+    enable_stats()
+    atexit.register(report_stats)
@@ -1,17 +1,28 @@
 from abc import ABCMeta, abstractmethod
 import ast
 import copy
+import functools
 import inspect
+import os
+import textwrap
+import types
 import typing as tp
 import warnings
 
 import libcst as cst
 
-from . import Pass
+from . import Pass, FusablePass
 from . import PASS_ARGS_T
+from . import fuse_passes
+from . import INJECTED_NAMES
+from .cache import CacheEntry, BaseRewriteCache, rewrite_key
+from .stats import PASS_STATS, measure, record_stats, stats_enabled
 
-from ast_tools.stack import get_symbol_table, SymbolTable
+from ast_tools.metadata import AnalysisManager, ANALYSIS_MANAGER
+from ast_tools.stack import get_symbol_table, get_function_symbol_table, SymbolTable
 from ast_tools.common import get_ast, get_cst, exec_def_in_file, exec_str_in_file
+from ast_tools.common import compile_def_in_file, compact_env, exec_code, restore_source
+from ast_tools.common import NAME_ALLOCATOR
 
 __ALL__ = ['begin_rewrite', 'end_rewrite', 'apply_ast_passes']
 
@@ -170,16 +181,40 @@ class end_rewrite(Pass):
         return exec_def_in_file(etree, env, serialized_tree=stree, **self.kwargs)
 
 
+def _source_id(fn) -> tp.Optional[str]:
+    '''
+    Identifies the source of a function by where it is defined and the
+    version of the file defining it, so the source does not have to be
+    read to build a cache key.  None if fn is not defined in a file.
+    '''
+    code = getattr(fn, '__code__', None)
+    if not isinstance(code, types.CodeType):
+        return None
+    try:
+        st = os.stat(code.co_filename)
+    except OSError:
+        return None
+    return '\0'.join(map(str, (
+        os.path.abspath(code.co_filename), code.co_firstlineno, code.co_name,
+        st.st_mtime_ns, st.st_size)))
+
+
 class _apply_passes(metaclass=ABCMeta):
     '''
     Applies a sequence of passes to a function or class
     '''
     passes: tp.Sequence[Pass]
-    env: SymbolTable
+    env: tp.Optional[SymbolTable]
     debug: bool
     path: tp.Optional[str]
     file_name: tp.Optional[str]
     metadata_attr: tp.Optional[str]
+    cache: tp.Optional[BaseRewriteCache]
+    lazy: bool
+    batch: bool
+    in_memory: bool
+    instrument: bool
+    compact_env: bool
 
 
     def __init__(self,
@@ -189,8 +224,17 @@ class _apply_passes(metaclass=ABCMeta):
                  path: tp.Optional[str] = None,
                  file_name: tp.Optional[str] = None,
                  metadata_attr: tp.Optional[str] = None,
+                 cache: tp.Optional[BaseRewriteCache] = None,
+                 lazy: bool = False,
+                 batch: bool = False,
+                 in_memory: bool = False,
+                 instrument: bool = False,
+                 env_from: str = 'stack',
+                 compact_env: bool = False,
             ):
-        if env is None:
+        if env_from not in ('stack', 'function'):
+            raise ValueError(f'Unknown env_from: {env_from}')
+        if env is None and env_from == 'stack':
             env = get_symbol_table([self.__init__])
         self.passes = passes
         self.env = env
@@ -198,6 +242,12 @@ class _apply_passes(metaclass=ABCMeta):
         self.path = path
         self.file_name = file_name
         self.metadata_attr = metadata_attr
+        self.cache = cache
+        self.lazy = lazy
+        self.batch = batch
+        self.in_memory = in_memory
+        self.instrument = instrument
+        self.compact_env = compact_env
 
 
     @staticmethod
@@ -207,11 +257,41 @@ class _apply_passes(metaclass=ABCMeta):
 
     @staticmethod
     @abstractmethod
-    def strip_decorators(tree): pass
+    def parse_source(source): pass
 
 
+    @staticmethod
     @abstractmethod
-    def exec(self, etree, stree, env): pass
+    def strip_decorators(tree): pass
+
+
+    def compile(self, etree, stree, env, metadata) -> tp.Tuple[str, types.CodeType, str]:
+        '''
+        Returns the name of the definition, a code object which defines it
+        and the serialized source.  Required to cache rewrites.
+        '''
+        raise NotImplementedError()
+
+    def exec(self, etree, stree, env, metadata):
+        '''
+        execs the rewritten definition and returns it, by default the result
+        of `compile` is exec'd.  Subclasses may override this instead of
+        `compile`, their rewrites are then never cached (see `fingerprint`).
+        '''
+        name, code, _ = self.compile(etree, stree, env, metadata)
+        return self.exec_code(code, env, metadata)[name]
+
+    def _overrides_exec(self) -> bool:
+        return type(self).exec is not _apply_passes.exec
+
+    def exec_code(self, code, env, metadata):
+        '''
+        execs `code` in `env`, if `self.compact_env` only the names `code`
+        references and the names injected by passes are kept
+        '''
+        if self.compact_env:
+            env = compact_env(code, env, metadata.get(INJECTED_NAMES, ()))
+        return exec_code(code, env)
 
     def prologue(self, tree, env, metadata):
         """
@@ -220,12 +300,58 @@ class _apply_passes(metaclass=ABCMeta):
         """
         return tree, env, metadata
 
+    def instrumenting(self) -> bool:
+        '''
+        Whether rewrites should be measured (see `ast_tools.passes.stats`)
+        '''
+        return self.instrument or stats_enabled()
+
     def do_passes(self, tree, env, metadata):
-        args = (tree, env, metadata)
+        groups = []
         for p in self.passes:
-            args = p(args)
+            if (isinstance(p, FusablePass)
+                    and groups and isinstance(groups[-1][0], FusablePass)):
+                groups[-1].append(p)
+            else:
+                groups.append([p])
+
+        owns_manager = ANALYSIS_MANAGER not in metadata
+        owns_allocator = NAME_ALLOCATOR not in metadata
+        manager = metadata.setdefault(ANALYSIS_MANAGER, AnalysisManager())
+        args = (tree, env, metadata)
+        try:
+            for group in groups:
+                args = self._do_group(group, args, manager)
+        finally:
+            if owns_manager:
+                # the manager holds trees so must not escape the rewrite
+                # (metadata is cached and sent between processes)
+                for md in (metadata, args[2]):
+                    md.pop(ANALYSIS_MANAGER, None)
+            if owns_allocator:
+                # likewise the name allocator (see ast_tools.common.NameAllocator)
+                for md in (metadata, args[2]):
+                    md.pop(NAME_ALLOCATOR, None)
         return args
 
+    def _do_group(self, group, args, manager):
+        tree, env, metadata = args
+        metadata.setdefault(ANALYSIS_MANAGER, manager)
+        requires = set().union(*(p.requires for p in group))
+        with measure('+'.join(type(p).__name__ for p in group), metadata, tree) as m:
+            if requires:
+                manager.resolve_many(tree, requires)
+
+            if len(group) == 1:
+                new_args = group[0](args)
+            else:
+                new_args = fuse_passes(group, *args)
+            m.done(new_args[0])
+
+        preserves = set(group[0].preserves).intersection(*(p.preserves for p in group[1:]))
+        manager.update(tree, new_args[0], preserves)
+        return new_args
+
     def epilogue(self, tree, env, metadata):
         """
         Invoked after `do_passes`, redefine this method to add code that
@@ -233,53 +359,246 @@ class _apply_passes(metaclass=ABCMeta):
         """
         return tree, env, metadata
 
+    def fingerprint(self) -> tp.Optional[str]:
+        '''
+        Returns a string identifying the rewrite performed by the decorator
+        or None if it cannot be cached (see `Pass.fingerprint`)
+        '''
+        if self._overrides_exec():
+            # cached rewrites are exec'd without calling exec
+            return None
+        t = type(self)
+        fingerprints = [
+            f'{t.__module__}.{t.__qualname__}',
+            repr((self.debug, self.path, self.file_name, self.in_memory)),
+        ]
+        for p in self.passes:
+            fp = p.fingerprint()
+            if fp is None:
+                return None
+            fingerprints.append(fp)
+        return '\n'.join(fingerprints)
+
+    def cache_key(self, fn) -> tp.Optional[str]:
+        fingerprint = self.fingerprint()
+        if fingerprint is None:
+            return None
+        source = _source_id(fn)
+        if source is None:
+            try:
+                source = inspect.getsource(fn)
+            except (OSError, TypeError):
+                return None
+        return rewrite_key(source, fingerprint)
+
+    def get_env(self, fn) -> SymbolTable:
+        '''
+        Returns the environment of `fn`, `self.env` unless it was constructed
+        with `env_from='function'` (and no env), in which case the environment
+        is built from `fn` (see `get_function_symbol_table`).  Must be called
+        while `fn` is being decorated.
+        '''
+        if self.env is not None:
+            return self.env
+        elif inspect.isfunction(fn):
+            return get_function_symbol_table(fn, [self.__call__, self.get_env])
+        else:
+            return get_symbol_table([self.__call__, self.get_env])
+
     def __call__(self, fn):
-        tree = self.parse(fn)
+        env = self.get_env(fn)
+        if self.lazy or self.batch:
+            return self.defer(fn, env)
+        return self.apply(fn, env)
+
+    def defer(self, fn, env: tp.Optional[SymbolTable] = None):
+        '''
+        Returns a trampoline which rewrites `fn` on its first invocation.
+
+        The trampoline forwards to the rewritten function and, if `fn` is bound
+        at module level, rebinds the name to the rewritten function so later
+        calls through the module skip the trampoline entirely.
+
+        If `self.batch` the rewrite is also registered as pending so that it
+        may be performed ahead of time by `rewrite_all`.
+        '''
+        if not inspect.isfunction(fn):
+            raise TypeError('deferred rewriting is only supported for functions')
+
+        if env is None:
+            env = self.env
+        deferred = _Deferred(self, fn, env)
+
+        @functools.wraps(fn)
+        def trampoline(*args, **kwargs):
+            return deferred.resolve()(*args, **kwargs)
+
+        deferred.trampoline = trampoline
+        if self.batch:
+            _PENDING.append(deferred)
+        return trampoline
+
+    def apply(self, fn, env: tp.Optional[SymbolTable] = None):
+        '''
+        Rewrites `fn` in `env` (defaults to `self.env`) and returns the
+        rewritten definition
+        '''
+        if env is None:
+            env = self.env
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(fn)
+            entry = None if key is None else self.cache.load(key)
+            if entry is not None:
+                return self.exec_entry(entry, env)
+
+        metadata = self.initial_metadata(fn)
+        with measure('parse', metadata) as m:
+            tree = self.parse(fn)
+            m.done(tree)
         self.i_tree = tree
+        tree, env, metadata = self.run_passes(tree, env, metadata)
+        return self.finalize(tree, env, metadata, key)
 
+    def initial_metadata(self, fn) -> tp.MutableMapping:
         metadata = {}
         if self.debug:
             metadata["source_filename"] = inspect.getsourcefile(fn)
             metadata["source_lines"] = inspect.getsourcelines(fn)
-
-        tree, env, metadata = self.prologue(tree, self.env,
-                                            metadata)
+        if self.instrumenting():
+            metadata[PASS_STATS] = []
+        return metadata
+
+    def run_passes(self, tree, env, metadata):
+        '''
+        Runs `prologue`, `do_passes`, and `epilogue`
+        '''
+        with measure('prologue', metadata, tree) as m:
+            tree, env, metadata = self.prologue(tree, env, metadata)
+            m.done(tree)
         tree, env, metadata = self.do_passes(tree, env, metadata)
-        tree, env, metadata = self.epilogue(tree, env, metadata)
+        with measure('epilogue', metadata, tree) as m:
+            tree, env, metadata = self.epilogue(tree, env, metadata)
+            m.done(tree)
+        return tree, env, metadata
 
+    def finalize(self, tree, env, metadata, key: tp.Optional[str] = None):
+        '''
+        Strips the decorators from the rewritten `tree` then execs it.
+        If `key` is not None the result is stored in the cache.
+        '''
         self.f_tree = tree
         self.metadata = metadata
 
-        etree = self.strip_decorators(tree, env, type(self), None)
-        stree = self.strip_decorators(tree, env, type(self), type(self))
-        fn = self.exec(etree, stree, env, metadata)
+        with measure('strip', metadata, tree) as m:
+            etree = self.strip_decorators(tree, env, type(self), None)
+            stree = self.strip_decorators(tree, env, type(self), type(self))
+            m.done(etree)
+        with measure('exec', metadata, etree):
+            if key is None:
+                fn = self.exec(etree, stree, env, metadata)
+            else:
+                name, code, serialized_source = self.compile(etree, stree, env, metadata)
+                self.cache.store(key, CacheEntry(name, code, serialized_source, metadata))
+                fn = self.exec_code(code, env, metadata)[name]
+
+        if PASS_STATS in metadata:
+            record_stats(metadata[PASS_STATS])
 
         if self.metadata_attr is not None:
             setattr(fn, self.metadata_attr, metadata)
 
         return fn
 
+    def exec_entry(self, entry: CacheEntry, env: tp.Optional[SymbolTable] = None):
+        '''
+        Execs a previously rewritten definition
+        '''
+        if env is None:
+            env = self.env
+        self.metadata = metadata = entry.metadata
+        # restore the source backing the code object so tracebacks and
+        # inspect.getsource keep working
+        restore_source(entry.code.co_filename, entry.serialized_source, missing_only=True)
+        fn = self.exec_code(entry.code, env, metadata)[entry.name]
+        if self.metadata_attr is not None:
+            setattr(fn, self.metadata_attr, metadata)
+        return fn
+
+
+class _Deferred:
+    '''
+    A rewrite of `fn` by `decorator` which has not yet been performed
+    '''
+    decorator: _apply_passes
+    fn: types.FunctionType
+    env: SymbolTable
+    trampoline: tp.Optional[types.FunctionType]
+    impl: tp.Optional[tp.Callable]
+
+    def __init__(self, decorator: _apply_passes, fn: types.FunctionType, env: SymbolTable):
+        self.decorator = decorator
+        self.fn = fn
+        self.env = env
+        self.trampoline = None
+        self.impl = None
+
+    def resolve(self, impl: tp.Optional[tp.Callable] = None) -> tp.Callable:
+        '''
+        Returns the rewritten function, performing the rewrite if `impl` is not
+        provided and it has not yet been performed
+        '''
+        if self.impl is not None:
+            return self.impl
+        if impl is None:
+            impl = self.decorator.apply(self.fn, self.env)
+
+        self.impl = impl
+        fn = self.fn
+        trampoline = self.trampoline
+        metadata_attr = self.decorator.metadata_attr
+        if trampoline is not None:
+            trampoline.__wrapped__ = impl
+            if metadata_attr is not None:
+                setattr(trampoline, metadata_attr, getattr(impl, metadata_attr))
+            if fn.__globals__.get(fn.__name__) is trampoline:
+                fn.__globals__[fn.__name__] = impl
+        return impl
+
+
+# rewrites registered with apply_passes(..., batch=True)
+_PENDING: tp.MutableSequence[_Deferred] = []
+
+
 class apply_ast_passes(_apply_passes):
     parse = staticmethod(get_ast)
     strip_decorators = staticmethod(_ASTStripper.strip)
 
-    def exec(self, etree: ast.AST, stree: ast.AST, env: SymbolTable,
-             metadata: tp.MutableMapping):
+    @staticmethod
+    def parse_source(source: str) -> ast.AST:
+        return ast.parse(textwrap.dedent(source)).body[0]
+
+    def compile(self, etree: ast.AST, stree: ast.AST, env: SymbolTable,
+             metadata: tp.MutableMapping) -> tp.Tuple[str, types.CodeType, str]:
         etree = ast.fix_missing_locations(etree)
         stree = ast.fix_missing_locations(stree)
-        return exec_def_in_file(etree, env, self.path, self.file_name, stree)
+        return compile_def_in_file(etree, self.path, self.file_name, stree, self.in_memory)
 
 
 class apply_cst_passes(_apply_passes):
     parse = staticmethod(get_cst)
     strip_decorators = staticmethod(_CSTStripper.strip)
 
-    def exec(self,
+    @staticmethod
+    def parse_source(source: str) -> cst.CSTNode:
+        return cst.parse_statement(textwrap.dedent(source))
+
+    def compile(self,
             etree: tp.Union[cst.ClassDef, cst.FunctionDef],
             stree: tp.Union[cst.ClassDef, cst.FunctionDef],
             env: SymbolTable,
-            metadata: tp.MutableMapping):
-        return exec_def_in_file(etree, env, self.path, self.file_name, stree)
+            metadata: tp.MutableMapping) -> tp.Tuple[str, types.CodeType, str]:
+        return compile_def_in_file(etree, self.path, self.file_name, stree, self.in_memory)
 
 
 apply_passes = apply_cst_passes
@@ -2,8 +2,10 @@
 Functions and classes the inspect or modify the stack
 '''
 
+import bisect
 import copy
 import inspect
+import sys
 import typing as tp
 import types
 import functools
@@ -18,16 +20,155 @@ _SKIP_FRAME_DEBUG_VALUE = 0xdeadbeaf
 _SKIP_FRAME_DEBUG_STMT = f'{_SKIP_FRAME_DEBUG_NAME} = {_SKIP_FRAME_DEBUG_VALUE}'
 _SKIP_FRAME_DEBUG_FAIL = False
 
+class LazyGlobals(tp.MutableMapping[str, tp.Any]):
+    '''
+    The union of several globals dicts (earlier dicts shadow later ones)
+    which is resolved on demand instead of being copied up front.
+
+    Names are cached the first time they are found.  Writes and deletes only
+    affect this mapping, never the underlying dicts, and increment `version`.
+    Use `flatten` to build an equivalent dict.
+    '''
+    maps: tp.Sequence[tp.Mapping[str, tp.Any]]
+
+    def __init__(self, maps: tp.Iterable[tp.Mapping[str, tp.Any]]):
+        # frames of the same module share a globals dict
+        unique = {}
+        for m in maps:
+            unique.setdefault(id(m), m)
+        self.maps = tuple(unique.values())
+        self.version = 0
+        self._cache = {}
+        self._deleted = set()
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        if key not in self._deleted:
+            for m in self.maps:
+                try:
+                    value = m[key]
+                except KeyError:
+                    continue
+                self._cache[key] = value
+                return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key, value):
+        self._deleted.discard(key)
+        self._cache[key] = value
+        self.version += 1
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._cache.pop(key, None)
+        self._deleted.add(key)
+        self.version += 1
+
+    def __iter__(self):
+        yield from self.keys()
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self) -> tp.AbstractSet[str]:
+        keys = set().union(*self.maps, self._cache)
+        keys -= self._deleted
+        return keys
+
+    def flatten(self) -> tp.Dict[str, tp.Any]:
+        d = {}
+        for m in reversed(self.maps):
+            d.update(m)
+        d.update(self._cache)
+        for key in self._deleted:
+            d.pop(key, None)
+        return d
+
+
+class TrackedMap(tp.MutableMapping[str, tp.Any]):
+    '''
+    Wraps a mapping and counts the writes and deletes made through it in
+    `version`.  Reads go straight to the wrapped mapping.
+    '''
+    map: tp.MutableMapping[str, tp.Any]
+
+    def __init__(self, map: tp.MutableMapping[str, tp.Any]):
+        self.map = map
+        self.version = 0
+
+    def __getitem__(self, key):
+        return self.map[key]
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def __setitem__(self, key, value):
+        self.map[key] = value
+        self.version += 1
+
+    def __delitem__(self, key):
+        del self.map[key]
+        self.version += 1
+
+    def __iter__(self):
+        return iter(self.map)
+
+    def __len__(self):
+        return len(self.map)
+
+    def keys(self) -> tp.AbstractSet[str]:
+        return self.map.keys()
+
+
 class SymbolTable(tp.Mapping[str, tp.Any]):
+    '''
+    Names visible to a definition, locals shadow globals.
+
+    Supports prefix queries, which use a sorted index of the names built the
+    first time it is needed.  The index is a snapshot: it is rebuilt after a
+    write or delete through `locals` or `globals` (or a call to
+    `invalidate`) but not when the underlying dicts (e.g. the globals of a
+    module which is still executing) change behind its back.  Lookups always
+    read through to the underlying maps.
+    '''
     locals: tp.MutableMapping[str, tp.Any]
-    globals: tp.Dict[str, tp.Any]
+    globals: tp.MutableMapping[str, tp.Any]
 
     def __init__(self,
             locals: tp.MutableMapping[str, tp.Any],
-            globals: tp.Dict[str, tp.Any]):
+            globals: tp.MutableMapping[str, tp.Any]):
         self.locals = locals
         self.globals = globals
 
+    @property
+    def locals(self) -> tp.MutableMapping[str, tp.Any]:
+        return self._locals
+
+    @locals.setter
+    def locals(self, locals: tp.MutableMapping[str, tp.Any]):
+        self._locals = _tracked(locals)
+        self.invalidate()
+
+    @property
+    def globals(self) -> tp.MutableMapping[str, tp.Any]:
+        return self._globals
+
+    @globals.setter
+    def globals(self, globals: tp.MutableMapping[str, tp.Any]):
+        self._globals = _tracked(globals)
+        self.invalidate()
+
     def __getitem__(self, key):
         try:
             return self.locals[key]
@@ -35,21 +176,108 @@ class SymbolTable(tp.Mapping[str, tp.Any]):
             pass
         return self.globals[key]
 
+    def __contains__(self, key):
+        return key in self.locals or key in self.globals
+
     def __iter__(self):
-        # the implementation of chain map does things this way
-        yield from set().union(self.locals, self.globals)
+        yield from self.keys()
 
     def __len__(self):
-        return len(set().union(self.locals, self.globals))
+        return len(self.keys())
+
+    def invalidate(self) -> None:
+        '''
+        Discards the index so changes to the underlying dicts are seen
+        '''
+        self._index = None
+
+    def _build_index(self) -> tp.Tuple[tp.FrozenSet[str], tp.List[str]]:
+        keys = frozenset().union(self.locals.keys(), self.globals.keys())
+        return keys, sorted(keys)
+
+    def _get_index(self) -> tp.Tuple[tp.FrozenSet[str], tp.List[str]]:
+        version = self.locals.version, self.globals.version
+        if self._index is None or self._index_version != version:
+            self._index = self._build_index()
+            self._index_version = version
+        return self._index
+
+    def keys(self) -> tp.AbstractSet[str]:
+        return self._get_index()[0]
+
+    def has_prefix(self, prefix: str) -> bool:
+        '''
+        Returns whether any name starts with prefix
+        '''
+        names = self._get_index()[1]
+        i = bisect.bisect_left(names, prefix)
+        return i < len(names) and names[i].startswith(prefix)
+
+    def with_prefix(self, prefix: str) -> tp.Sequence[str]:
+        '''
+        Returns the names which start with prefix in sorted order
+        '''
+        names = self._get_index()[1]
+        i = j = bisect.bisect_left(names, prefix)
+        while j < len(names) and names[j].startswith(prefix):
+            j += 1
+        return names[i:j]
+
+    def restrict(self, names: tp.Iterable[str]) -> 'SymbolTable':
+        '''
+        Returns a symbol table containing only `names` (names which are not
+        in the symbol table are ignored)
+        '''
+        locals = {}
+        globals = {}
+        for name in names:
+            try:
+                locals[name] = self.locals[name]
+                continue
+            except KeyError:
+                pass
+            try:
+                globals[name] = self.globals[name]
+            except KeyError:
+                pass
+        return SymbolTable(locals=locals, globals=globals)
+
+    def flatten(self) -> tp.Dict[str, tp.Any]:
+        '''
+        Returns a dict with the same contents as the symbol table
+        '''
+        if isinstance(self.globals, LazyGlobals):
+            d = self.globals.flatten()
+        else:
+            d = dict(self.globals)
+        d.update(self.locals)
+        return d
+
+
+def _tracked(m: tp.MutableMapping[str, tp.Any]) -> tp.MutableMapping[str, tp.Any]:
+    if isinstance(m, (LazyGlobals, TrackedMap)):
+        return m
+    return TrackedMap(m)
 
 
 def get_symbol_table(
         decorators: tp.Optional[tp.Sequence[inspect.FrameInfo]] = None,
-        copy_locals: bool = False
+        copy_locals: bool = False,
+        max_depth: tp.Optional[int] = None,
+        stop_at_module: bool = False,
         ) -> SymbolTable:
+    """
+    Builds a symbol table from the frames on the stack, inner frames shadow
+    outer frames.  Frames executing the code of `decorators` are skipped.
+
+    max_depth limits the number of frames (not counting skipped frames)
+    included starting from the caller.  If stop_at_module frames outside
+    the first module level frame (e.g. the frames of the import machinery
+    and whatever triggered the import) are not included.
+    """
     exec(_SKIP_FRAME_DEBUG_STMT)
     locals = ChainMap()
-    globals = ChainMap()
+    globals = []
 
     if decorators is None:
         decorators = set()
@@ -57,24 +285,82 @@ def get_symbol_table(
         decorators = {f.__code__ for f in decorators}
     decorators.add(get_symbol_table.__code__)
 
+    # walk the frames directly, inspect.stack() is much slower as it
+    # reads the source of every frame
+    frames = []
+    frame = sys._getframe(1)
+    while frame is not None and (max_depth is None or len(frames) < max_depth):
+        code = frame.f_code
+        if code not in decorators:
+            frames.append(frame)
+            if stop_at_module and code.co_name == '<module>':
+                break
+        frame = frame.f_back
 
-    stack = inspect.stack()
-    for i in range(len(stack) - 1, 0, -1):
-        frame = stack[i]
-        if frame.frame.f_code in decorators:
-            continue
-        debug_check = frame.frame.f_locals.get(_SKIP_FRAME_DEBUG_NAME, None)
+    for frame in reversed(frames):
+        f_locals = frame.f_locals
+        debug_check = f_locals.get(_SKIP_FRAME_DEBUG_NAME, None)
         if debug_check == _SKIP_FRAME_DEBUG_VALUE:
+            code = frame.f_code
+            msg = f'{code.co_name} @ {code.co_filename}:{frame.f_lineno} might be leaking names'
             if _SKIP_FRAME_DEBUG_FAIL:
-                raise RuntimeError(f'{frame.function} @ {frame.filename}:{frame.lineno} might be leaking names')
+                raise RuntimeError(msg)
             else:
-                logging.debug(f'{frame.function} @ {frame.filename}:{frame.lineno} might be leaking names')
-        f_locals = stack[i].frame.f_locals
+                logging.debug(msg)
         if copy_locals:
             f_locals = copy.copy(f_locals)
         locals = locals.new_child(f_locals)
-        globals = globals.new_child(stack[i].frame.f_globals)
-    return SymbolTable(locals=locals, globals=dict(globals))
+        globals.append(frame.f_globals)
+    # inner frames shadow outer frames
+    globals.reverse()
+    return SymbolTable(locals=locals, globals=LazyGlobals(globals))
+
+def get_function_symbol_table(
+        fn: types.FunctionType,
+        decorators: tp.Optional[tp.Sequence[tp.Callable]] = None,
+        ) -> SymbolTable:
+    """
+    Builds a symbol table for fn from the function itself instead of the
+    whole stack: its closure, the locals of the frame defining it (for the
+    names used by its decorators) and its globals.
+
+    Must be called while fn is being defined (e.g. from a decorator).  The
+    defining frame is the nearest frame whose code contains fn's code.  If
+    there is no such frame the symbol table falls back to the stack
+    (see `get_symbol_table`), the frames executing `decorators` are skipped.
+
+    The fallback is all or nothing: when the defining frame is found names
+    which cannot be resolved from it (e.g. globals fn expects to find in the
+    locals of its caller) are not looked up on the stack.
+    """
+    code = fn.__code__
+    closure = {}
+    for name, cell in zip(code.co_freevars, fn.__closure__ or ()):
+        try:
+            closure[name] = cell.cell_contents
+        except ValueError:
+            # empty cell
+            pass
+    locals = ChainMap(closure)
+    globals = [fn.__globals__]
+
+    frame = sys._getframe(1)
+    while frame is not None:
+        if any(c is code for c in frame.f_code.co_consts):
+            break
+        frame = frame.f_back
+
+    if frame is None:
+        st = get_symbol_table([get_function_symbol_table, *(decorators or ())])
+        locals.maps.extend(st.locals.map.maps)
+        globals.extend(st.globals.maps)
+    elif frame.f_locals is not frame.f_globals:
+        # copy so the frame is not kept alive by the symbol table
+        locals.maps.append(dict(frame.f_locals))
+    del frame
+
+    return SymbolTable(locals=locals, globals=LazyGlobals(globals))
+
 
 def inspect_symbol_table(
         fn: tp.Callable, # tp.Callable[[SymbolTable, ...], tp.Any],
@@ -111,8 +397,7 @@ def inspect_enclosing_env(
         if st is not None:
             _st.locals.update(st)
 
-        env = dict(_st.globals)
-        env.update(_st.locals)
+        env = _st.flatten()
         return fn(env, *args, **kwargs)
 
     return wrapped_0
@@ -0,0 +1,74 @@
+import typing as tp
+
+import libcst as cst
+from libcst import CSTNode, CSTNodeT, RemovalSentinel, FlattenSentinel
+
+
+class FusedTransformer(cst.CSTTransformer):
+    '''
+    Runs a sequence of node-local transformers in a single traversal.
+
+    A transformer is node-local if it:
+        - does not control recursion (never returns False from visit_*)
+        - does not depend on metadata
+        - only rewrites the node it is leaving (the result of its leave_*
+          does not need to be visited by later transformers)
+
+    On leaving a node each transformer is invoked in order on the result of the
+    previous transformer, the i-th transformer receives the result of the
+    (i-1)-th as its original node just as it would had the transformers been
+    run one after the other.  If a transformer returns a sentinel the
+    remaining transformers are not invoked on that node.
+    '''
+    transformers: tp.Sequence[cst.CSTTransformer]
+
+    def __init__(self, transformers: tp.Sequence[cst.CSTTransformer]):
+        super().__init__()
+        for t in transformers:
+            if t.get_inherited_dependencies():
+                raise TypeError(f'Cannot fuse {type(t).__name__} as it depends on metadata')
+        self.transformers = tuple(transformers)
+
+    def on_visit(self, node: CSTNode) -> bool:
+        for t in self.transformers:
+            if not t.on_visit(node):
+                raise TypeError(f'Cannot fuse {type(t).__name__} as it controls recursion')
+        return True
+
+    def on_visit_attribute(self, node: CSTNode, attribute: str) -> None:
+        for t in self.transformers:
+            t.on_visit_attribute(node, attribute)
+
+    def on_leave_attribute(self, original_node: CSTNode, attribute: str) -> None:
+        for t in reversed(self.transformers):
+            t.on_leave_attribute(original_node, attribute)
+
+    def on_leave(self,
+            original_node: CSTNodeT,
+            updated_node: CSTNodeT,
+            ) -> tp.Union[CSTNodeT, RemovalSentinel, FlattenSentinel[CSTNodeT]]:
+        transformers = iter(self.transformers)
+        for t in transformers:
+            final_node = t.on_leave(original_node, updated_node)
+            if isinstance(final_node, (RemovalSentinel, FlattenSentinel)):
+                break
+            if final_node is not updated_node:
+                original_node = final_node
+            updated_node = final_node
+        else:
+            return updated_node
+
+        # Remaining transformers still need to leave the node to keep their
+        # state consistent but their results are discarded
+        for t in transformers:
+            t.on_leave(original_node, updated_node)
+        return final_node
+
+
+def fuse(transformers: tp.Sequence[cst.CSTTransformer]) -> cst.CSTTransformer:
+    '''
+    Returns a transformer equivalent to running `transformers` in order
+    '''
+    if len(transformers) == 1:
+        return transformers[0]
+    return FusedTransformer(transformers)
@@ -1,3 +1,4 @@
+from array import array
 import functools as ft
 import typing as tp
 import types
@@ -8,15 +9,181 @@ import libcst.matchers as m
 from libcst import CSTNode, CSTNodeT, RemovalSentinel, FlattenSentinel
 
 
-from ast_tools.utils import BiMap
+__ALL__ = ['ProvenanceTable', 'NodeTrackingTransformer',
+           'NodeTrackingMatcherTransformer', 'with_tracking']
+
+
+class _ProvenanceStore:
+    # Nodes are numbered in the order they are first seen and edges are
+    # stored in arrays, the edges of a node form a linked list in both
+    # directions (head[node] is its last edge, next[edge] the edge before).
+    __slots__ = ('nodes', 'ids', 'src', 'dst', 'f_head', 'r_head',
+                 'f_next', 'r_next', 'edges', 'f_count', 'r_count')
+
+    def __init__(self):
+        # holds a reference to every node so that ids are not reused
+        self.nodes = []
+        self.ids = {}
+        self.src = array('l')
+        self.dst = array('l')
+        self.f_head = array('l')
+        self.r_head = array('l')
+        self.f_next = array('l')
+        self.r_next = array('l')
+        self.edges = set()
+        # number of nodes with outgoing / incoming edges
+        self.f_count = 0
+        self.r_count = 0
+
+    def get_id(self, node) -> int:
+        return self.ids.get(id(node), -1)
+
+    def make_id(self, node) -> int:
+        key = id(node)
+        try:
+            return self.ids[key]
+        except KeyError:
+            pass
+        n = self.ids[key] = len(self.nodes)
+        self.nodes.append(node)
+        self.f_head.append(-1)
+        self.r_head.append(-1)
+        return n
+
+    def add(self, s: int, d: int) -> None:
+        key = (s, d)
+        if key in self.edges:
+            return
+        self.edges.add(key)
+        e = len(self.src)
+        self.src.append(s)
+        self.dst.append(d)
+        if self.f_head[s] < 0:
+            self.f_count += 1
+        if self.r_head[d] < 0:
+            self.r_count += 1
+        self.f_next.append(self.f_head[s])
+        self.r_next.append(self.r_head[d])
+        self.f_head[s] = e
+        self.r_head[d] = e
+
+    def successors(self, n: int, reverse: bool) -> tp.Iterator[int]:
+        if reverse:
+            e, nxt, ends = self.r_head[n], self.r_next, self.src
+        else:
+            e, nxt, ends = self.f_head[n], self.f_next, self.dst
+        while e >= 0:
+            yield ends[e]
+            e = nxt[e]
+
+
+class ProvenanceTable(tp.Mapping[CSTNode, tp.AbstractSet[CSTNode]]):
+    '''
+    Maps origin nodes to the nodes they were transformed into, `i` is the
+    inverse mapping (updated nodes to their origins).  Supports the same
+    interface as `BiMap` but nodes are keyed by identity and given integer
+    ids, edges are stored in arrays.
+    '''
+
+    def __init__(self,
+            table: tp.Optional[tp.Mapping[CSTNode, tp.Iterable[CSTNode]]] = None,
+            ) -> None:
+        self._store = _ProvenanceStore()
+        self._reverse = False
+        if table is not None:
+            for k, v in table.items():
+                for vv in v:
+                    self[k] = vv
+
+    @property
+    def i(self) -> 'ProvenanceTable':
+        i = ProvenanceTable.__new__(ProvenanceTable)
+        i._store = self._store
+        i._reverse = not self._reverse
+        return i
+
+    def _head(self) -> array:
+        return self._store.r_head if self._reverse else self._store.f_head
+
+    def __contains__(self, node) -> bool:
+        n = self._store.get_id(node)
+        return n >= 0 and self._head()[n] >= 0
+
+    def __getitem__(self, node: CSTNode) -> tp.AbstractSet[CSTNode]:
+        store = self._store
+        n = store.get_id(node)
+        if n < 0 or self._head()[n] < 0:
+            raise KeyError(node)
+        nodes = store.nodes
+        return frozenset(nodes[k] for k in store.successors(n, self._reverse))
+
+    def __setitem__(self, node: CSTNode, val: CSTNode) -> None:
+        store = self._store
+        s = store.make_id(node)
+        d = store.make_id(val)
+        if self._reverse:
+            s, d = d, s
+        store.add(s, d)
+
+    def __iter__(self) -> tp.Iterator[CSTNode]:
+        store = self._store
+        nodes = store.nodes
+        for n, e in enumerate(self._head()):
+            if e >= 0:
+                yield nodes[n]
+
+    def __len__(self) -> int:
+        return self._store.r_count if self._reverse else self._store.f_count
+
+    def edges(self) -> tp.Iterator[tp.Tuple[CSTNode, CSTNode]]:
+        '''
+        Returns the (key, value) pairs in the order they were added
+        '''
+        store = self._store
+        nodes = store.nodes
+        src, dst = store.src, store.dst
+        if self._reverse:
+            src, dst = dst, src
+        for s, d in zip(src, dst):
+            yield nodes[s], nodes[d]
+
+    def compose(self,
+            prev_table: tp.Mapping[CSTNode, tp.Iterable[CSTNode]],
+            ) -> 'ProvenanceTable':
+        '''
+        Returns the table from the origins of prev_table to the nodes in this
+        table, nodes of prev_table which are not origins in this table are
+        kept as they are.  Linear in the size of the tables.
+        '''
+        if isinstance(prev_table, ProvenanceTable):
+            prev_edges = prev_table.edges()
+        else:
+            prev_edges = ((k, v) for k, vs in prev_table.items() for v in vs)
+
+        store = self._store
+        nodes = store.nodes
+        head = self._head()
+        new_table = ProvenanceTable()
+        for origin, mid in prev_edges:
+            n = store.get_id(mid)
+            if n >= 0 and head[n] >= 0:
+                for k in store.successors(n, self._reverse):
+                    new_table[origin] = nodes[k]
+            else:
+                new_table[origin] = mid
+        return new_table
+
+    def __repr__(self) -> str:
+        kv = map(': '.join, (map(repr, items) for items in self.items()))
+        return f'{type(self).__name__}(' + ', '.join(kv) + ')'
+
 
 class _NodeTrackerMixin:
-    node_tracking_table: BiMap[CSTNode, CSTNode]
+    node_tracking_table: ProvenanceTable
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self.node_tracking_table = BiMap()
-        self.new = set()
+        self.node_tracking_table = ProvenanceTable()
 
     def on_leave(self,
             original_node: CSTNodeT,
@@ -27,35 +194,52 @@ class _NodeTrackerMixin:
         return final_node
 
 
-    def _track(self,
-            original_node: CSTNode,
-            updated_node: cst.CSTNode) -> None:
-        if original_node in self.node_tracking_table.i:
+    def _track(self, o_id: int, u_id: int) -> None:
+        # unchanged nodes are their own origin, never follow those edges
+        # as it would recurse forever
+        store = self.node_tracking_table._store
+        if store.r_head[o_id] >= 0:
             # original_node has a origin, track back
-            for o_node in self.node_tracking_table.i[original_node]:
-                self._track(o_node, updated_node)
-            return
-
-        if updated_node in self.node_tracking_table:
+            unchanged = False
+            for oo_id in list(store.successors(o_id, True)):
+                if oo_id == o_id:
+                    unchanged = True
+                else:
+                    self._track(oo_id, u_id)
+            if not unchanged:
+                return
+
+        if o_id != u_id and store.f_head[u_id] >= 0:
             # updated_node is an origin, skip it
-            for u_node in self.node_tracking_table[updated_node]:
-                self._track(original_node, u_node)
+            for uu_id in list(store.successors(u_id, False)):
+                if uu_id == u_id:
+                    store.add(o_id, u_id)
+                else:
+                    self._track(o_id, uu_id)
             return
-        assert updated_node not in self.node_tracking_table, (original_node, updated_node)
-        assert original_node not in self.node_tracking_table.i, (original_node, updated_node)
-        self.node_tracking_table[original_node] = updated_node
+        store.add(o_id, u_id)
 
     def _track_with_children(self,
             original_nodes: tp.Iterable[CSTNode],
             updated_nodes: tp.Iterable[CSTNode]) -> None:
-
-        for o_node in original_nodes:
-            for u_node in updated_nodes:
-                if u_node not in self.node_tracking_table.i or u_node in self.new:
-                    # u_node has not been explained or has multiple origins
-                    self.new.add(u_node)
-                    self._track(o_node, u_node)
-                    self._track_with_children(original_nodes, u_node.children)
+        store = self.node_tracking_table._store
+        o_ids = [store.make_id(o_node) for o_node in original_nodes]
+        new = set()
+        stack = list(updated_nodes)
+        stack.reverse()
+        while stack:
+            u_node = stack.pop()
+            u_id = store.get_id(u_node)
+            if u_id < 0:
+                u_id = store.make_id(u_node)
+            elif u_id in new or store.r_head[u_id] >= 0:
+                # u_node has already been explained
+                continue
+            new.add(u_id)
+            for o_id in o_ids:
+                self._track(o_id, u_id)
+            children = u_node.children
+            stack.extend(reversed(children))
 
     def track(self,
             original_node: tp.Union[CSTNode, tp.Iterable[CSTNode]],
@@ -70,9 +254,10 @@ class _NodeTrackerMixin:
         if isinstance(original_node, CSTNode):
             original_node = original_node,
 
-        for o_node in original_nodes:
-            for u_node in updated_nodes:
-                self._track(o_node, u_node)
+        store = self.node_tracking_table._store
+        for o_node in original_node:
+            for u_node in updated_node:
+                self._track(store.make_id(o_node), store.make_id(u_node))
 
 
     def track_with_children(self,
@@ -89,22 +274,11 @@ class _NodeTrackerMixin:
             original_node = original_node,
 
         self._track_with_children(original_node, updated_node)
-        self.new = set()
-
-    def trace_origins(self, prev_table: BiMap[CSTNode, CSTNode]) -> BiMap[CSTNode, CSTNode]:
-        new_table = BiMap()
-        for update, origins in self.node_tracking_table.i.items():
-            for o in origins:
-                for oo in prev_table.i.get(o, []):
-                    new_table[oo] = update
-
-        for origin, updates in prev_table.items():
-            for u in updates:
-                for uu in self.node_tracking_table.get(u, [u]):
-                    new_table[origin] = uu
 
-
-        return new_table
+    def trace_origins(self,
+            prev_table: tp.Mapping[CSTNode, tp.Iterable[CSTNode]],
+            ) -> ProvenanceTable:
+        return self.node_tracking_table.compose(prev_table)
 
 
 class NodeTrackingTransformer(
@@ -1,6 +1,8 @@
+from collections import OrderedDict
 import functools as ft
 import typing as tp
 import sys
+import weakref
 
 # PEP 585
 if sys.version_info < (3, 9):
@@ -119,3 +121,76 @@ class _BiMapDebug(BiMap[T, S]):
     __len__ = _with_attestation(BiMap.__len__)
     __eq__ = _with_attestation(BiMap.__eq__)
     __ne__ = _with_attestation(BiMap.__ne__)
+
+
+class CacheInfo(tp.NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class _IdentityCacheEntry(tp.NamedTuple):
+    # a weakref to the key if it supports them, otherwise the key itself
+    ref: tp.Any
+    value: tp.Any
+
+
+def identity_cache(maxsize: int = 128) -> tp.Callable[[F], F]:
+    """
+    Like functools.lru_cache for functions of a single argument but keyed
+    on the identity of the argument instead of its hash.
+
+    Arguments which support weak references are not kept alive by the
+    cache.  Arguments which do not (e.g. libcst nodes) are kept alive until
+    they are evicted, so at most `maxsize` of them.
+
+    The wrapper has `cache_info` and `cache_clear` methods like those of
+    lru_cache.
+    """
+    def decorator(f: F) -> F:
+        cache: tp.MutableMapping[int, _IdentityCacheEntry] = OrderedDict()
+        hits = misses = 0
+
+        def evict(k: int, ref) -> None:
+            entry = cache.get(k)
+            if entry is not None and entry.ref is ref:
+                del cache[k]
+
+        @ft.wraps(f)
+        def wrapper(arg):
+            nonlocal hits, misses
+            k = id(arg)
+            entry = cache.get(k)
+            if entry is not None:
+                ref = entry.ref
+                if isinstance(ref, weakref.ref):
+                    ref = ref()
+                if ref is arg:
+                    hits += 1
+                    cache.move_to_end(k)
+                    return entry.value
+            misses += 1
+            value = f(arg)
+            try:
+                ref = weakref.ref(arg, lambda r, k=k: evict(k, r))
+            except TypeError:
+                ref = arg
+            cache[k] = _IdentityCacheEntry(ref, value)
+            cache.move_to_end(k)
+            while len(cache) > maxsize:
+                cache.popitem(last=False)
+            return value
+
+        def cache_info() -> CacheInfo:
+            return CacheInfo(hits, misses, maxsize, len(cache))
+
+        def cache_clear() -> None:
+            nonlocal hits, misses
+            cache.clear()
+            hits = misses = 0
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return tp.cast(F, wrapper)
+    return decorator
@@ -1,3 +1,4 @@
 from .collect_names import *
 from .collect_targets import *
 from .used_names import *
+from .bound_names import *
@@ -0,0 +1,92 @@
+"""
+Defines a scanner for the names bound in a tree
+"""
+import ast
+import typing as tp
+
+import libcst as cst
+
+from ast_tools.utils import identity_cache
+
+__ALL__ = ['bound_names']
+
+
+def _cst_target_names(target: cst.CSTNode, names: tp.MutableSet[str]) -> None:
+    # attributes and subscripts do not bind names
+    if isinstance(target, cst.Name):
+        names.add(target.value)
+    elif isinstance(target, (cst.Tuple, cst.List)):
+        for element in target.elements:
+            _cst_target_names(element.value, names)
+    elif isinstance(target, cst.StarredElement):
+        _cst_target_names(target.value, names)
+
+
+def _cst_bound_names(tree: cst.CSTNode) -> tp.AbstractSet[str]:
+    names = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (cst.AssignTarget, cst.AnnAssign, cst.AugAssign,
+                             cst.For, cst.CompFor, cst.NamedExpr)):
+            _cst_target_names(node.target, names)
+        elif isinstance(node, (cst.FunctionDef, cst.ClassDef, cst.Param)):
+            names.add(node.name.value)
+        elif isinstance(node, cst.AsName):
+            _cst_target_names(node.name, names)
+        elif isinstance(node, cst.ImportAlias):
+            if node.asname is None:
+                name = node.name
+                # import a.b binds a
+                while isinstance(name, cst.Attribute):
+                    name = name.value
+                names.add(name.value)
+        elif isinstance(node, (cst.Global, cst.Nonlocal)):
+            names.update(item.name.value for item in node.names)
+        stack.extend(node.children)
+    return names
+
+
+def _ast_bound_names(tree: ast.AST) -> tp.AbstractSet[str]:
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if not isinstance(node.ctx, ast.Load):
+                names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.alias):
+            names.add(node.asname or node.name.partition('.')[0])
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, ast.ExceptHandler):
+            if node.name is not None:
+                names.add(node.name)
+    return names
+
+
+@identity_cache(maxsize=256)
+def _cached_cst_bound_names(tree: cst.CSTNode) -> tp.AbstractSet[str]:
+    return frozenset(_cst_bound_names(tree))
+
+
+def bound_names(tree: tp.Union[cst.CSTNode, ast.AST]) -> tp.AbstractSet[str]:
+    """
+    Returns the names bound anywhere in tree (in any scope), works on both
+    CSTs and ASTs.
+
+    Much cheaper than `used_names` as it is a single walk without scope
+    analysis.  Use it when a superset of the names that could collide with
+    a new name is good enough.
+
+    Results for CSTs are cached (see `bound_names.cache_info`), ASTs are
+    mutable so their names are computed on every call.
+    """
+    if isinstance(tree, ast.AST):
+        return frozenset(_ast_bound_names(tree))
+    return _cached_cst_bound_names(tree)
+
+bound_names.cache_info = _cached_cst_bound_names.cache_info
+bound_names.cache_clear = _cached_cst_bound_names.cache_clear
@@ -1,10 +1,10 @@
-from functools import lru_cache
 import typing as tp
 
 import libcst as cst
 from libcst.metadata import ScopeProvider
 
 from ast_tools.cst_utils import to_module
+from ast_tools.utils import identity_cache
 
 class UsedNames(cst.CSTVisitor):
     METADATA_DEPENDENCIES = (ScopeProvider,)
@@ -25,10 +25,17 @@ class UsedNames(cst.CSTVisitor):
         if node in self.scope.assignments:
             self.names.add(node.value)
 
-@lru_cache()
-def used_names(tree: cst.CSTNode):
+@identity_cache(maxsize=128)
+def used_names(tree: cst.CSTNode) -> tp.AbstractSet[str]:
+    """
+    Returns the names assigned in the outermost scope of tree.
+
+    Results are cached by the identity of tree (see
+    `ast_tools.utils.identity_cache`), `used_names.cache_info()` reports
+    the hits and misses.
+    """
     tree = to_module(tree)
     visitor = UsedNames()
     wrapper = cst.MetadataWrapper(tree, unsafe_skip_copy=True)
     wrapper.visit(visitor)
-    return visitor.names
+    return frozenset(visitor.names)
@@ -0,0 +1,190 @@
+'''
+Measures how the cost of rewriting scales with the size of the input
+
+    python -m benchmarks.rewrite --vary statements --sizes 8,16,32,64
+
+For each size a synthetic function (see `benchmarks.synthetic`) is rewritten
+by the selected pipeline with instrumentation enabled and the wall time and
+peak memory of every stage is reported.  The growth of each stage is
+summarized by the slope of log(time) against log(size) (1 is linear, 2 is
+quadratic).  With `--max-exponent` the script exits with a non zero status if
+any stage grows faster than allowed or any rewrite fails.
+
+Times are measured with memory tracing disabled, peak memory is measured
+by a separate rewrite.
+'''
+import argparse
+import json
+import math
+import sys
+import typing as tp
+
+from ast_tools.common import to_source
+from ast_tools.passes import apply_ast_passes, apply_cst_passes
+from ast_tools.passes import bool_to_bit, dce, if_to_phi, loop_unroll, remove_asserts, ssa
+from ast_tools.passes.cse import cse
+from ast_tools.passes.stats import PASS_STATS, PassStats, measure, set_memory_tracing
+
+from .synthetic import SyntheticParams, gen_function, gen_env
+
+# name -> (decorator, passes)
+PIPELINES: tp.Mapping[str, tp.Tuple[type, tp.Callable[[], tp.Sequence]]] = {
+    'ssa': (apply_cst_passes, lambda: [loop_unroll(), ssa()]),
+    'ssa_untracked': (apply_cst_passes, lambda: [loop_unroll(), ssa(track=False)]),
+    'loop_unroll': (apply_cst_passes, lambda: [loop_unroll()]),
+    'default': (apply_cst_passes, lambda: [
+        loop_unroll(), ssa(), bool_to_bit(), if_to_phi(lambda c, t, f: t if c else f), remove_asserts(),
+        dce(),
+    ]),
+    'cse': (apply_ast_passes, lambda: [cse()]),
+}
+
+
+def _ssa_source(source: str) -> str:
+    decorator = apply_cst_passes([loop_unroll(), ssa(track=False)], env=gen_env())
+    tree, _, _ = decorator.run_passes(decorator.parse_source(source), decorator.env, {})
+    return to_source(tree)
+
+
+# name -> rewrite of the source before it is benchmarked, cse must be run on
+# a function in ssa form without control flow
+PREPARE: tp.Mapping[str, tp.Callable[[str], str]] = {
+    'cse': _ssa_source,
+}
+
+
+def rewrite_once(pipeline: str, source: str, memory: bool) -> tp.Sequence[PassStats]:
+    '''
+    Rewrites `source` with `pipeline` and returns the stats of each stage
+    '''
+    set_memory_tracing(memory)
+    decorator_t, passes = PIPELINES[pipeline]
+    env = gen_env()
+    decorator = decorator_t(passes(), env=env, in_memory=True, instrument=True)
+    metadata = decorator.initial_metadata(None)
+    with measure('parse', metadata) as m:
+        tree = decorator.parse_source(source)
+        m.done(tree)
+    tree, env, metadata = decorator.run_passes(tree, env, metadata)
+    decorator.finalize(tree, env, metadata)
+    return metadata[PASS_STATS]
+
+
+def run(pipeline: str,
+        param: str,
+        sizes: tp.Sequence[int],
+        base: SyntheticParams = SyntheticParams(),
+        repeat: int = 3,
+        ) -> tp.Mapping[str, tp.Mapping[int, tp.Optional[PassStats]]]:
+    '''
+    Returns stage -> size -> best stats (lowest times of `repeat` rewrites
+    and the peak memory of an additional rewrite) or None if the rewrite
+    failed at that size
+    '''
+    results = {}
+    for size in sizes:
+        source = gen_function(base.with_size(param, size))
+        best = {}
+        try:
+            if pipeline in PREPARE:
+                source = PREPARE[pipeline](source)
+            for s in rewrite_once(pipeline, source, memory=True):
+                best[s.name] = s._replace(wall=math.inf, cpu=math.inf)
+            for _ in range(repeat):
+                for s in rewrite_once(pipeline, source, memory=False):
+                    prev = best[s.name]
+                    best[s.name] = prev._replace(
+                        wall=min(s.wall, prev.wall),
+                        cpu=min(s.cpu, prev.cpu),
+                    )
+        except Exception as e:
+            print(f'{pipeline} failed on {param}={size}: {type(e).__name__}: {e}', file=sys.stderr)
+            best = {name: None for name in results}
+        finally:
+            set_memory_tracing(True)
+        for name, s in best.items():
+            results.setdefault(name, {})[size] = s
+    return results
+
+
+def growth(points: tp.Mapping[int, tp.Optional[PassStats]]) -> tp.Optional[float]:
+    '''
+    Least squares slope of log(wall) against log(size)
+    '''
+    xs, ys = [], []
+    for size, s in points.items():
+        if s is not None and size > 0 and s.wall > 0:
+            xs.append(math.log(size))
+            ys.append(math.log(s.wall))
+    if len(xs) < 2:
+        return None
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    var = sum((x - mx)**2 for x in xs)
+    if var == 0:
+        return None
+    return sum((x - mx)*(y - my) for x, y in zip(xs, ys)) / var
+
+
+def report(pipeline: str, param: str, sizes: tp.Sequence[int], results, file=sys.stdout) -> None:
+    print(f'pipeline={pipeline} vary={param}', file=file)
+    width = max(len('stage'), *(len(n) for n in results)) if results else len('stage')
+    header = ''.join(f'{size:>18}' for size in sizes)
+    print(f'{"stage":<{width}}{header}{"growth":>8}', file=file)
+    for name, points in results.items():
+        cells = []
+        for size in sizes:
+            s = points.get(size)
+            if s is None:
+                cells.append(f'{"-":>18}')
+            else:
+                cells.append(f'{s.wall * 1e3:>9.2f}ms{s.peak_mem / 1024:>6.0f}KiB')
+        g = growth(points)
+        g = '-' if g is None else f'{g:.2f}'
+        print(f'{name:<{width}}{"".join(cells)}{g:>8}', file=file)
+    print(file=file)
+
+
+def main(argv: tp.Optional[tp.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark rewrites on synthetic functions')
+    parser.add_argument('--pipeline', choices=sorted(PIPELINES), default='default')
+    parser.add_argument('--vary', choices=['all', *SyntheticParams._fields], default='all')
+    parser.add_argument('--sizes', default='4,8,16,32',
+            help='comma separated sizes of the varied parameter')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--max-exponent', type=float,
+            help='fail if any stage grows faster than size**max_exponent')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    params = SyntheticParams._fields if args.vary == 'all' else [args.vary]
+
+    status = 0
+    dump = {}
+    for param in params:
+        results = run(args.pipeline, param, sizes, repeat=args.repeat)
+        report(args.pipeline, param, sizes, results)
+        failed = not results or any(
+                points.get(size) is None for points in results.values() for size in sizes)
+        if args.max_exponent is not None and failed:
+            print(f'{args.pipeline} failed varying {param}', file=sys.stderr)
+            status = 1
+        for name, points in results.items():
+            g = growth(points)
+            dump.setdefault(param, {})[name] = {
+                'growth': g,
+                'sizes': {size: None if s is None else s._asdict() for size, s in points.items()},
+            }
+            if args.max_exponent is not None and g is not None and g > args.max_exponent:
+                print(f'{name} grows as {param}**{g:.2f} (max {args.max_exponent})', file=sys.stderr)
+                status = 1
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({'pipeline': args.pipeline, 'results': dump}, fp, indent=2)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
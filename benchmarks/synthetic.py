@@ -0,0 +1,81 @@
+'''
+Generator for synthetic functions used to benchmark rewrites
+'''
+import typing as tp
+
+import ast_tools
+from ast_tools.stack import SymbolTable
+
+__ALL__ = ['SyntheticParams', 'gen_function', 'gen_env']
+
+
+class SyntheticParams(tp.NamedTuple):
+    # number of straight line assignments
+    statements: int = 8
+    # depth of nested ifs (each with an else)
+    if_depth: int = 2
+    # number of return statements (all but the last are early returns)
+    returns: int = 2
+    # number of attribute writes
+    attr_writes: int = 2
+    # trip count of a loop to unroll (0 for no loop)
+    unroll: int = 4
+    # number of statements using the same subexpression
+    subexprs: int = 2
+
+    def with_size(self, param: str, size: int) -> 'SyntheticParams':
+        return self._replace(**{param: size})
+
+
+def gen_function(params: SyntheticParams = SyntheticParams(), name: str = 'synthetic') -> str:
+    '''
+    Generates the source of a function `name(a, b, c, obj)` shaped by `params`
+
+    The function is deterministic and only uses `ast_tools.macros.unroll`
+    from its environment (see `gen_env`).  `obj` should be an object whose
+    attributes can be written.
+    '''
+    if params.returns < 1:
+        raise ValueError('returns must be >= 1')
+
+    lines = [f'def {name}(a, b, c, obj):', '    x = a']
+
+    for i in range(params.statements):
+        op = '+-*'[i % 3]
+        lines.append(f'    x = x {op} b')
+
+    for i in range(params.attr_writes):
+        lines.append(f'    obj.f{i} = x + {i}')
+
+    if params.unroll:
+        lines.append(f'    for i in ast_tools.macros.unroll(range({params.unroll})):')
+        lines.append(f'        x = x + i')
+
+    indent = '    '
+    for depth in range(params.if_depth):
+        lines.append(f'{indent}if c > {depth}:')
+        lines.append(f'{indent}    x = x * 2')
+        lines.append(f'{indent}else:')
+        lines.append(f'{indent}    x = x - {depth}')
+        # nest in the else branch so every level is reachable
+        indent += '    '
+    # leave a statement at the innermost level so the last else is non empty
+    if params.if_depth:
+        lines.append(f'{indent}x = x + c')
+
+    for i in range(params.returns - 1):
+        lines.append(f'    if a == {i}:')
+        lines.append(f'        return x + {i}')
+
+    for i in range(params.subexprs):
+        lines.append(f'    x = (a + b) * (c - a) + x')
+
+    lines.append('    return x')
+    return '\n'.join(lines) + '\n'
+
+
+def gen_env() -> SymbolTable:
+    '''
+    Returns an environment in which generated functions can be rewritten
+    '''
+    return SymbolTable(locals={}, globals={'ast_tools': ast_tools})
@@ -1,8 +1,14 @@
 import inspect
 
-from ast_tools.passes import apply_passes, if_inline
+import pytest
+
+import libcst as cst
+
+from ast_tools.passes import apply_passes, if_inline, ssa, Pass, RewriteCache, MemoryRewriteCache
+from ast_tools.passes import rewrite_all
 from ast_tools.macros import inline
-from ast_tools.common import to_source
+from ast_tools.passes.util import _apply_passes, _CSTStripper
+from ast_tools.common import to_source, get_cst, exec_def_in_file
 
 
 def test_apply_with_prologue():
@@ -45,3 +51,375 @@ def bar():
             return 0
         else:
             return 1
+
+
+class _count_calls(Pass):
+    calls = 0
+
+    def rewrite(self, tree, env, metadata):
+        type(self).calls += 1
+        metadata['count'] = type(self).calls
+        return tree, env, metadata
+
+    def fingerprint(self):
+        return self.args_fingerprint()
+
+
+def test_rewrite_cache(tmp_path):
+    cache = RewriteCache(str(tmp_path / 'cache'))
+    x = 1
+
+    def make():
+        @apply_passes([_count_calls()], cache=cache, metadata_attr='md',
+                      path=str(tmp_path / 'src'))
+        def foo():
+            return x + 1
+        return foo
+
+    _count_calls.calls = 0
+    foo0 = make()
+    assert _count_calls.calls == 1
+    foo1 = make()
+    # second rewrite is served from the cache
+    assert _count_calls.calls == 1
+    assert foo0() == foo1() == 2
+    assert foo1.md == {'count': 1}
+    assert foo0.__code__.co_filename == foo1.__code__.co_filename
+    assert inspect.getsource(foo1) == inspect.getsource(foo0)
+
+    # passes which depend on env are not cached
+    @apply_passes([_count_calls(), if_inline()], cache=cache)
+    def bar():
+        return 0
+    @apply_passes([_count_calls(), if_inline()], cache=cache)
+    def bar():
+        return 0
+    assert _count_calls.calls == 3
+
+    cache.clear()
+    make()
+    assert _count_calls.calls == 4
+
+
+def test_fingerprint_opt_in():
+    class no_fingerprint(Pass):
+        def rewrite(self, tree, env, metadata):
+            return tree, env, metadata
+
+    assert no_fingerprint().fingerprint() is None
+    assert no_fingerprint().args_fingerprint() is None
+    assert _count_calls().fingerprint() is not None
+    assert ssa().fingerprint() != ssa(strict=False).fingerprint()
+    assert if_inline().fingerprint() is None
+
+    cache = MemoryRewriteCache()
+    for _ in range(2):
+        @apply_passes([no_fingerprint()], cache=cache)
+        def foo():
+            return 0
+    assert foo() == 0
+    assert len(cache) == 0 and cache.hits == 0
+
+
+def test_fingerprint_versions(monkeypatch):
+    import ast_tools
+    from ast_tools.passes import base
+    from ast_tools.passes.cache import rewrite_key
+
+    # the implementation of a pass is part of its fingerprint
+    assert base._module_digest('ast_tools.passes.ssa') in ssa().fingerprint()
+    monkeypatch.setattr(base, '_module_digest', lambda name: 'edited')
+    assert ssa().fingerprint().endswith('@edited')
+
+    key = rewrite_key('def f(): pass', 'fp')
+    monkeypatch.setattr(ast_tools, '__version__', '0.0.0')
+    assert rewrite_key('def f(): pass', 'fp') != key
+
+
+def test_cache_key_without_source(tmp_path, monkeypatch):
+    import os
+    import importlib.util
+    from ast_tools.passes import util
+
+    path = tmp_path / 'cache_key_mod.py'
+    path.write_text('def foo():\n    return 0\n')
+    spec = importlib.util.spec_from_file_location('cache_key_mod', path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+
+    def getsource(obj):
+        raise AssertionError('source read')
+    monkeypatch.setattr(util.inspect, 'getsource', getsource)
+
+    decorator = apply_passes([ssa()], cache=MemoryRewriteCache())
+    key = decorator.cache_key(mod.foo)
+    assert key is not None
+    assert decorator.cache_key(mod.foo) == key
+
+    # editing the file changes the key
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert decorator.cache_key(mod.foo) != key
+
+
+def test_exec_override():
+    class exec_passes(_apply_passes):
+        parse = staticmethod(get_cst)
+        strip_decorators = staticmethod(_CSTStripper.strip)
+        parse_source = staticmethod(apply_passes.parse_source)
+        execs = 0
+
+        def exec(self, etree, stree, env, metadata):
+            type(self).execs += 1
+            return exec_def_in_file(etree, env, self.path, self.file_name, stree)
+
+    cache = MemoryRewriteCache()
+    _count_calls.calls = 0
+    for _ in range(2):
+        @exec_passes([_count_calls()], cache=cache)
+        def foo():
+            return 1
+    assert foo() == 1
+    # the rewrite is never cached as a hit would bypass exec
+    assert exec_passes.execs == _count_calls.calls == 2
+    assert len(cache) == 0
+
+
+def test_memory_rewrite_cache():
+    cache = MemoryRewriteCache(maxsize=1)
+
+    def make(y):
+        @apply_passes([_count_calls()], cache=cache, metadata_attr='md')
+        def foo():
+            return y + 1
+        return foo
+
+    _count_calls.calls = 0
+    foos = [make(y) for y in range(3)]
+    assert _count_calls.calls == 1
+    assert cache.hits == 2 and cache.misses == 1
+    # each hit builds a new function in its own environment
+    assert [f() for f in foos] == [1, 2, 3]
+    assert all(f.md == {'count': 1} for f in foos)
+    assert foos[0].md is not foos[1].md
+
+    @apply_passes([_count_calls()], cache=cache)
+    def bar():
+        return 0
+
+    # foo was evicted
+    make(0)
+    assert _count_calls.calls == 3
+    assert len(cache) == 1
+
+
+def test_lazy():
+    _count_calls.calls = 0
+    x = 1
+
+    @apply_passes([_count_calls()], lazy=True, metadata_attr='md')
+    def foo(y):
+        return x + y
+
+    assert _count_calls.calls == 0
+    assert not hasattr(foo, 'md')
+    assert foo(1) == 2
+    assert _count_calls.calls == 1
+    assert foo(2) == 3
+    assert _count_calls.calls == 1
+    assert foo.md == {'count': 1}
+    assert inspect.getsource(foo) == '''\
+def foo(y):
+    return x + y
+'''
+
+
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_rewrite_all(max_workers):
+    x = True
+
+    @apply_passes([ssa()], batch=True, metadata_attr='md')
+    def foo(y):
+        if y:
+            z = 1
+        else:
+            z = 2
+        return z
+
+    @apply_passes([if_inline()], batch=True)
+    def bar():
+        if inline(x):
+            return 0
+        else:
+            return 1
+
+    rewrite_all(max_workers=max_workers)
+    assert 'SYMBOL-TABLE' in foo.md
+    assert foo(True) == 1
+    assert foo(False) == 2
+    assert bar() == 0
+    assert inspect.getsource(bar) == '''\
+def bar():
+    return 0
+'''
+    assert 'z_0' in inspect.getsource(foo)
+
+
+def test_instrument():
+    from ast_tools.passes import get_stats, reset_stats, report_stats
+    from ast_tools.passes.stats import PASS_STATS
+    import io
+
+    reset_stats()
+
+    @apply_passes([ssa(), if_inline()], instrument=True, metadata_attr='md')
+    def foo(x):
+        if x:
+            return 1
+        return 0
+
+    assert foo(True) == 1
+    stats = foo.md[PASS_STATS]
+    names = [s.name for s in stats]
+    assert names == ['parse', 'prologue', 'ssa', 'if_inline', 'epilogue', 'strip', 'exec']
+    for s in stats:
+        assert s.wall >= 0 and s.cpu >= 0 and s.peak_mem >= 0
+    assert stats[0].nodes_in is None and stats[0].nodes_out > 0
+    assert stats[2].nodes_in == stats[0].nodes_out
+    assert stats[-1].nodes_out is None
+
+    agg = get_stats()
+    assert agg['ssa'].calls == 1
+    assert agg['ssa'].nodes_out == stats[2].nodes_out
+
+    buf = io.StringIO()
+    report_stats(buf)
+    assert 'ssa' in buf.getvalue()
+
+    @apply_passes([if_inline()], metadata_attr='md')
+    def bar(x):
+        return x
+
+    assert PASS_STATS not in bar.md
+    assert get_stats()['if_inline'].calls == 1
+    reset_stats()
+
+
+def _outer_frame(f):
+    LEAKED = 1
+    return f()
+
+
+def test_env_from_function():
+    deco = apply_passes
+    y = 1
+
+    def make():
+        x = True
+
+        @deco([if_inline()], env_from='function', metadata_attr='md')
+        def foo():
+            if inline(x):
+                return y + 1
+            else:
+                return 0
+        return foo
+
+    foo = _outer_frame(make)
+    assert foo() == 2
+    assert inspect.getsource(foo) == '''\
+def foo():
+    return y + 1
+'''
+    env = apply_passes([], env_from='function').get_env(foo)
+    assert env['x'] and env['y'] == 1
+
+    def check(names):
+        @apply_passes([_check_env(names)], env_from='function')
+        def bar():
+            return x + y
+        return bar
+
+    x = 0
+    seen = []
+    _check_env.seen = seen
+    _outer_frame(lambda: check(['x', 'y', 'deco', 'LEAKED']))
+    # names used by neither bar nor its decorators are not captured
+    assert seen == [True, True, False, False]
+
+    with pytest.raises(ValueError):
+        apply_passes([], env_from='frames')
+
+
+class _check_env(Pass):
+    def __init__(self, names):
+        self.names = names
+
+    def rewrite(self, tree, env, metadata):
+        _check_env.seen.extend(name in env for name in self.names)
+        return tree, env, metadata
+
+
+def test_compact_env():
+    from ast_tools.passes import if_to_phi
+    unused = object()
+    y = 1
+
+    @apply_passes([if_to_phi(lambda c, t, f: t if c else f)], compact_env=True)
+    def foo(x):
+        return x + y if x else len([])
+
+    assert foo(1) == 2
+    assert foo(0) == 0
+    g = foo.__globals__
+    assert 'unused' not in g and 'pytest' not in g
+    assert g['y'] == 1
+    assert '__name__' in g and '__builtins__' in g
+    # the injected phi
+    assert any(name.startswith('__phi') for name in g)
+
+    cache = MemoryRewriteCache()
+    def make():
+        @apply_passes([_count_calls()], cache=cache, compact_env=True)
+        def bar():
+            return y
+        return bar
+
+    assert make()() == 1
+    bar = make()
+    assert cache.hits == 1
+    assert bar() == 1
+    assert 'unused' not in bar.__globals__
+
+
+def test_measure_without_reset_peak(monkeypatch):
+    # tracemalloc.reset_peak is python 3.9+
+    import tracemalloc
+    from ast_tools.passes.stats import PASS_STATS, measure
+    monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    metadata = {PASS_STATS: []}
+    with measure('outer', metadata) as outer:
+        with measure('inner', metadata) as inner:
+            data = [object() for _ in range(1000)]
+            inner.done(None)
+        outer.done(None)
+    inner_stats, outer_stats = metadata[PASS_STATS]
+    assert inner_stats.name == 'inner'
+    assert 0 < inner_stats.peak_mem <= outer_stats.peak_mem
+
+
+def test_measure_nested_peak():
+    from ast_tools.passes.stats import PASS_STATS, measure
+    metadata = {PASS_STATS: []}
+    tree = cst.parse_statement('x = 1')
+    with measure('outer', metadata) as outer:
+        data = [object() for _ in range(10000)]
+        del data
+        # resetting the peak for inner must not lose the peak of outer
+        with measure('inner', metadata) as inner:
+            inner.done(tree)
+        outer.done(None)
+    inner_stats, outer_stats = metadata[PASS_STATS]
+    assert inner_stats.peak_mem < outer_stats.peak_mem
+    assert outer_stats.peak_mem > 10000 * 16
+    assert inner_stats.nodes_out > 0 and outer_stats.nodes_out is None
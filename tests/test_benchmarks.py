@@ -0,0 +1,59 @@
+import itertools
+
+import pytest
+
+from benchmarks.synthetic import SyntheticParams, gen_function, gen_env
+from benchmarks.rewrite import PIPELINES, PREPARE, run, growth, main
+
+
+class _Obj:
+    # ssa reads written attributes before the first write
+    def __init__(self):
+        for i in range(3):
+            setattr(self, f'f{i}', None)
+
+
+@pytest.mark.parametrize('pipeline', ['default', 'cse'])
+@pytest.mark.parametrize('param', SyntheticParams._fields)
+def test_synthetic_rewrite(param, pipeline):
+    params = SyntheticParams().with_size(param, 3)
+    src = gen_function(params)
+    env = gen_env()
+    decorator_t, passes = PIPELINES[pipeline]
+    decorator = decorator_t(passes(), env=env, in_memory=True)
+    prepared = PREPARE[pipeline](src) if pipeline in PREPARE else src
+    tree, env, metadata = decorator.run_passes(decorator.parse_source(prepared), env, {})
+    rewritten = decorator.finalize(tree, env, metadata)
+
+    env_dict = dict(gen_env())
+    exec(src, env_dict)
+    original = env_dict['synthetic']
+
+    for a, b, c in itertools.product(range(-1, 3), repeat=3):
+        o1, o2 = _Obj(), _Obj()
+        assert original(a, b, c, o1) == rewritten(a, b, c, o2)
+        assert vars(o1) == vars(o2)
+
+
+def test_run():
+    results = run('ssa', 'statements', [1, 2], repeat=1)
+    assert {'parse', 'loop_unroll', 'ssa', 'exec'} <= results.keys()
+    for points in results.values():
+        assert points.keys() == {1, 2}
+        for s in points.values():
+            assert s.wall > 0 and s.peak_mem is not None
+        assert growth(points) is not None
+
+
+def test_max_exponent_fails(monkeypatch, capsys):
+    from ast_tools.passes import Pass, apply_cst_passes
+
+    class broken(Pass):
+        def rewrite(self, tree, env, metadata):
+            raise RuntimeError('broken')
+
+    monkeypatch.setitem(PIPELINES, 'broken', (apply_cst_passes, lambda: [broken()]))
+    args = ['--vary', 'statements', '--sizes', '1,2', '--repeat', '1', '--max-exponent', '100']
+    assert main(['--pipeline', 'cse', *args]) == 0
+    assert main(['--pipeline', 'broken', *args]) == 1
+    assert 'broken failed' in capsys.readouterr().err
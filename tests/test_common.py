@@ -1,9 +1,18 @@
 import ast
+import inspect
+import os
+import textwrap
+import traceback
+
+import pytest
+
 import astor
 
 import libcst as cst
 
 from ast_tools.common import get_ast, get_cst, gen_free_name, gen_free_prefix, to_source
+from ast_tools.common import exec_str_in_file, gc_sources, set_source_limits
+from ast_tools.common import NameAllocator, get_name_allocator, NAME_ALLOCATOR
 from ast_tools.stack import SymbolTable
 from ast_tools.passes import apply_passes
 
@@ -64,6 +73,46 @@ P1 = P0()
     free_prefix = gen_free_prefix(tree, env, 'P')
     assert free_prefix == 'P2'
 
+def test_name_allocator():
+    src = '''
+class P:
+    P5 = 1
+    def __init__(self): self.y = 0
+def P0():
+    return P.P5
+P1 = P0()
+'''
+    tree = cst.parse_module(src)
+    env = SymbolTable({'P3': 'foo'}, {})
+    allocator = NameAllocator(tree, env)
+
+    assert allocator.fresh_name() == '_auto_name_0'
+    assert allocator.fresh_name() == '_auto_name_1'
+    assert allocator.fresh_name('P') == 'P2'
+    assert allocator.fresh_name('P') == 'P4'
+    # P5 is bound in the class body
+    assert allocator.fresh_name('P') == 'P6'
+    # builtins are reserved
+    assert allocator.fresh_name('len') == 'len0'
+
+    assert allocator.fresh_prefix('x_') == 'x_'
+    assert allocator.fresh_prefix('x_') == 'x_0'
+    assert not allocator.is_free_name('x_1')
+    # names in env are checked when allocating
+    env.locals['y_a'] = 1
+    assert allocator.fresh_prefix('y_') == 'y_0'
+
+    metadata = {}
+    allocator = get_name_allocator(tree, env, metadata)
+    assert metadata[NAME_ALLOCATOR] is allocator
+    assert get_name_allocator(tree, env, metadata) is allocator
+    assert allocator.fresh_name('P') == 'P2'
+    new_tree = cst.parse_module('P7 = P2')
+    assert get_name_allocator(new_tree, env, metadata) is allocator
+    assert allocator.fresh_name('P') == 'P4'
+    assert allocator.fresh_name('P') == 'P6'
+    assert allocator.fresh_name('P') == 'P8'
+
 def test_exec_in_file():
     x = 3
     def foo():
@@ -75,3 +124,103 @@ def test_exec_in_file():
         return x
 
     assert foo() == 3
+
+
+def test_exec_in_memory(tmp_path):
+    path = str(tmp_path / 'src')
+
+    @apply_passes(passes=(), path=path, in_memory=True)
+    def foo(x):
+        return 1 // x
+
+    assert foo(1) == 1
+    assert not os.path.exists(path)
+    assert foo.__code__.co_filename.startswith('<')
+    assert inspect.getsource(foo) == '''\
+def foo(x):
+    return 1 // x
+'''
+
+    try:
+        foo(0)
+    except ZeroDivisionError:
+        tb = traceback.format_exc()
+    assert 'return 1 // x' in tb
+
+    env = exec_str_in_file('y = 1', SymbolTable({}, {}), path=path, in_memory=True)
+    assert env['y'] == 1
+    assert not os.path.exists(path)
+
+
+def test_content_addressed_sources(tmp_path):
+    path = str(tmp_path / 'src')
+
+    def make():
+        @apply_passes(passes=(), path=path)
+        def foo():
+            return 0
+        return foo
+
+    f0, f1 = make(), make()
+    assert f0.__code__.co_filename == f1.__code__.co_filename
+    assert os.listdir(path) == [os.path.basename(f0.__code__.co_filename)]
+
+    st = SymbolTable({}, {})
+    for i in range(4):
+        exec_str_in_file(f'x = {i}', st, path=path)
+    assert len(os.listdir(path)) == 5
+
+    # remove sources until the directory fits in 8 bytes
+    assert gc_sources(path, max_bytes=8) <= 8
+    assert len(os.listdir(path)) == 1
+    # foo is recreated
+    make()
+    assert len(os.listdir(path)) == 2
+    # a limit is required
+    with pytest.raises(ValueError):
+        gc_sources(path)
+    assert len(os.listdir(path)) == 2
+    assert gc_sources(path, max_bytes=0) == 0
+    assert os.listdir(path) == []
+
+    set_source_limits(max_bytes=12)
+    try:
+        for i in range(4):
+            exec_str_in_file(f'x = {i}', st, path=path)
+        assert len(os.listdir(path)) == 2
+    finally:
+        set_source_limits()
+
+
+def _deco(obj):
+    return obj
+
+
+# comments before a definition are not part of its source
+@_deco
+class _Outer:
+    @_deco
+    def method(self, x):
+        # a comment
+        return x
+
+    class Inner:
+        def method(self): pass
+
+
+def test_get_cst_shares_parse(monkeypatch):
+    import libcst
+    from ast_tools import common
+
+    common.clear_source_cache()
+    calls = []
+    parse_module = libcst.parse_module
+    monkeypatch.setattr(libcst, 'parse_module', lambda src: calls.append(src) or parse_module(src))
+
+    objs = [_Outer, _Outer.method, _Outer.Inner, _Outer.Inner.method]
+    for obj in objs:
+        src = textwrap.dedent(inspect.getsource(obj))
+        assert to_source(get_cst(obj)) == to_source(cst.parse_statement(src))
+        assert ast.dump(get_ast(obj), include_attributes=True) == \
+            ast.dump(ast.parse(src).body[0], include_attributes=True)
+    assert len(calls) == 1
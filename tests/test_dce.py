@@ -0,0 +1,92 @@
+import inspect
+
+import libcst as cst
+import pytest
+
+from ast_tools.common import exec_def_in_file
+from ast_tools.passes import apply_passes, dce, ssa
+from ast_tools.stack import SymbolTable
+
+
+def test_dce():
+    @apply_passes([dce()])
+    def foo(x, y):
+        a = x
+        b = a if y else x
+        c = not b
+        d = (c, 1)
+        e = x + 1
+        if y:
+            f = e
+        else: g = y
+        def bar():
+            return h
+        h = y
+        return y
+
+    assert inspect.getsource(foo) == '''\
+def foo(x, y):
+    e = x + 1
+    if y:
+        pass
+    else: pass
+    def bar():
+        return h
+    h = y
+    return y
+'''
+    assert foo(1, 2) == 2
+
+
+def test_dce_assume_pure():
+    def foo(t, x):
+        a = t.x
+        b = x + 1
+        c = x[0] < b
+        d = len(x)
+        return x
+
+    assert inspect.getsource(apply_passes([dce()])(foo)) == '''\
+def foo(t, x):
+    a = t.x
+    b = x + 1
+    c = x[0] < b
+    d = len(x)
+    return x
+'''
+    assert inspect.getsource(apply_passes([dce(assume_pure=True)])(foo)) == '''\
+def foo(t, x):
+    d = len(x)
+    return x
+'''
+
+
+@pytest.mark.parametrize('stmt', ['global a', 'print(locals())'])
+def test_dce_pinned(stmt):
+    src = f'''\
+def foo(x):
+    {stmt}
+    a = x
+    return x
+'''
+    tree = cst.parse_statement(src)
+    foo = exec_def_in_file(tree, SymbolTable({}, {'print': print}))
+    assert inspect.getsource(apply_passes([dce()])(foo)) == src
+
+
+def test_dce_after_ssa():
+    def foo(x, y):
+        z = 0
+        if x:
+            z = y
+            w = z
+        return x
+
+    bar = apply_passes([ssa(), dce()])(foo)
+    assert inspect.getsource(bar) == '''\
+def foo(x, y):
+    __0_return_0 = x
+    return __0_return_0
+'''
+    for x in range(2):
+        assert foo(x, 1) == bar(x, 1)
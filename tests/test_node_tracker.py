@@ -0,0 +1,51 @@
+import libcst as cst
+
+from ast_tools.transformers.node_tracker import NodeTrackingTransformer, ProvenanceTable
+
+
+def test_provenance_table():
+    a, b, c, d = (cst.Name(x) for x in 'abcd')
+    table = ProvenanceTable()
+    table[a] = c
+    table[b] = c
+    table[a] = d
+    table[a] = d
+    assert table[a] == {c, d}
+    assert table.i[c] == {a, b}
+    assert len(table) == 2
+    assert len(table.i) == 2
+    assert c not in table
+    assert c in table.i
+    assert list(table.edges()) == [(a, c), (b, c), (a, d)]
+    # nodes are keyed by identity
+    assert cst.Name('a') not in table
+
+    e = cst.Name('e')
+    prev = ProvenanceTable({e: [a, b], d: [d]})
+    composed = table.compose(prev)
+    assert composed[e] == {c, d}
+    assert composed[d] == {d}
+    assert composed.i[c] == {e}
+
+
+class Rename(NodeTrackingTransformer):
+    def leave_Name(self, original_node, updated_node):
+        return updated_node.with_changes(value=updated_node.value + '_0')
+
+
+def test_tracking():
+    tree = cst.parse_expression('f(x, y)')
+    transformer = Rename()
+    new_tree = tree.visit(transformer)
+    table = transformer.node_tracking_table
+    assert table[tree] == {new_tree}
+    assert table.i[new_tree.func] == {tree.func}
+    assert table.i[new_tree.args[1].value] == {tree.args[1].value}
+
+    # trace the new tree back through a second transformation
+    transformer = Rename()
+    newer_tree = new_tree.visit(transformer)
+    traced = transformer.trace_origins(table)
+    assert traced[tree] == {newer_tree}
+    assert traced.i[newer_tree.func] == {tree.func}
+    assert newer_tree.func.value == 'f_0_0'
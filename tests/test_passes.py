@@ -133,3 +133,152 @@ def test_custom_env():
         return x
 
     assert f() == 1
+
+
+def test_fused_passes():
+    import libcst as cst
+    from ast_tools.passes import bool_to_bit, remove_asserts, if_to_phi, loop_unroll
+    from ast_tools.passes import fuse_passes
+    from ast_tools.transformers.fused import FusedTransformer
+    from ast_tools.transformers import Inliner
+
+    src = '''\
+def foo(x, y):
+    assert x and y
+    for i in unroll(range(2)):
+        z = (x and not y) if i else (x or y)
+    return z
+'''
+    tree = cst.parse_statement(src)
+    passes = [remove_asserts(), bool_to_bit(), if_to_phi('phi'), loop_unroll()]
+    env = SymbolTable({'unroll': ast_tools.macros.unroll}, {})
+
+    args = tree, env, {}
+    for p in passes:
+        args = p(args)
+    sequential = args[0]
+
+    fused, _, _ = fuse_passes(passes, tree, env, {})
+    assert fused.deep_equals(sequential)
+    assert ast_tools.common.to_source(fused) == '''\
+def foo(x, y):
+    pass
+    z = phi(0, (x & ~y), (x | y))
+    z = phi(1, (x & ~y), (x | y))
+    return z
+'''
+
+    # Inliner controls recursion so it is not node-local
+    tree = cst.parse_statement('if x: pass')
+    with pytest.raises(TypeError):
+        tree.visit(FusedTransformer([Inliner(env), *bool_to_bit().transformers(tree, env, {})]))
+
+
+def test_analysis_manager():
+    from libcst.metadata import PositionProvider, ExpressionContextProvider
+    from ast_tools.passes import Pass, bool_to_bit
+    from ast_tools.metadata import ANALYSIS_MANAGER
+
+    class record_cached(Pass):
+        def __init__(self, requires=()):
+            self.requires = requires
+
+        def rewrite(self, tree, env, metadata):
+            manager = metadata[ANALYSIS_MANAGER]
+            metadata.setdefault('cached', []).append(manager.cached(tree))
+            return tree, env, metadata
+
+    @apply_cst_passes([
+        record_cached(requires=(PositionProvider,)),
+        record_cached(requires=(ExpressionContextProvider,)),
+        bool_to_bit(),
+        record_cached(),
+    ], metadata_attr='md')
+    def foo(x):
+        return x and x
+
+    assert foo.md['cached'] == [
+        {PositionProvider},
+        # the tree was not modified so positions are still valid
+        {PositionProvider, ExpressionContextProvider},
+        # bool_to_bit does not preserve anything
+        set(),
+    ]
+    assert ANALYSIS_MANAGER not in foo.md
+
+
+def test_analysis_manager_results():
+    import libcst as cst
+    from libcst.metadata import PositionProvider, ExpressionContextProvider
+    from ast_tools.metadata import AnalysisManager
+
+    manager = AnalysisManager()
+    tree = cst.parse_statement('x = y')
+    positions = manager.resolve(tree, PositionProvider)
+    assert manager.resolve(tree, PositionProvider) is positions
+
+    # recorded results are served without resolving
+    new_tree = tree.with_changes()
+    manager.update(tree, new_tree, (PositionProvider,))
+    assert manager.cached(new_tree) == {PositionProvider}
+    assert manager.cached(tree) == set()
+    manager.record(new_tree, ExpressionContextProvider, {})
+    results = manager.resolve_many(new_tree, (PositionProvider, ExpressionContextProvider))
+    assert results[ExpressionContextProvider] == {}
+    # preserved results are moved to the nodes of the new tree
+    new_positions = results[PositionProvider]
+    assert new_positions[new_tree] == positions[tree]
+    assert tree not in new_positions
+    assert new_positions[new_tree.body[0]] == positions[tree.body[0]]
+
+    class get_ctx(cst.CSTVisitor):
+        METADATA_DEPENDENCIES = (ExpressionContextProvider,)
+
+        def visit_Name(self, node):
+            self.ctx = self.get_metadata(ExpressionContextProvider, node, None)
+
+    visitor = get_ctx()
+    manager.visit(new_tree, visitor)
+    assert visitor.ctx is None
+    assert visitor.metadata == {}
+
+    # results are dropped when the nodes they describe are replaced
+    newer_tree = new_tree.with_changes(body=[cst.Pass()])
+    manager.update(new_tree, newer_tree, (PositionProvider,))
+    assert manager.cached(newer_tree) == set()
+
+
+def test_analysis_manager_preserves(monkeypatch):
+    from ast_tools.passes import Pass, bool_to_bit, remove_asserts
+    from ast_tools.metadata import ANALYSIS_MANAGER, AlwaysReturnsProvider
+
+    visits = []
+    leave = AlwaysReturnsProvider.leave_IndentedBlock
+    def leave_IndentedBlock(self, node):
+        visits.append(node)
+        return leave(self, node)
+    monkeypatch.setattr(AlwaysReturnsProvider, 'leave_IndentedBlock', leave_IndentedBlock)
+
+    class always_returns(Pass):
+        requires = (AlwaysReturnsProvider,)
+
+        def rewrite(self, tree, env, metadata):
+            manager = metadata[ANALYSIS_MANAGER]
+            always = manager.resolve(tree, AlwaysReturnsProvider)
+            metadata.setdefault('always', []).append(always[tree.body])
+            return tree, env, metadata
+
+    @apply_cst_passes([
+        always_returns(),
+        remove_asserts(),
+        bool_to_bit(),
+        always_returns(),
+    ], metadata_attr='md')
+    def foo(x, y):
+        assert x
+        return x and not y
+
+    assert foo(True, False)
+    assert foo.md['always'] == [True, True]
+    # the provider ran once, on the original tree
+    assert len(visits) == 1
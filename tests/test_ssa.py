@@ -7,7 +7,7 @@ import libcst as cst
 import pytest
 
 from ast_tools.common import exec_def_in_file
-from ast_tools.passes.ssa import ssa
+from ast_tools.passes.ssa import ssa, SSASymbolTable
 from ast_tools.passes import apply_passes, debug
 from ast_tools.stack import SymbolTable
 
@@ -222,6 +222,33 @@ def foo(a, b, c):   # 2
         'c': 'c',
         } for i in range(2, 12)}
     assert symbol_table == gold_table
+    assert symbol_table.resolve(5, 'a') == 'a_0'
+    assert symbol_table.resolve(11, 'b') == 'b_2'
+    with pytest.raises(KeyError):
+        symbol_table.resolve(12, 'a')
+    assert symbol_table.export()['a'] == (
+        (2, 3, 'a'), (4, 5, 'a_0'), (6, 6, 'a_1'), (7, 11, 'a_2'))
+
+
+def test_ssa_symbol_table():
+    table = SSASymbolTable(1, 10)
+    table.set(1, 'x', 'x')
+    table.set(4, 'x', 'x_0')
+    table.set(8, 'x', 'x_1')
+    table.set(6, 'y', 'y_0')
+    # later definitions are overridden
+    table.set(6, 'x', 'x_2')
+    table.set(11, 'x', 'x_3')
+    assert table.resolve(5, 'x') == 'x_0'
+    assert table.resolve(9, 'x') == 'x_2'
+    with pytest.raises(KeyError):
+        table.resolve(5, 'y')
+    assert table[6] == {'x': 'x_2', 'y': 'y_0'}
+    assert len(table) == 10
+    assert table.export() == {
+        'x': ((1, 3, 'x'), (4, 5, 'x_0'), (6, 10, 'x_2')),
+        'y': ((6, 10, 'y_0'),),
+    }
 
 class Thing:
     def __init__(self, x=None):
@@ -469,3 +496,273 @@ def test_issue_79(strict):
     for _ in range(8):
         x = Wrapper(random.randint(0, 1<<10))
         assert f1(x) == f2(x)
+
+
+def test_elif_attr_order():
+    def f1(t, x):
+        t.b = x
+        if x:
+            t.a = 0
+        elif t.b:
+            return 1
+        return t.b
+
+    f2 = apply_passes([ssa(validate=True)])(f1)
+    # attributes are read in the order they are written
+    assert inspect.getsource(f2) == '''\
+def f1(t, x):
+    _attr_t_b_0 = t.b
+    _attr_t_a_0 = t.a
+    _attr_t_b_1 = x
+    _cond_1 = x
+    _attr_t_a_1 = 0
+    _cond_0 = _attr_t_b_1
+    __0_final_t_b_0 = _attr_t_b_1; __0_final_t_a_0 = _attr_t_a_0; __0_return_0 = 1
+    _attr_t_a_2 = _attr_t_a_1 if _cond_1 else _attr_t_a_0
+    __0_final_t_b_1 = _attr_t_b_1; __0_final_t_a_1 = _attr_t_a_2; __0_return_1 = _attr_t_b_1
+    t.b = __0_final_t_b_0 if not _cond_1 and _cond_0 else __0_final_t_b_1
+    t.a = __0_final_t_a_0 if not _cond_1 and _cond_0 else __0_final_t_a_1
+    return __0_return_0 if not _cond_1 and _cond_0 else __0_return_1
+'''
+    t1 = Thing()
+    t2 = Thing()
+    for x in (0, 1):
+        t1.a = t2.a = t1.b = t2.b = None
+        assert f1(t1, x) == f2(t2, x)
+        assert (t1.a, t1.b) == (t2.a, t2.b)
+
+
+def test_loops():
+    def f1(t, n):
+        i = 0
+        while i < n:
+            if i % 2:
+                t.x = t.x + i
+            for j in range(i):
+                t.x = t.x - j
+            i = i + 1
+        else:
+            i = -i
+        return i
+
+    f2 = apply_passes([ssa(validate=True)])(f1)
+    assert inspect.getsource(f2) == '''\
+def f1(t, n):
+    _attr_t_x_0 = t.x
+    i_0 = 0
+    _attr_t_x_1 = _attr_t_x_0
+    i_1 = i_0
+    while i_1 < n:
+        _cond_0 = i_1 % 2
+        _attr_t_x_2 = _attr_t_x_1 + i_1
+        _attr_t_x_3 = _attr_t_x_2 if _cond_0 else _attr_t_x_1
+        _attr_t_x_4 = _attr_t_x_3
+        for j_0 in range(i_1):
+            _attr_t_x_5 = _attr_t_x_4 - j_0
+            _attr_t_x_4 = _attr_t_x_5
+        i_2 = i_1 + 1
+        _attr_t_x_1 = _attr_t_x_4
+        i_1 = i_2
+    i_3 = -i_1
+    __0_final_t_x_0 = _attr_t_x_1; __0_return_0 = i_3
+    t.x = __0_final_t_x_0
+    return __0_return_0
+'''
+    t1 = Thing()
+    t2 = Thing()
+    for n in range(5):
+        t1.x = t2.x = 0
+        assert f1(t1, n) == f2(t2, n)
+        assert t1.x == t2.x
+
+
+@pytest.mark.parametrize('strict', [True, False])
+def test_loop_defined_names(strict):
+    def f1(n):
+        for i in range(n):
+            x = i
+        return x
+
+    if strict:
+        with pytest.raises(SyntaxError):
+            apply_passes([ssa(strict)])(f1)
+    else:
+        f2 = apply_passes([ssa(strict)])(f1)
+        for n in range(1, 4):
+            assert f1(n) == f2(n)
+
+
+@pytest.mark.parametrize('stmt', ['return i', 'break', 'continue'])
+def test_loop_unsupported(stmt):
+    src = f'''\
+def f(n):
+    for i in range(n):
+        if i:
+            {stmt}
+    return n
+'''
+    tree = cst.parse_statement(src)
+    f = exec_def_in_file(tree, SymbolTable({}, {}))
+    with pytest.raises(NotImplementedError):
+        apply_passes([ssa()])(f)
+
+
+def test_untracked():
+    def f1(t, x):
+        if x:
+            t.x = x
+            return 0
+        elif t.x:
+            x = x + 1
+        return x
+
+    tracked = apply_passes([ssa()], metadata_attr='metadata')(f1)
+    untracked = apply_passes([ssa(track=False)], metadata_attr='metadata')(f1)
+    assert inspect.getsource(tracked) == inspect.getsource(untracked)
+    assert 'SYMBOL-TABLE' in tracked.metadata
+    assert 'SYMBOL-TABLE' not in untracked.metadata
+    t1 = Thing()
+    t2 = Thing()
+    for x in (0, 1):
+        for t_x in (0, 1):
+            t1.x = t2.x = t_x
+            assert untracked(t1, x) == f1(t2, x)
+            assert t1.x == t2.x
+
+
+def test_dead_names_not_muxed():
+    def f1(x, y):
+        if x:
+            t = x + 1
+            y = t * 2
+            if y > 2:
+                t = 0
+                y = y + 1
+        else:
+            t = x - 1
+            y = t * 3
+        for i in range(x):
+            if i:
+                y = y + i
+                t = i
+        return y
+
+    f2 = apply_passes([ssa()])(f1)
+    # t is never read so it is not merged
+    assert inspect.getsource(f2) == '''\
+def f1(x, y):
+    _cond_1 = x
+    t_0 = x + 1
+    y_0 = t_0 * 2
+    _cond_0 = y_0 > 2
+    t_1 = 0
+    y_1 = y_0 + 1
+    y_2 = y_1 if _cond_0 else y_0
+    t_2 = x - 1
+    y_3 = t_2 * 3
+    y_4 = y_2 if _cond_1 else y_3
+    y_5 = y_4
+    for i_0 in range(x):
+        _cond_2 = i_0
+        y_6 = y_5 + i_0
+        t_3 = i_0
+        y_7 = y_6 if _cond_2 else y_5
+        y_5 = y_7
+    __0_return_0 = y_5
+    return __0_return_0
+'''
+    for x in range(-1, 4):
+        assert f1(x, 0) == f2(x, 0)
+
+
+@pytest.mark.parametrize('dce', [False, True])
+def test_loop_target_shadows(dce):
+    from ast_tools.passes import dce as dce_pass
+
+    def f1(n):
+        x = 0
+        for x in range(n):
+            pass
+        return x
+
+    def g1(n):
+        a, b = 0, 1
+        for a, b in zip(range(n), range(1, n + 1)):
+            b = b * 2
+        return a, b
+
+    passes = [ssa(), dce_pass()] if dce else [ssa()]
+    f2 = apply_passes(passes)(f1)
+    g2 = apply_passes(passes)(g1)
+    for n in range(4):
+        assert f1(n) == f2(n)
+        assert g1(n) == g2(n)
+
+
+def test_loop_under_if():
+    def f1(n):
+        if n > 0:
+            while n != 0:
+                n = n - 1
+        return n
+
+    def g1(xs):
+        s = 0
+        if xs is not None:
+            for x in xs:
+                s = s + x
+        else:
+            s = -1
+        return s
+
+    def h1(n):
+        if n < 0:
+            return n
+        elif n == 0:
+            while n < 10 or n > 20:
+                n = n + 1
+        while n > 1:
+            n = n - 1
+        return n
+
+    f2 = apply_passes([ssa()])(f1)
+    assert inspect.getsource(f2) == '''\
+def f1(n):
+    _cond_0 = n > 0
+    n_0 = n
+    while _cond_0 and n_0 != 0:
+        n_1 = n_0 - 1
+        n_0 = n_1
+    n_2 = n_0 if _cond_0 else n
+    __0_return_0 = n_2
+    return __0_return_0
+'''
+    g2 = apply_passes([ssa()])(g1)
+    assert 'for x_0 in xs if _cond_0 else ():' in inspect.getsource(g2)
+    h2 = apply_passes([ssa()])(h1)
+    # the loops do not execute (or never terminate) if not gaurded
+    for n in range(-2, 4):
+        assert f1(n) == f2(n)
+        assert h1(n) == h2(n)
+    for xs in (None, [], [1, 2]):
+        assert g1(xs) == g2(xs)
+
+
+def _shadowed():
+    return 0
+
+
+def test_loop_def_not_merged():
+    def f1(n):
+        x = 0
+        for i in range(n):
+            def _shadowed():
+                return 1
+            x = x + _shadowed()
+        return x
+
+    f2 = apply_passes([ssa()])(f1)
+    # _shadowed is not renamed so it has no header
+    assert '_shadowed_' not in inspect.getsource(f2)
+    for n in range(3):
+        assert f1(n) == f2(n)
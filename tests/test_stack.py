@@ -1,4 +1,5 @@
 import pytest
+import libcst as cst
 from ast_tools import stack
 
 MAGIC = 'foo'
@@ -74,3 +75,142 @@ def test_get_symbol_table_copy_frames():
     for j in range(5):
         assert non_copy_sts[j].locals["i"] == 4
         assert copy_sts[j].locals["i"] == j
+
+def test_get_symbol_table_max_depth():
+    MAGIC = 'bar'
+    def inner():
+        MAGIC = 'baz'
+        MAGIC1 = 'baz'
+        return stack.get_symbol_table(max_depth=1), stack.get_symbol_table(max_depth=2)
+
+    st1, st2 = inner()
+    assert st1.locals['MAGIC'] == 'baz'
+    assert 'inner' not in st1.locals
+    assert st2.locals['MAGIC'] == 'baz'
+    assert st2.locals['inner'] is inner
+    assert st2.globals['MAGIC'] == 'foo'
+
+def test_get_symbol_table_stop_at_module():
+    MAGIC = 'bar'
+    env = {'get_symbol_table': stack.get_symbol_table, 'MAGIC2': 'baz'}
+    exec('st = get_symbol_table(stop_at_module=True)', env)
+    st = env['st']
+    assert st.locals['MAGIC2'] == 'baz'
+    assert 'MAGIC' not in st
+    assert 'pytest' not in st
+
+    exec('st = get_symbol_table()', env)
+    assert env['st']['MAGIC'] == 'bar'
+
+def test_lazy_globals():
+    inner = {'a': 1, 'b': 2}
+    outer = {'a': 0, 'c': 3}
+    g = stack.LazyGlobals([inner, outer, inner])
+    assert len(g.maps) == 2
+    assert g['a'] == 1
+    assert g['c'] == 3
+    assert 'd' not in g
+
+    g['d'] = 4
+    del g['b']
+    assert 'd' not in inner and inner['b'] == 2
+    assert 'b' not in g
+    assert g.flatten() == {'a': 1, 'c': 3, 'd': 4}
+    assert dict(g) == g.flatten()
+
+    st = stack.SymbolTable({'a': 'local'}, g)
+    assert st.flatten() == dict(st) == {'a': 'local', 'c': 3, 'd': 4}
+
+def test_get_symbol_table_lazy_globals():
+    st = stack.get_symbol_table()
+    assert isinstance(st.globals, stack.LazyGlobals)
+    assert st.globals['MAGIC'] == 'foo'
+    st.globals['MAGIC'] = 'baz'
+    assert MAGIC == 'foo'
+
+def test_symbol_table_keys():
+    locals = {'a': 1, 'ab': 2}
+    globals = {'abc': 3, 'b': 4}
+    st = stack.SymbolTable(locals, globals)
+    assert st.keys() == {'a', 'ab', 'abc', 'b'}
+    assert len(st) == 4
+    assert st.has_prefix('ab')
+    assert not st.has_prefix('c')
+    assert st.with_prefix('ab') == ['ab', 'abc']
+
+    # writes through the symbol table are seen
+    st.locals['c'] = 5
+    assert locals['c'] == 5
+    assert 'c' in st.keys()
+    assert st.has_prefix('c')
+
+    # including those which don't change the size of a map
+    del st.locals['c']
+    st.locals['d'] = 5
+    assert st.keys() == {'a', 'ab', 'abc', 'b', 'd'}
+    assert not st.has_prefix('c')
+    assert st.with_prefix('d') == ['d']
+    assert set(st) == {'a', 'ab', 'abc', 'b', 'd'}
+
+    # the keys are a snapshot of the underlying maps
+    globals['e'] = 6
+    assert 'e' in st
+    assert not st.has_prefix('e')
+    st.invalidate()
+    assert st.with_prefix('e') == ['e']
+
+    g = stack.LazyGlobals([globals])
+    st = stack.SymbolTable({}, g)
+    assert st.keys() == {'abc', 'b', 'e'}
+    g['f'] = 7
+    assert st.with_prefix('f') == ['f']
+    del g['abc']
+    assert not st.has_prefix('abc')
+
+
+def test_symbol_table_index_cached(monkeypatch):
+    from ast_tools.common import NameAllocator
+    builds = []
+    build_index = stack.SymbolTable._build_index
+    def _build_index(self):
+        builds.append(self)
+        return build_index(self)
+    monkeypatch.setattr(stack.SymbolTable, '_build_index', _build_index)
+
+    env = stack.SymbolTable({}, stack.LazyGlobals([{f'x{i}': i for i in range(100)}]))
+    allocator = NameAllocator(cst.parse_module('pass'), env)
+    for _ in range(10):
+        allocator.fresh_name('x')
+        allocator.fresh_prefix('x_')
+    assert len(builds) == 1
+
+    env.locals['y_'] = 0
+    assert allocator.fresh_prefix('y_') == 'y_0'
+    assert len(builds) == 2
+
+
+def test_get_function_symbol_table():
+    def define(z):
+        @stack.inspect_symbol_table
+        def deco(st, fn):
+            fn.st = st
+            fn.fst = stack.get_function_symbol_table(fn, [deco])
+            return fn
+
+        w = 'defining'
+        def fn():
+            return x + y + z
+        return deco(fn)
+
+    def caller():
+        y = 'caller'
+        return define('closure')
+
+    fn = caller()
+    # names from the closure, the defining frame and the globals
+    assert fn.fst['z'] == 'closure'
+    assert fn.fst['w'] == 'defining'
+    assert fn.fst['MAGIC'] == 'foo'
+    # the locals of other frames are only found on the stack
+    assert fn.st['y'] == 'caller'
+    assert 'y' not in fn.fst
@@ -1,6 +1,8 @@
 """
 Test visitors
 """
+import ast
+
 import libcst as cst
 
 import pytest
@@ -8,6 +10,7 @@ import pytest
 from ast_tools.visitors import collect_names
 from ast_tools.visitors import collect_targets
 from ast_tools.visitors import used_names
+from ast_tools.visitors import bound_names
 
 
 def test_collect_targets():
@@ -54,6 +57,61 @@ async def h(): pass
     assert used_names(tree) == {'x', 'foo', 'A', 'h'}
     assert used_names(tree.body[1].body) == {'g'}
 
+def test_used_names_cache():
+    src = 'x = 1'
+    used_names.cache_clear()
+    t0 = cst.parse_module(src)
+    t1 = cst.parse_module(src)
+    assert used_names(t0) == {'x'}
+    assert used_names(t0) == {'x'}
+    assert used_names.cache_info().hits == 1
+    # keyed on identity
+    assert used_names(t1) == {'x'}
+    info = used_names.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+
+    # bounded
+    for _ in range(info.maxsize + 1):
+        used_names(cst.parse_module(src))
+    assert used_names.cache_info().currsize == info.maxsize
+    used_names.cache_clear()
+    assert used_names.cache_info().currsize == 0
+
+def test_bound_names():
+    src = '''
+import a.b
+from c import d as e
+x, (y, *z) = 1
+w.attr = v[0] = 2
+def foo(p, *q, r=0, **s):
+    global g
+    t += 1
+    for i in range(3): pass
+    with open(p) as f: pass
+    try: pass
+    except Exception as exc: pass
+    return [j for j in q if (k := j)]
+
+class A:
+    u: int = 0
+'''
+    golds = {'a', 'e', 'x', 'y', 'z', 'foo', 'p', 'q', 'r', 's', 'g', 't',
+             'i', 'f', 'exc', 'j', 'k', 'A', 'u'}
+    assert bound_names(cst.parse_module(src)) == golds
+    assert bound_names(ast.parse(src)) == golds
+
+    # ast nodes are mutable so are not cached
+    bound_names.cache_clear()
+    tree = ast.parse('x = 0')
+    assert bound_names(tree) == {'x'}
+    tree.body.append(ast.parse('y = 0').body[0])
+    assert bound_names(tree) == {'x', 'y'}
+    assert bound_names.cache_info().currsize == 0
+
+    tree = cst.parse_module(src)
+    assert bound_names(tree) is bound_names(tree)
+    assert bound_names.cache_info().currsize == 1
+
 # Currently broken requires new release of LibCSt
 def test_collect_names():
     """